@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+送信データ一括インポートスクリプト
+紙・オフラインで集めた回答（生 payload の JSONL / CSV）をレコードストアへまとめて取り込む
+
+使い方:
+    python bulk_import.py submissions.jsonl
+    python bulk_import.py paper_form5.csv --form-id form5 --workers 8
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+from pathlib import Path
+
+# main.py と同じディレクトリから読み込む
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def main():
+    """メイン関数"""
+    parser = argparse.ArgumentParser(description="送信データの一括インポート（JSONL / CSV）")
+    parser.add_argument("files", nargs="+", help="取り込むファイル（.jsonl / .csv）")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="入力形式（省略時は拡張子で判定）")
+    parser.add_argument("--form-id", help="form_id 列が無い場合に使うフォーム（例: form5）")
+    parser.add_argument("--workers", type=int, help="変換に使うプロセス数（省略時は CPU コア数）")
+    args = parser.parse_args()
+
+    # アプリ本体の読み込み時のログは表示しない
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as app_main
+    app_main._ensure_dirs()
+
+    failed = 0
+    for name in args.files:
+        path = Path(name)
+        if not path.exists():
+            print(f"⚠ ファイルが見つかりません: {path}")
+            failed += 1
+            continue
+        fmt = args.format or ("csv" if path.suffix.lower() == ".csv" else "jsonl")
+        print(f"\n処理中: {path} ({fmt})")
+        with open(path, "r", encoding="utf-8-sig", newline="") as f:
+            with contextlib.redirect_stdout(io.StringIO()):
+                report = app_main._bulk_import(f, fmt, args.form_id, args.workers)
+        print(f"  行数: {report['rows']} / 取り込み: {report['imported']} / 保存済みより古い: {report['skipped_older']} / エラー: {report['failed']}")
+        print(f"  所要時間: {report['elapsed_sec']} 秒 ({report['rows_per_sec']} 行/秒, ワーカー {report['workers']})")
+        print(f"  内訳: {json.dumps(report['phases_sec'], ensure_ascii=False)}")
+        for err in report["errors"][:20]:
+            print(f"  ⚠ {err['line']} 行目: {err['error']}")
+        if report["failed"] > 20:
+            print(f"  …ほか {report['failed'] - 20} 件")
+        if report["failed"]:
+            failed += 1
+
+    # 終了前にジャーナルを確定させる
+    app_main._shutdown_flush_records()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
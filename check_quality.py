@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+データ品質チェックスクリプト
+レコードストアの one-hot 列の矛盾（はい/いいえの両方が 1、スケールの複数選択、f18 列の食い違い、0/1 以外の値）を検出する
+デプロイ後に流し、矛盾があれば終了コード 1 で終わる
+
+使い方:
+    python check_quality.py
+    python check_quality.py --form form18 --office 001 --limit 20
+    python check_quality.py --json
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+from pathlib import Path
+
+# main.py と同じディレクトリから読み込む
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def main():
+    """メイン関数"""
+    parser = argparse.ArgumentParser(description="one-hot 列の矛盾の検出")
+    parser.add_argument("--form", help="対象フォーム（例: form18。省略時は全フォーム）")
+    parser.add_argument("--office", help="対象事業所番号（省略時は全事業所）")
+    parser.add_argument("--limit", type=int, default=100, help="規則・列グループごとに表示する user_id の上限")
+    parser.add_argument("--json", action="store_true", help="結果を JSON で出力する")
+    args = parser.parse_args()
+
+    # アプリ本体の読み込み時のログは表示しない
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as app_main
+        report = app_main._quality_scan(args.form, args.office, args.limit)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print(f"対象: {app_main.RECORDS_PARTITION_DIR}")
+        print(f"  判定した行: {report['rows']} / 矛盾: {report['violations']} 件 / 所要時間: {report['elapsed_sec']} 秒")
+        for rule, groups in report["rules"].items():
+            if not groups:
+                continue
+            print(f"  [{rule}] {report['descriptions'][rule]}")
+            for name, entry in sorted(groups.items(), key=lambda kv: -kv[1]["count"]):
+                more = f" …ほか {entry['count'] - len(entry['user_ids'])} 件" if entry["count"] > len(entry["user_ids"]) else ""
+                print(f"    {name}: {entry['count']} 件 {', '.join(entry['user_ids'])}{more}")
+
+    sys.exit(1 if report["violations"] else 0)
+
+
+if __name__ == "__main__":
+    main()
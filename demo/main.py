@@ -98,4 +98,151 @@ async def download_export_demo():
     csv_path = "/var/www/app/backend/app/exports_demo/demo_records.csv"
     if os.path.exists(csv_path):
         return FileResponse(csv_path, media_type="text/csv", filename="demo_records.csv")
-    return {"error": "CSV file not found"}
\ No newline at end of file
+    return {"error": "CSV file not found"}
+
+# ----------------------------
+# 提出データ（DB）の保存・検索
+# ----------------------------
+# 絞り込みは DB 側で行う（PostgreSQL: JSONB + GIN / 式インデックス、ローカル: SQLite JSON1）
+try:
+    import json
+    from typing import List, Optional
+    from fastapi import Query
+    from sqlalchemy import func, select, text, bindparam
+    from database import SessionLocal, engine, Base
+    from models import Submission, answer_expr, ensure_submission_indexes
+except Exception as e:
+    SessionLocal = None
+    print("⚠ submissions DB unavailable:", e)
+
+
+@app.on_event("startup")
+def _init_submissions_db():
+    """テーブルとインデックスを用意する（DB に接続できない環境では何もしない）"""
+    if SessionLocal is None:
+        return
+    try:
+        Base.metadata.create_all(bind=engine)
+        ensure_submission_indexes(engine)
+    except Exception as e:
+        print("⚠ submissions DB init failed:", e)
+
+
+def _answer_variants(value: str) -> list:
+    """値の文字列と、数値として読める場合はその JSON 数値（"1" と 1 を同じ回答として扱う）"""
+    variants = [value]
+    try:
+        typed = json.loads(value)
+    except ValueError:
+        return variants
+    if isinstance(typed, (int, float)) and not isinstance(typed, bool):
+        variants.append(typed)
+    return variants
+
+
+def _answer_filters(answers: List[str], dialect: str) -> list:
+    """answer=キー=値 / キー=値1|値2 を WHERE 条件にする（文字列でも数値でも一致させる）"""
+    conds = []
+    for i, item in enumerate(answers or []):
+        key, sep, value = item.partition("=")
+        if not sep or not key:
+            raise ValueError(f"answer は キー=値 の形式で指定してください: {item}")
+        values = value.split("|")
+        if dialect == "postgresql" and len(values) == 1:
+            # 包含検索（GIN インデックスが効く）。文字列と数値の両方の文書で探す
+            docs = [json.dumps({key: v}, ensure_ascii=False) for v in _answer_variants(values[0])]
+            sql = " OR ".join(f"data_json @> CAST(:ans{i}_{j} AS jsonb)" for j in range(len(docs)))
+            conds.append(text(f"({sql})").bindparams(
+                *[bindparam(f"ans{i}_{j}", doc) for j, doc in enumerate(docs)]
+            ))
+        elif dialect == "postgresql":
+            # ->> は数値もテキストで返すので文字列のまま比較できる
+            conds.append(answer_expr(key, dialect).in_(values))
+        else:
+            # json_extract は型付きの値を返すので数値の候補も並べる
+            conds.append(answer_expr(key, dialect).in_(
+                [v for value in values for v in _answer_variants(value)]
+            ))
+    return conds
+
+
+@app.post("/api/submissions")
+def create_submission(payload: dict):
+    """提出データを1件保存（facility_id / individual_id と回答の dict）"""
+    if SessionLocal is None:
+        return {"status": "error", "detail": "database unavailable"}
+    facility_id = str(payload.get("facility_id") or payload.get("office_id") or "").strip()
+    individual_id = str(payload.get("individual_id") or payload.get("personal_id") or payload.get("person_id") or "").strip()
+    if not facility_id or not individual_id:
+        raise HTTPException(status_code=400, detail="facility_id と individual_id は必須です")
+    answers = payload.get("answers")
+    if not isinstance(answers, dict):
+        skip = {"facility_id", "office_id", "individual_id", "personal_id", "person_id"}
+        answers = {k: v for k, v in payload.items() if k not in skip}
+    with SessionLocal() as db:
+        sub = Submission(facility_id=facility_id, individual_id=individual_id, data_json=answers)
+        db.add(sub)
+        db.commit()
+        return {"status": "ok", "id": sub.id}
+
+
+@app.get("/api/submissions")
+def list_submissions(
+    facility_id: Optional[str] = None,
+    individual_id: Optional[str] = None,
+    answer: List[str] = Query(default=[]),
+    limit: int = Query(default=100, ge=1, le=1000),
+    offset: int = Query(default=0, ge=0),
+):
+    """施設・個人・回答の条件で検索（例: ?facility_id=001&answer=sex=女&answer=care_status_nursing=要介護1|要介護2）"""
+    if SessionLocal is None:
+        return {"status": "error", "detail": "database unavailable"}
+    try:
+        conds = _answer_filters(answer, engine.dialect.name)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if facility_id:
+        conds.append(Submission.facility_id == facility_id)
+    if individual_id:
+        conds.append(Submission.individual_id == individual_id)
+    with SessionLocal() as db:
+        total = db.scalar(select(func.count()).select_from(Submission).where(*conds))
+        rows = db.scalars(
+            select(Submission).where(*conds).order_by(Submission.id).limit(limit).offset(offset)
+        ).all()
+        items = [
+            {
+                "id": r.id,
+                "facility_id": r.facility_id,
+                "individual_id": r.individual_id,
+                "data": r.data_json,
+                "created_at": r.created_at.isoformat() if r.created_at else None,
+            }
+            for r in rows
+        ]
+    return {"status": "ok", "total": total, "items": items}
+
+
+@app.get("/api/submissions/counts")
+def count_submissions(
+    key: str,
+    facility_id: Optional[str] = None,
+    answer: List[str] = Query(default=[]),
+):
+    """回答キーの値ごとの件数（集計も DB 側で行う）"""
+    if SessionLocal is None:
+        return {"status": "error", "detail": "database unavailable"}
+    try:
+        dialect = engine.dialect.name
+        expr = answer_expr(key, dialect)
+        conds = _answer_filters(answer, dialect)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if facility_id:
+        conds.append(Submission.facility_id == facility_id)
+    with SessionLocal() as db:
+        result = db.execute(
+            select(expr.label("value"), func.count().label("n"))
+            .select_from(Submission).where(*conds).group_by(expr)
+        ).all()
+    return {"status": "ok", "key": key, "counts": {("" if v is None else str(v)): n for v, n in result}}
@@ -1,12 +1,59 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, JSON, Index, text, inspect, literal_column
+from sqlalchemy.dialects.postgresql import JSONB
 from datetime import datetime
+import os
+import re
 from database import Base
 
+# 回答は PostgreSQL では JSONB、それ以外（ローカルの SQLite）では JSON1 で扱える JSON 列に保存する
+AnswerJSON = JSON().with_variant(JSONB(), "postgresql")
+
+# よく絞り込む回答キー（式インデックスを張る）。カンマ区切りで差し替え可能
+INDEXED_ANSWER_KEYS = [
+    k.strip() for k in os.environ.get("APOS_SUBMISSION_INDEXED_KEYS", "form_id,sex,care_status_nursing").split(",")
+    if k.strip()
+]
+
+_ANSWER_KEY_RE = re.compile(r"^[A-Za-z0-9_]+$")
+
 class Submission(Base):
     __tablename__ = "submissions"
 
     id = Column(Integer, primary_key=True, index=True)
     facility_id = Column(String(50), nullable=False)
-    individual_id = Column(String(50), nullable=False)
-    data_json = Column(Text, nullable=False)
+    individual_id = Column(String(50), nullable=False, index=True)
+    data_json = Column(AnswerJSON, nullable=False)
     created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        # 施設単位・施設+個人の検索（施設のみの条件もこの先頭列で引ける）
+        Index("ix_submissions_facility_individual", "facility_id", "individual_id"),
+    )
+
+
+def answer_expr(key: str, dialect: str):
+    """回答キーの値（文字列）を取り出す式。インデックスの式と一致させるためキーは埋め込む"""
+    if not _ANSWER_KEY_RE.match(key):
+        raise ValueError(f"invalid answer key: {key}")
+    if dialect == "postgresql":
+        return literal_column(f"(data_json ->> '{key}')")
+    return literal_column(f"json_extract(data_json, '$.{key}')")
+
+
+def ensure_submission_indexes(engine) -> None:
+    """
+    テーブル作成後に呼ぶ。旧スキーマ（data_json が TEXT）は JSONB へ変換し、
+    回答全体の GIN インデックスと、よく絞り込むキーの式インデックスを作る（SQLite は式インデックスのみ）。
+    """
+    dialect = engine.dialect.name
+    with engine.begin() as conn:
+        if dialect == "postgresql":
+            cols = {c["name"]: c["type"] for c in inspect(conn).get_columns("submissions")}
+            if "data_json" in cols and not isinstance(cols["data_json"], JSONB):
+                conn.execute(text("ALTER TABLE submissions ALTER COLUMN data_json TYPE jsonb USING data_json::jsonb"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_submissions_data_gin ON submissions USING gin (data_json jsonb_path_ops)"
+            ))
+        for key in INDEXED_ANSWER_KEYS:
+            expr = answer_expr(key, dialect).name
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_submissions_answer_{key} ON submissions ({expr})"))
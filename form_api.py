@@ -47,6 +47,35 @@ def one_hot_encode_answers(answers: Dict[str, Any]) -> Dict[str, Any]:
     
     return encoded
 
+# 読み出し用キャッシュ（CSVの全行と user_id 索引。保存時に差し替え、他プロセスの更新はファイルの変化で検知）
+_form_data_cache: Dict[str, Any] = {"sig": None, "rows": [], "by_user": {}}
+
+
+def _csv_signature(csv_file: Path):
+    try:
+        st = csv_file.stat()
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _set_form_data_cache(csv_file: Path, rows: list) -> None:
+    by_user: Dict[str, list] = {}
+    for row in rows:
+        by_user.setdefault(row.get("user_id"), []).append(row)
+    _form_data_cache.update({"sig": _csv_signature(csv_file), "rows": rows, "by_user": by_user})
+
+
+def load_form_data(csv_file: Path) -> Dict[str, Any]:
+    """CSVの内容をキャッシュから返す（ファイルが変わっていれば読み直す）"""
+    sig = _csv_signature(csv_file)
+    if sig != _form_data_cache["sig"]:
+        with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+        _set_form_data_cache(csv_file, rows)
+        _form_data_cache["sig"] = sig
+    return _form_data_cache
+
 def save_form_data_to_csv(facility_id: str, person_id: str, answers: Dict[str, Any]) -> str:
     """フォームデータをCSVファイルに保存"""
     # ユーザーIDを作成
@@ -96,6 +125,9 @@ def save_form_data_to_csv(facility_id: str, person_id: str, answers: Dict[str, A
         writer.writeheader()
         writer.writerows(existing_data)
     
+    # 書き込んだ内容で読み出し用キャッシュを更新（次の取得でCSVを読み直さない）
+    _set_form_data_cache(csv_file, [{k: ("" if row.get(k) is None else str(row.get(k))) for k in fieldnames} for row in existing_data])
+    
     return str(csv_file)
 
 @app.get("/")
@@ -145,13 +177,13 @@ async def get_form_data(user_id: str = None):
         if not csv_file.exists():
             return {"data": [], "message": "データファイルが存在しません"}
         
-        with open(csv_file, 'r', encoding='utf-8-sig', newline='') as f:
-            reader = csv.DictReader(f)
-            data = list(reader)
+        cache = load_form_data(csv_file)
         
-        # 特定のuser_idが指定された場合はフィルタリング
+        # 特定のuser_idが指定された場合は索引から取得
         if user_id:
-            data = [row for row in data if row.get("user_id") == user_id]
+            data = list(cache["by_user"].get(user_id, []))
+        else:
+            data = list(cache["rows"])
         
         return {
             "data": data,
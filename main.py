@@ -3,14 +3,50 @@
 # ============================
 from fastapi import FastAPI, Request, Query, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from starlette.staticfiles import StaticFiles
 from datetime import datetime, timedelta, timezone
 import unicodedata
 import os
+import sys
 import csv
 import re
+import io
+import json
+import heapq
+import gzip
+import zipfile
+import shutil
+import zlib
+import queue
+import hashlib
+import threading
+import time
+import random
+import asyncio
+import contextlib
+import functools
 import base64
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from starlette.concurrency import run_in_threadpool
+try:
+    # ワーカープロセス間のファイルロック（Windows では無し）
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    # 自由記述の全文検索索引（FTS5 が使えない環境では検索を無効にする）
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+try:
+    # ラベル化エクスポートの列単位の計算用（requirements に含む。入っていない環境でも行単位で同じ結果を作る）
+    import numpy as np
+    import pandas as pd
+except ImportError:
+    np = None
+    pd = None
 try:
     # DBユーティリティ（存在しない環境でも起動できるようにtryで囲む）
     from utils.db_utils import init_db, insert_form_data, export_all_records_to_csv
@@ -23,15 +59,55 @@ app = FastAPI(title="APOS-HC Backend")
 
 @app.on_event("startup")
 def _startup_init_db():
-    """アプリ起動時にDBを初期化（ユーティリティが読み込めた場合のみ）。"""
+    """アプリ起動時にDBを初期化（ユーティリティが読み込めた場合 / APOS_DB_URL 指定時）。"""
     try:
         if init_db:
             init_db()
+        if DB_URL:
+            _db_engine()
     except Exception as e:
         try:
             print("⚠ DB init failed:", e)
         except Exception:
             pass
+
+
+@app.on_event("shutdown")
+def _shutdown_flush_records():
+    """停止前に保留中の書き込みを反映し、バックグラウンドの処理を止める。"""
+    try:
+        # 合流待ちの書き込み → ジャーナルのチェックポイント
+        _store_flush()
+        if _journal_enabled():
+            _journal_checkpoint()
+    except Exception as e:
+        print("⚠ pending record flush failed:", e)
+    # エクスポートジョブの取り消し、DB書き込みキュー・アウトボックスの送り出し、生 payload アーカイブを閉じる
+    _export_jobs_stop()
+    _db_flush()
+    _outbox_drain()
+    _archive_close()
+
+
+@app.on_event("startup")
+def _startup_migrate_records():
+    """レコードストアの復旧・移行を行い、バックグラウンドの処理を始める。"""
+    try:
+        _journal_recover()
+        # シャード方式が変わった場合の再配置、旧 records.csv（横持ち）の分割、スキーマ移行
+        _reshard_store()
+        _migrate_legacy_records_csv()
+        _migrate_store_schema()
+        # 前回のプロセスが残したスナップショットの掃除
+        _snapshot_gc()
+        if _journal_enabled():
+            _journal_checkpoint(full=True)
+        _ensure_outbox_thread()
+        threading.Thread(target=_read_model_warm, name="read-model-warm", daemon=True).start()
+        if SEARCH_ENABLED:
+            threading.Thread(target=_search_backfill, name="search-backfill", daemon=True).start()
+    except Exception as e:
+        print("⚠ records partition migration failed:", e)
 # ------------------------------------------------------------
 # 🔹 設定: 保存先パス
 # ------------------------------------------------------------
@@ -79,6 +155,138 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ------------------------------------------------------------
+# 🔹 リクエストキャプチャ（負荷試験の再生用。既定はオフ）
+# ------------------------------------------------------------
+# APOS_CAPTURE=1 のとき、フォーム保存の POST を APOS_CAPTURE_SAMPLE の割合で抜き取り、
+# ヘッダ・パス・本文・応答ステータス・処理時間を JSONL に追記する（replay_capture.py で再生）。
+# 画像の DataURL は極小の画像に差し替え、元のバイト数だけ残す。認証系のヘッダは残さない。
+# ファイルは APOS_CAPTURE_MAX_MB ごとに切り替え、新しい方から APOS_CAPTURE_KEEP 個だけ残す。
+CAPTURE_ENABLED = os.environ.get("APOS_CAPTURE", "0").strip().lower() in ("1", "true", "on")
+CAPTURE_DIR = os.environ.get("APOS_CAPTURE_DIR", "/var/www/app/backend/app/captures")
+CAPTURE_SAMPLE = float(os.environ.get("APOS_CAPTURE_SAMPLE", "1.0"))
+CAPTURE_MAX_BYTES = int(float(os.environ.get("APOS_CAPTURE_MAX_MB", "64")) * 1024 * 1024)
+CAPTURE_KEEP = int(os.environ.get("APOS_CAPTURE_KEEP", "10"))
+CAPTURE_PATH_RE = re.compile(r"^/api/form(\d+|_demo|/batch)?$")
+CAPTURE_DROP_HEADERS = {"authorization", "cookie", "x-access-key", "x-api-key", "content-length", "host"}
+# 1x1 の JPEG（再生時に画像保存の経路を通すための差し替え）
+CAPTURE_IMAGE_STUB = (
+    "data:image/jpeg;base64,/9j/4AAQSkZJRgABAQEASABIAAD/2wBDAAMCAgICAgMCAgIDAwMDBAYEBAQEBAgGBgUGCQgKCgkICQkKDA8MCgsOCwkJDRENDg8QEBEQCgwSExIQEw8QEBD/"
+    "yQALCAABAAEBAREA/8wABgAQEAX/2gAIAQEAAD8A0s8g/9k="
+)
+
+_capture_lock = threading.Lock()
+_capture_fp = None
+_capture_seq = 0
+
+
+def _capture_stub_images(value, sizes: dict, key: str = ""):
+    """本文中の画像 DataURL を差し替える（入れ子の batch も対象）。sizes に元のバイト数を記録"""
+    if isinstance(value, str) and value.startswith("data:image/"):
+        sizes[key] = len(value)
+        return CAPTURE_IMAGE_STUB
+    if isinstance(value, dict):
+        return {k: _capture_stub_images(v, sizes, f"{key}.{k}" if key else str(k)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_capture_stub_images(v, sizes, f"{key}[{i}]") for i, v in enumerate(value)]
+    return value
+
+
+def _capture_open_locked():
+    global _capture_fp, _capture_seq
+    if _capture_fp is not None:
+        _capture_fp.close()
+    os.makedirs(CAPTURE_DIR, exist_ok=True)
+    _capture_seq += 1
+    stamp = datetime.now(timezone(timedelta(hours=9))).strftime("%Y%m%d-%H%M%S")
+    _capture_fp = open(os.path.join(CAPTURE_DIR, f"capture-{stamp}-{os.getpid()}-{_capture_seq}.jsonl"), "a", encoding="utf-8")
+    names = sorted(
+        (f for f in os.listdir(CAPTURE_DIR) if f.startswith("capture-") and f.endswith(".jsonl")),
+        key=lambda f: os.path.getmtime(os.path.join(CAPTURE_DIR, f)),
+    )
+    for f in names[:-CAPTURE_KEEP] if CAPTURE_KEEP > 0 else []:
+        try:
+            os.remove(os.path.join(CAPTURE_DIR, f))
+        except OSError:
+            pass
+
+
+def _capture_write(record: dict) -> None:
+    line = json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n"
+    try:
+        with _capture_lock:
+            if _capture_fp is None or _capture_fp.tell() >= CAPTURE_MAX_BYTES:
+                _capture_open_locked()
+            _capture_fp.write(line)
+            _capture_fp.flush()
+    except Exception as e:
+        print("⚠️ request capture failed:", e)
+
+
+class _CaptureMiddleware:
+    """抜き取った POST の本文を受け渡しながら控え、応答後に1行書き出す（ASGI ミドルウェア）"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            not CAPTURE_ENABLED
+            or scope.get("type") != "http"
+            or scope.get("method") != "POST"
+            or not CAPTURE_PATH_RE.match(scope.get("path", ""))
+            or random.random() >= CAPTURE_SAMPLE
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        chunks: list[bytes] = []
+        status = {"code": 0}
+        started_wall = time.time()
+        started = time.perf_counter()
+
+        async def receive_wrapper():
+            message = await receive()
+            if message.get("type") == "http.request":
+                chunks.append(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            if message.get("type") == "http.response.start":
+                status["code"] = message.get("status", 0)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            latency_ms = (time.perf_counter() - started) * 1000.0
+            try:
+                body = json.loads(b"".join(chunks) or b"null")
+            except ValueError:
+                body = None
+            if body is not None:
+                sizes: dict[str, int] = {}
+                body = _capture_stub_images(body, sizes)
+                headers = {}
+                for k, v in scope.get("headers", []):
+                    name = k.decode("latin-1").lower()
+                    if name not in CAPTURE_DROP_HEADERS:
+                        headers[name] = v.decode("latin-1")
+                _capture_write({
+                    "ts": round(started_wall, 6),
+                    "method": "POST",
+                    "path": scope.get("path", ""),
+                    "query": scope.get("query_string", b"").decode("latin-1"),
+                    "headers": headers,
+                    "body": body,
+                    "images": sizes,
+                    "status": status["code"],
+                    "latency_ms": round(latency_ms, 3),
+                })
+
+
+app.add_middleware(_CaptureMiddleware)
+
 # ------------------------------------------------------------
 # 🔹 デモフォーム保存API
 # ------------------------------------------------------------
@@ -119,7 +327,7 @@ async def save_form_demo(request: Request):
             uid = f"{office_id}_{personal_id}"
             flattened["user_id"] = uid
 
-        row = {"timestamp": timestamp, "form_id": form_id}
+        row = _KeyedRow({"timestamp": timestamp, "form_id": form_id})
         row.update(flattened)
         if uid:
             row["user_id"] = uid
@@ -136,25 +344,18 @@ async def save_form_demo(request: Request):
 
 # 実データを受け取ってる
         if fid == "form0":
-            row = with_imgs(_form0_apply_aliases_and_order(dict(row)))
+            row = with_imgs(_form0_apply_aliases_and_order(row.copy()))
         elif fid == "form1":
-            row = with_imgs(_form1_apply_aliases_and_order(dict(row)))
+            row = with_imgs(_form1_apply_aliases_and_order(row.copy()))
         elif fid == "form19":
-            row = with_imgs(_form19_apply_order(dict(row)))
+            row = with_imgs(_form19_apply_order(row.copy()))
 
         # 不要列は除外（ID列は保持）
         for k in ("session", "form_id"):
             row.pop(k, None)
 
-        # DB保存（任意機能：ユーティリティがある場合のみ）
-        try:
-            if insert_form_data:
-                insert_form_data(fid, row)
-        except Exception as e:
-            try:
-                print("⚠ DB insert (demo) failed:", e)
-            except Exception:
-                pass
+        # DB保存（任意機能：キューに積み、バックグラウンドでまとめて書き込む）
+        _db_enqueue(fid, row)
 
         # Upsert 保存（1ユーザー=1行で上書き）
         _upsert_row(DEMO_CSV_PATH, row, KEY_FIELDS)
@@ -192,6 +393,8 @@ async def save_form(request: Request):
 @app.post("/api/form")
 async def save_form_production(request: Request):
     """フォーム送信をCSV + 画像として保存"""
+    idem_key = None
+    result = None
     try:
         _ensure_dirs()
         payload = await request.json()
@@ -199,6 +402,13 @@ async def save_form_production(request: Request):
         if not isinstance(payload, dict):
             return {"status": "error", "message": "Invalid JSON"}
 
+        # 同じ送信の再送なら、画像保存や書き込みをせず元の応答を返す
+        idem_key = _idempotency_key(request, payload)
+        replay = await _idempotency_begin(idem_key)
+        if replay is not None:
+            idem_key = None
+            return replay
+
         # -----------------------------
         # 基本情報
         # -----------------------------
@@ -206,288 +416,754 @@ async def save_form_production(request: Request):
         now = datetime.now(timezone(timedelta(hours=9)))
         timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        # 画像のデコード（form17〜19などの upload画像）
+        # 生 payload（画像を除く）を控えてから、画像保存 + 行の組み立て
+        raw = _archive_snapshot(payload)
         image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
+        row = _build_production_row(payload, form_id, now, image_files)
+        _archive_raw_payload(request.url.path, form_id, now, raw, image_files)
+
+        # フォーム別パーティションへアップサート（他フォームの列は書き直さない）
+        # シャード単位のロックで待つため、イベントループは塞がずスレッドで実行する
+        durability = await run_in_threadpool(_store_submit, form_id, row, _wants_commit(request))
+        # DB保存（ジャーナル有効時はアウトボックス経由で配送。無効時はキューに積む）
+        if not _outbox_active():
+            _db_enqueue(form_id, row)
+        result = {"status": "ok", "form_id": form_id, "timestamp": timestamp, "durability": durability}
+        return result
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    finally:
+        # 取り消し（CancelledError）でも待っている再送を解放する
+        _idempotency_finish(idem_key, result)
 
-        field_types = payload.pop("field_types", None)
-        flattened = _flatten_payload(payload, field_types)
 
-        # form17 専用の薬剤画像ファイル名を拾う
-        extra_image_files: list[str] = []
-        if form_id == "form17":
-            for i in range(1, 25):
-                key = f"med_image_{i}_filename"
-                val = str(flattened.get(key, "")).strip()
-                if val:
-                    flattened[key] = val
-                    extra_image_files.append(val)
-            for i in range(0, 25):
-                key = f"emotional_distress_{i}_filename"
-                val = str(flattened.get(key, "")).strip()
-                if val:
-                    flattened[key] = val
-                    extra_image_files.append(val)
+# ------------------------------------------------------------
+# 🔹 本番フォーム行の組み立て（/api/form と一括保存で共用）
+# ------------------------------------------------------------
+def _build_production_row(payload: dict, form_id: str, now: datetime, image_files: list[str] | None = None) -> dict:
+    """
+    1フォーム分の payload → パーティションへ保存する行。
+    画像の保存、フラット化、フォーム別の列順固定（_formN_apply_order 系）までを行う。
+    image_files を渡した場合（デコード済み・アーカイブからの再処理）は画像を保存し直さない。
+    """
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
 
-        # -----------------------------
-        # ユーザー識別
-        # -----------------------------
-        uid = (payload.get("user_id") or flattened.get("user_id") or "").strip()
-        office_id = (payload.get("office_id") or flattened.get("office_id") or "").strip()
-        personal_id = (payload.get("personal_id") or flattened.get("personal_id") or "").strip()
+    # 画像のデコード（form17〜19などの upload画像）
+    if image_files is None:
+        image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
 
-        if not uid and office_id and personal_id:
-            uid = f"{office_id}_{personal_id}"
-            flattened["user_id"] = uid
+    field_types = payload.pop("field_types", None)
+    flattened = _flatten_payload(payload, field_types)
 
-        # -----------------------------
-        # row 初期化
-        # -----------------------------
-        row = {"timestamp": timestamp, "form_id": form_id}
-        row.update(flattened)
-        if uid:
-            row["user_id"] = uid
+    # form17 専用の薬剤画像ファイル名を拾う
+    extra_image_files: list[str] = []
+    if form_id == "form17":
+        for i in range(1, 25):
+            key = f"med_image_{i}_filename"
+            val = str(flattened.get(key, "")).strip()
+            if val:
+                flattened[key] = val
+                extra_image_files.append(val)
+        for i in range(0, 25):
+            key = f"emotional_distress_{i}_filename"
+            val = str(flattened.get(key, "")).strip()
+            if val:
+                flattened[key] = val
+                extra_image_files.append(val)
+
+    # -----------------------------
+    # ユーザー識別
+    # -----------------------------
+    uid = (payload.get("user_id") or flattened.get("user_id") or "").strip()
+    office_id = (payload.get("office_id") or flattened.get("office_id") or "").strip()
+    personal_id = (payload.get("personal_id") or flattened.get("personal_id") or "").strip()
+
+    if not uid and office_id and personal_id:
+        uid = f"{office_id}_{personal_id}"
+        flattened["user_id"] = uid
+
+    # -----------------------------
+    # row 初期化
+    # -----------------------------
+    row = _KeyedRow({"timestamp": timestamp, "form_id": form_id})
+    row.update(flattened)
+    if uid:
+        row["user_id"] = uid
+
+    # -----------------------------
+    # 画像共通列（image_file / image_url）
+    # -----------------------------
+    all_image_files: list[str] = []
+    for fname in list(image_files) + extra_image_files:
+        if fname and fname not in all_image_files:
+            all_image_files.append(fname)
+
+    row["image_file"] = ";".join(all_image_files) if all_image_files else ""
+    row["image_url"] = ";".join(f"{BASE_UPLOAD_URL}/{fname}" for fname in all_image_files) if all_image_files else ""
+
+    # -----------------------------
+    # form17 〜 form19 の専用画像列
+    # -----------------------------
+    urls = [f"{BASE_UPLOAD_URL}/{f}" for f in image_files]
+    if form_id == "form17":
+        row["pain_image_front"] = urls[0] if len(urls) > 0 else ""
+        row["pain_image_back"] = urls[1] if len(urls) > 1 else ""
+    elif form_id == "form18":
+        row["paralysis_image_front"] = urls[0] if len(urls) > 0 else ""
+        row["paralysis_image_back"] = urls[1] if len(urls) > 1 else ""
+    elif form_id == "form19":
+        row["contracture_image_front"] = urls[0] if len(urls) > 0 else ""
+        row["contracture_image_back"] = urls[1] if len(urls) > 1 else ""
+
+    # ============================================================
+    # 🔥🔥🔥 form1：ここを完全に差し替え（Canvas → JPEG保存）
+    # ============================================================
+    if form_id == "form1":
+
+        # Base64 のジェノグラム画像保存
+        base64_img = row.get("genogramCanvas_image", "")
+        saved_file = _save_genogram_base64(base64_img, uid)
+
+        # one-hot や alias を適用
+        form1_only = _form1_apply_aliases_and_order(row)
+
+        # 専用列をセット
+        form1_only["genogramCanvas_image"] = saved_file
+        form1_only["genogram_file"] = saved_file
+        form1_only["genogram_url"] = f"{BASE_UPLOAD_URL}/{saved_file}" if saved_file else ""
+
+        row = {
+            "timestamp": form1_only["timestamp"],
+            "form_id": form_id,
+            "user_id": uid,
+            **form1_only
+        }
 
-        # -----------------------------
-        # 画像共通列（image_file / image_url）
-        # -----------------------------
-        all_image_files: list[str] = []
-        for fname in list(image_files) + extra_image_files:
-            if fname and fname not in all_image_files:
-                all_image_files.append(fname)
+    # ------------------------------------------------------------
+    # form0（そのまま）
+    # ------------------------------------------------------------
+    elif form_id == "form0":
+        form0_only = _form0_apply_aliases_and_order(row)
+        if uid:
+            form0_only["user_id"] = uid
+        row = form0_only
+
+    # ------------------------------------------------------------
+    # form2
+    # ------------------------------------------------------------
+    elif form_id == "form2":
+        form2_only = _form2_apply_order(row)
+        row = {
+            "timestamp": form2_only["timestamp"],
+            "form_id": form_id,
+            "user_id": uid,
+            **form2_only
+        }
 
-        row["image_file"] = ";".join(all_image_files) if all_image_files else ""
-        row["image_url"] = ";".join(f"{BASE_UPLOAD_URL}/{fname}" for fname in all_image_files) if all_image_files else ""
+    # ------------------------------------------------------------
+    # form3
+    # ------------------------------------------------------------
+    elif form_id == "form3":
+        form3_only = _form3_apply_order_and_image(row)
+        row = {
+            "timestamp": form3_only["timestamp"],
+            "form_id": form_id,
+            "user_id": uid,
+            **form3_only
+        }
+        form3_only = _form3_apply_order_and_image(row)
+        # デバッグ: form3 の主要 one-hot / 数値列を確認
+        try:
+            debug_f3 = {}
+            for k in list(form3_only.keys()):
+                if (
+                    k.startswith((
+                        "residence_type_", "elevator_", "entrance_to_road_", "expensive_cost_usage_",
+                        "public_medical_usage_", "reform_need_", "reform_place_", "care_tool_need_",
+                        "care_tool_type_", "equipment_need_", "equipment_type_",
+                    ))
+                    or k in ("apartment_floor","room_safety","room_photo_image_filename")
+                ):
+                    debug_f3[k] = form3_only.get(k, "")
+            print("🏠 form3 payload (residence/elevator/entrance/reform/tools/equipment):", debug_f3)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form3_only["timestamp"], "form_id": form_id, "user_id": uid}, **form3_only, **img_cols}
+    elif form_id == "form4":
+        form4_only = _form4_apply_order(row)
+        # デバッグ: form4 の主要 one-hot / 数値列を確認
+        try:
+            debug_f4 = {}
+            for k in list(form4_only.keys()):
+                if (
+                    k.startswith((
+                        "care_burden_feeling_", "care_burden_health_", "care_burden_life_", "care_burden_work_",
+                        "care_intention_", "abuse_injury_", "neglect_hygiene_", "psychological_abuse_",
+                        "neglect_care_", "sexual_abuse_", "financial_abuse_",
+                    ))
+                    or k in ("care_period_years","care_period_months")
+                    or k == "memo"
+                ):
+                    debug_f4[k] = form4_only.get(k, "")
+            print("🛡 form4 payload (burden/intention/abuse etc):", debug_f4)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form4_only["timestamp"], "form_id": form_id, "user_id": uid}, **form4_only, **img_cols}
+    elif form_id == "form5":
+        form5_only = _form5_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form5_only["timestamp"], "form_id": form_id, "user_id": uid}, **form5_only, **img_cols}
+    elif form_id == "form6":
+        form6_only = _form6_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form6_only["timestamp"], "form_id": form_id, "user_id": uid}, **form6_only, **img_cols}
+    elif form_id == "form7":
+        form7_only = _form7_apply_order(row)
+        # デバッグ: oral_tongue の値を確認
+        try:
+            dbg = {k: form7_only.get(k, "") for k in ("oral_tongue_0","oral_tongue_1","oral_tongue_2","oral_tongue_surface_0","oral_tongue_surface_1","oral_tongue_surface_2")}
+            print("🦷 form7 oral_tongue mapping:", dbg)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form7_only["timestamp"], "form_id": form_id, "user_id": uid}, **form7_only, **img_cols}
+    elif form_id == "form8":
+        form8_only = _form8_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form8_only["timestamp"], "form_id": form_id, "user_id": uid}, **form8_only, **img_cols}
+    elif form_id == "form9":
+        form9_only = _form9_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form9_only["timestamp"], "form_id": form_id, "user_id": uid}, **form9_only, **img_cols}
+    elif form_id == "form10":
+        form10_only = _form10_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        # form10 は URL 列は不要
+        img_cols.pop("image_url", None)
+        row = {**{"timestamp": form10_only["timestamp"], "form_id": form_id, "user_id": uid}, **form10_only, **img_cols}
+    elif form_id == "form11":
+        form11_only = _form11_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form11_only["timestamp"], "form_id": form_id, "user_id": uid}, **form11_only, **img_cols}
+    elif form_id == "form12":
+        form12_only = _form12_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form12_only["timestamp"], "form_id": form_id, "user_id": uid}, **form12_only, **img_cols}
+    elif form_id == "form13":
+        form13_only = _form13_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form13_only["timestamp"], "form_id": form_id, "user_id": uid}, **form13_only, **img_cols}
+    elif form_id == "form14":
+        form14_only = _form14_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form14_only["timestamp"], "form_id": form_id, "user_id": uid}, **form14_only, **img_cols}
+    elif form_id == "form15":
+        form15_only = _form15_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form15_only["timestamp"], "form_id": form_id, "user_id": uid}, **form15_only, **img_cols}
+    elif form_id == "form16":
+        form16_only = _form16_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form16_only["timestamp"], "form_id": form_id, "user_id": uid}, **form16_only, **img_cols}
+    elif form_id == "form17":
+        form17_only = _form17_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form17_only["timestamp"], "form_id": form_id, "user_id": row.get("user_id", "")}, **form17_only, **img_cols}
+    elif form_id == "form18":
+        form18_only = _form18_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form18_only["timestamp"], "form_id": form_id, "user_id": row.get("user_id", "")}, **form18_only, **img_cols}
+    elif form_id == "form19":
+        form19_only = _form19_apply_order(row)
+        # デバッグ: form19 の主要列を確認
+        try:
+            keys = [
+                "fall_0","fall_1","fall_count","fall_detail",
+                "fall_anxiety_0","fall_anxiety_1","fall_anxiety_2",
+                "anxiety_reason_aging_muscle","anxiety_reason_disease","anxiety_reason_medicine",
+                "anxiety_reason_internal_other","internal_other_text","anxiety_reason_environment_external",
+                "fracture_0","fracture_1","fracture_cause_fall","fracture_cause_other",
+                "fracture_count","fracture_location","height_decrease_check","height_decrease",
+                "back_curved","back_pain",
+                "choking_risk_0","choking_risk_1",
+                "abuse_evaluation_0","abuse_evaluation_1","abuse_detail_a","abuse_detail_b","abuse_detail_c",
+                "kodokushi_feeling_0","kodokushi_feeling_1","kodokushi_feeling_2","kodokushi_feeling_3",
+                "fire_water_negligence_0","fire_water_negligence_1","fire_water_detail_a","fire_water_detail_b","fire_water_detail_c",
+                "news_eval_0","news_eval_1",
+                "dehydration_0","dehydration_1",
+                "abnormal_behavior_0","abnormal_behavior_1","abnormal_behavior_2","abnormal_behavior_3",
+            ]
+            dbg = {k: form19_only.get(k, "") for k in keys}
+            print("🧩 form19 payload (mapped):", dbg)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form19_only["timestamp"], "form_id": form_id, "user_id": row.get("user_id", "")}, **form19_only, **img_cols}
+    # 不要列をCSVから除外（ID列は保持）
+    for k in ("session", "form_id"):
+        row.pop(k, None)
+    _set_visit_session(row, payload, flattened)
+    return row
 
-        # -----------------------------
-        # form17 〜 form19 の専用画像列
-        # -----------------------------
-        urls = [f"{BASE_UPLOAD_URL}/{f}" for f in image_files]
-        if form_id == "form17":
-            row["pain_image_front"] = urls[0] if len(urls) > 0 else ""
-            row["pain_image_back"] = urls[1] if len(urls) > 1 else ""
-        elif form_id == "form18":
-            row["paralysis_image_front"] = urls[0] if len(urls) > 0 else ""
-            row["paralysis_image_back"] = urls[1] if len(urls) > 1 else ""
-        elif form_id == "form19":
-            row["contracture_image_front"] = urls[0] if len(urls) > 0 else ""
-            row["contracture_image_back"] = urls[1] if len(urls) > 1 else ""
-
-        # ============================================================
-        # 🔥🔥🔥 form1：ここを完全に差し替え（Canvas → JPEG保存）
-        # ============================================================
-        if form_id == "form1":
-
-            # Base64 のジェノグラム画像保存
-            base64_img = row.get("genogramCanvas_image", "")
-            saved_file = _save_genogram_base64(base64_img, uid)
-
-            # one-hot や alias を適用
-            form1_only = _form1_apply_aliases_and_order(row)
-
-            # 専用列をセット
-            form1_only["genogramCanvas_image"] = saved_file
-            form1_only["genogram_file"] = saved_file
-            form1_only["genogram_url"] = f"{BASE_UPLOAD_URL}/{saved_file}" if saved_file else ""
-
-            row = {
-                "timestamp": form1_only["timestamp"],
-                "form_id": form_id,
-                "user_id": uid,
-                **form1_only
-            }
 
-        # ------------------------------------------------------------
-        # form0（そのまま）
-        # ------------------------------------------------------------
-        elif form_id == "form0":
-            form0_only = _form0_apply_aliases_and_order(row)
-            if uid:
-                form0_only["user_id"] = uid
-            row = form0_only
-
-        # ------------------------------------------------------------
-        # form2
-        # ------------------------------------------------------------
-        elif form_id == "form2":
-            form2_only = _form2_apply_order(row)
-            row = {
-                "timestamp": form2_only["timestamp"],
-                "form_id": form_id,
-                "user_id": uid,
-                **form2_only
-            }
+# ------------------------------------------------------------
+# 🔹 一括保存API（同一ユーザーの複数フォームを1リクエストで保存）
+# ------------------------------------------------------------
+@app.post("/api/form/batch")
+async def save_form_batch(request: Request):
+    """
+    複数フォームの payload を受け取り、各フォームの変換を通してからまとめて1回で保存する。
+    body: {"user_id" or "office_id"+"personal_id", "forms": [{"form_id": "form0", ...}, ...]}
+          （"forms" は {"form0": {...}, "form1": {...}} の形でも可。ID 類は各フォームへ引き継ぐ）
+    """
+    idem_key = None
+    idem_result = None
+    try:
+        _ensure_dirs()
+        body = await request.json()
+        if not isinstance(body, dict):
+            return {"status": "error", "message": "Invalid JSON"}
+        forms = body.get("forms")
+        if isinstance(forms, dict):
+            forms = [dict(p, form_id=p.get("form_id") or fid) for fid, p in forms.items() if isinstance(p, dict)]
+        if not isinstance(forms, list) or not forms:
+            return {"status": "error", "message": "forms is required"}
+
+        idem_key = _idempotency_key(request, body)
+        replay = await _idempotency_begin(idem_key)
+        if replay is not None:
+            idem_key = None
+            return replay
 
-        # ------------------------------------------------------------
-        # form3
-        # ------------------------------------------------------------
-         elif form_id == "form3":
-            form3_only = _form3_apply_order_and_image(row)
-            row = {
-                "timestamp": form3_only["timestamp"],
-                "form_id": form_id,
-                "user_id": uid,
-                **form3_only
-            }
-            form3_only = _form3_apply_order_and_image(row)
-            # デバッグ: form3 の主要 one-hot / 数値列を確認
-            try:
-                debug_f3 = {}
-                for k in list(form3_only.keys()):
-                    if (
-                        k.startswith("residence_type_")
-                        or k.startswith("elevator_")
-                        or k.startswith("entrance_to_road_")
-                        or k.startswith("expensive_cost_usage_")
-                        or k.startswith("public_medical_usage_")
-                        or k.startswith("reform_need_")
-                        or k.startswith("reform_place_")
-                        or k.startswith("care_tool_need_")
-                        or k.startswith("care_tool_type_")
-                        or k.startswith("equipment_need_")
-                        or k.startswith("equipment_type_")
-                        or k in ("apartment_floor","room_safety","room_photo_image_filename")
-                    ):
-                        debug_f3[k] = form3_only.get(k, "")
-                print("🏠 form3 payload (residence/elevator/entrance/reform/tools/equipment):", debug_f3)
-            except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form3_only["timestamp"], "form_id": form_id, "user_id": uid}, **form3_only, **img_cols}
-        elif form_id == "form4":
-            form4_only = _form4_apply_order(row)
-            # デバッグ: form4 の主要 one-hot / 数値列を確認
-            try:
-                debug_f4 = {}
-                for k in list(form4_only.keys()):
-                    if (
-                        k.startswith("care_burden_feeling_")
-                        or k.startswith("care_burden_health_")
-                        or k.startswith("care_burden_life_")
-                        or k.startswith("care_burden_work_")
-                        or k in ("care_period_years","care_period_months")
-                        or k.startswith("care_intention_")
-                        or k.startswith("abuse_injury_")
-                        or k.startswith("neglect_hygiene_")
-                        or k.startswith("psychological_abuse_")
-                        or k.startswith("neglect_care_")
-                        or k.startswith("sexual_abuse_")
-                        or k.startswith("financial_abuse_")
-                        or k == "memo"
-                    ):
-                        debug_f4[k] = form4_only.get(k, "")
-                print("🛡 form4 payload (burden/intention/abuse etc):", debug_f4)
-            except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form4_only["timestamp"], "form_id": form_id, "user_id": uid}, **form4_only, **img_cols}
-        elif form_id == "form5":
-            form5_only = _form5_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form5_only["timestamp"], "form_id": form_id, "user_id": uid}, **form5_only, **img_cols}
-        elif form_id == "form6":
-            form6_only = _form6_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form6_only["timestamp"], "form_id": form_id, "user_id": uid}, **form6_only, **img_cols}
-        elif form_id == "form7":
-            form7_only = _form7_apply_order(row)
-            # デバッグ: oral_tongue の値を確認
-            try:
-                dbg = {k: form7_only.get(k, "") for k in ("oral_tongue_0","oral_tongue_1","oral_tongue_2","oral_tongue_surface_0","oral_tongue_surface_1","oral_tongue_surface_2")}
-                print("🦷 form7 oral_tongue mapping:", dbg)
-            except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form7_only["timestamp"], "form_id": form_id, "user_id": uid}, **form7_only, **img_cols}
-        elif form_id == "form8":
-            form8_only = _form8_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form8_only["timestamp"], "form_id": form_id, "user_id": uid}, **form8_only, **img_cols}
-        elif form_id == "form9":
-            form9_only = _form9_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form9_only["timestamp"], "form_id": form_id, "user_id": uid}, **form9_only, **img_cols}
-        elif form_id == "form10":
-            form10_only = _form10_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            # form10 は URL 列は不要
-            img_cols.pop("image_url", None)
-            row = {**{"timestamp": form10_only["timestamp"], "form_id": form_id, "user_id": uid}, **form10_only, **img_cols}
-        elif form_id == "form11":
-            form11_only = _form11_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form11_only["timestamp"], "form_id": form_id, "user_id": uid}, **form11_only, **img_cols}
-        elif form_id == "form12":
-            form12_only = _form12_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form12_only["timestamp"], "form_id": form_id, "user_id": uid}, **form12_only, **img_cols}
-        elif form_id == "form13":
-            form13_only = _form13_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form13_only["timestamp"], "form_id": form_id, "user_id": uid}, **form13_only, **img_cols}
-        elif form_id == "form14":
-            form14_only = _form14_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form14_only["timestamp"], "form_id": form_id, "user_id": uid}, **form14_only, **img_cols}
-        elif form_id == "form15":
-            form15_only = _form15_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form15_only["timestamp"], "form_id": form_id, "user_id": uid}, **form15_only, **img_cols}
-        elif form_id == "form16":
-            form16_only = _form16_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form16_only["timestamp"], "form_id": form_id, "user_id": uid}, **form16_only, **img_cols}
-        elif form_id == "form17":
-            form17_only = _form17_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form17_only["timestamp"], "form_id": form_id, "user_id": row.get("user_id", "")}, **form17_only, **img_cols}
-        elif form_id == "form18":
-            form18_only = _form18_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form18_only["timestamp"], "form_id": form_id, "user_id": row.get("user_id", "")}, **form18_only, **img_cols}
-        elif form_id == "form19":
-            form19_only = _form19_apply_order(row)
-            # デバッグ: form19 の主要列を確認
+        now = datetime.now(timezone(timedelta(hours=9)))
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+        ids = {k: body[k] for k in ("user_id", "office_id", "personal_id", "person_id") if body.get(k)}
+
+        results: list[dict] = []
+        built: list[tuple[str, dict]] = []
+        for payload in forms:
+            form_id = payload.get("form_id") if isinstance(payload, dict) else None
+            if not form_id:
+                results.append({"form_id": form_id, "status": "error", "message": "form_id is required"})
+                continue
             try:
-                keys = [
-                    "fall_0","fall_1","fall_count","fall_detail",
-                    "fall_anxiety_0","fall_anxiety_1","fall_anxiety_2",
-                    "anxiety_reason_aging_muscle","anxiety_reason_disease","anxiety_reason_medicine",
-                    "anxiety_reason_internal_other","internal_other_text","anxiety_reason_environment_external",
-                    "fracture_0","fracture_1","fracture_cause_fall","fracture_cause_other",
-                    "fracture_count","fracture_location","height_decrease_check","height_decrease",
-                    "back_curved","back_pain",
-                    "choking_risk_0","choking_risk_1",
-                    "abuse_evaluation_0","abuse_evaluation_1","abuse_detail_a","abuse_detail_b","abuse_detail_c",
-                    "kodokushi_feeling_0","kodokushi_feeling_1","kodokushi_feeling_2","kodokushi_feeling_3",
-                    "fire_water_negligence_0","fire_water_negligence_1","fire_water_detail_a","fire_water_detail_b","fire_water_detail_c",
-                    "news_eval_0","news_eval_1",
-                    "dehydration_0","dehydration_1",
-                    "abnormal_behavior_0","abnormal_behavior_1","abnormal_behavior_2","abnormal_behavior_3",
-                ]
-                dbg = {k: form19_only.get(k, "") for k in keys}
-                print("🧩 form19 payload (mapped):", dbg)
-            except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form19_only["timestamp"], "form_id": form_id, "user_id": row.get("user_id", "")}, **form19_only, **img_cols}
-        # 不要列をCSVから除外（ID列は保持）
-        for k in ("session", "form_id"):
-            row.pop(k, None)
+                payload = {**ids, **payload}
+                raw = _archive_snapshot(payload)
+                image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
+                row = _build_production_row(payload, form_id, now, image_files)
+                if not str(row.get("user_id", "") or "").strip():
+                    raise ValueError("user_id is required")
+                _archive_raw_payload("/api/form", form_id, now, raw, image_files)
+                built.append((form_id, row))
+                results.append({"form_id": form_id, "status": "ok"})
+            except Exception as e:
+                results.append({"form_id": form_id, "status": "error", "message": str(e)})
+
+        durability = "skipped"
+        if built:
+            durability = await run_in_threadpool(_store_submit_many, built, _wants_commit(request))
+            # DB保存（ジャーナル有効時はアウトボックス経由で配送。無効時はキューに積む）
+            if not _outbox_active():
+                for form_id, row in built:
+                    _db_enqueue(form_id, row)
+
+        failed = sum(1 for r in results if r["status"] != "ok")
+        result = {
+            "status": "ok" if not failed else ("partial" if built else "error"),
+            "timestamp": timestamp,
+            "durability": durability,
+            "forms": results,
+        }
+        idem_result = result if not failed else None
+        return result
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    finally:
+        # 取り消し（CancelledError）でも待っている再送を解放する
+        _idempotency_finish(idem_key, idem_result)
 
-        _upsert_row(RECORDS_CSV_PATH, row, KEY_FIELDS)
-        # DB保存（ユーティリティがある場合のみ）
+
+# ------------------------------------------------------------
+# 🔹 一括インポート（紙・オフラインで集めた回答の後追い取り込み）
+# ------------------------------------------------------------
+# 1件ずつ /api/form に流すとパーティションを行数ぶん書き換えるため、変換（_flatten_payload と
+# フォーム別の列順固定）はプロセスプールで並列に行い、ストアへは最後に1パスでまとめて反映する。
+# 入力は生 payload の JSONL（1行1送信）か CSV（1行1送信、列名 = payload のキー）。
+IMPORT_WORKERS = int(os.environ.get("APOS_IMPORT_WORKERS", "0")) or (os.cpu_count() or 1)
+IMPORT_CHUNK_ROWS = 200
+# 応答に載せるエラー行の上限
+IMPORT_MAX_ERRORS = 1000
+
+
+def _parse_import_timestamp(value) -> datetime | None:
+    """payload の timestamp（"YYYY-MM-DD HH:MM:SS" / ISO 8601）→ JST の datetime"""
+    sval = str(value or "").strip()
+    if not sval:
+        return None
+    jst = timezone(timedelta(hours=9))
+    try:
+        dt = datetime.strptime(sval, "%Y-%m-%d %H:%M:%S")
+    except ValueError:
         try:
-            if insert_form_data:
-                insert_form_data(form_id, row)
-        except Exception as e:
+            dt = datetime.fromisoformat(sval.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+    return dt.replace(tzinfo=jst) if dt.tzinfo is None else dt.astimezone(jst)
+
+
+def _import_transform(payload: dict, default_form_id: str | None = None) -> tuple[str, dict, list[str]]:
+    """1送信分の payload → (form_id, 保存行, 保存した画像)。送信時刻があればそれを timestamp に使う"""
+    form_id = str(payload.get("form_id") or default_form_id or "").strip()
+    if not form_id:
+        raise ValueError("form_id is required")
+    now = _parse_import_timestamp(payload.get("timestamp")) or datetime.now(timezone(timedelta(hours=9)))
+    payload = dict(payload)
+    payload.pop("timestamp", None)
+    image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
+    row = _build_production_row(payload, form_id, now, image_files)
+    if not str(row.get("user_id", "") or "").strip():
+        raise ValueError("user_id (or office_id + personal_id) is required")
+    return form_id, row, image_files
+
+
+def _import_transform_chunk(chunk: list[tuple[int, dict]], default_form_id: str | None = None) -> list[tuple]:
+    """ワーカープロセスで実行: [(行番号, payload)] → [(行番号, form_id, 行, 画像, エラー)]"""
+    out = []
+    # 変換関数のデバッグ出力はワーカーでは捨てる
+    with contextlib.redirect_stdout(io.StringIO()):
+        for line_no, payload in chunk:
             try:
-                print("⚠ DB insert failed:", e)
-            except Exception:
-                pass
-        return {"status": "ok", "form_id": form_id, "timestamp": timestamp}
+                form_id, row, image_files = _import_transform(payload, default_form_id)
+                out.append((line_no, form_id, row, image_files, None))
+            except Exception as e:
+                out.append((line_no, None, None, None, str(e)))
+    return out
+
+
+def _iter_import_payloads(lines, fmt: str):
+    """入力行 → (行番号, payload または例外メッセージ)"""
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for line_no, r in enumerate(reader, start=2):
+            yield line_no, {k: v for k, v in r.items() if k is not None}
+        return
+    for line_no, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            payload = json.loads(line)
+        except ValueError as e:
+            yield line_no, f"invalid JSON: {e}"
+            continue
+        yield line_no, payload if isinstance(payload, dict) else "payload must be a JSON object"
+
+
+def _run_import_chunks(chunks, default_form_id: str | None, workers: int):
+    """変換をプロセスプールで並列実行（小さい入力やワーカー1ならこのプロセスで実行）"""
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            yield from _import_transform_chunk(chunk, default_form_id)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as pool:
+        for result in pool.map(_import_transform_chunk, chunks, [default_form_id] * len(chunks)):
+            yield from result
+
+
+def _bulk_import(lines, fmt: str = "jsonl", default_form_id: str | None = None, workers: int | None = None) -> dict:
+    """
+    JSONL / CSV の送信データをまとめて取り込む（HTTP・CLI 共通）。
+    同じユーザー・フォームが複数回あれば timestamp の新しい方が残る（choose_value と同じ後勝ち）。
+    保存済みの行より古い送信はパーティションには反映しない（skipped_older。DB・アーカイブには残す）。
+    """
+    started = time.monotonic()
+    fmt = "csv" if str(fmt).lower() == "csv" else "jsonl"
+    errors: list[dict] = []
+    total = 0
+    chunks: list[list[tuple[int, dict]]] = [[]]
+    for line_no, payload in _iter_import_payloads(lines, fmt):
+        total += 1
+        if not isinstance(payload, dict):
+            errors.append({"line": line_no, "error": payload})
+            continue
+        if len(chunks[-1]) >= IMPORT_CHUNK_ROWS:
+            chunks.append([])
+        chunks[-1].append((line_no, payload))
+    chunks = [c for c in chunks if c]
+    parsed_at = time.monotonic()
+
+    payloads = {line_no: payload for chunk in chunks for line_no, payload in chunk}
+    transformed: list[tuple] = []
+    for line_no, form_id, row, image_files, error in _run_import_chunks(chunks, default_form_id, workers or IMPORT_WORKERS):
+        if error is not None:
+            errors.append({"line": line_no, "error": error})
+            continue
+        transformed.append((str(row.get("timestamp", "")), line_no, form_id, row))
+        # 取り込んだ送信も生 payload アーカイブに残す（再処理で作り直せるように）
+        raw = _archive_snapshot(payloads[line_no])
+        raw.pop("timestamp", None)
+        _archive_raw_payload("/api/import", form_id, _parse_import_timestamp(row.get("timestamp")), raw, image_files)
+    transformed_at = time.monotonic()
+
+    # 1パスで反映（パーティションごとに書き換えは1回）
+    rows_by_partition: dict[str, list[dict]] = {}
+    for _ts, _line_no, form_id, row in sorted(transformed, key=lambda t: (t[0], t[1])):
+        rows_by_partition.setdefault(_partition_name(form_id), []).append(row)
+    imported = 0
+    if rows_by_partition:
+        _store_flush()
+        imported = _store_bulk_upsert(rows_by_partition, newer_only=True)
+        if _journal_enabled():
+            # ジャーナルを通していないので、反映したパーティションをここで確定させる
+            _journal_checkpoint()
+        db_items = [(form_id, row) for _ts, _line_no, form_id, row in transformed]
+        if _outbox_active():
+            _outbox_append_records(db_items)
+        else:
+            _db_insert_many(db_items)
+    finished = time.monotonic()
+
+    elapsed = finished - started
+    errors.sort(key=lambda e: e["line"])
+    return {
+        "status": "ok" if not errors else ("partial" if imported else "error"),
+        "rows": total,
+        "imported": imported,
+        "skipped_older": len(transformed) - imported,
+        "failed": len(errors),
+        "partitions": len(rows_by_partition),
+        "workers": min(workers or IMPORT_WORKERS, max(1, len(chunks))),
+        "elapsed_sec": round(elapsed, 3),
+        "rows_per_sec": round(total / elapsed, 1) if elapsed > 0 else None,
+        "phases_sec": {
+            "parse": round(parsed_at - started, 3),
+            "transform": round(transformed_at - parsed_at, 3),
+            "store": round(finished - transformed_at, 3),
+        },
+        "errors": errors[:IMPORT_MAX_ERRORS],
+    }
+
+
+@app.post("/api/import")
+async def import_submissions(file: UploadFile = File(...), format: str | None = None, form_id: str | None = None):
+    """
+    送信データの一括インポート（JSONL または CSV をアップロード）。
+    format 未指定時はファイル名の拡張子で判定。CSV に form_id 列が無い場合は form_id クエリを使う。
+    """
+    try:
+        _ensure_dirs()
+        raw = await file.read()
+        fmt = format or ("csv" if (file.filename or "").lower().endswith(".csv") else "jsonl")
+        text = raw.decode("utf-8-sig")
+        return await run_in_threadpool(_bulk_import, io.StringIO(text), fmt, form_id)
     except Exception as e:
         return {"status": "error", "detail": str(e)}
 
+
+# ------------------------------------------------------------
+# 🔹 生 payload アーカイブ（画像を除いた受信内容を日付別の gz JSONL に追記）
+# ------------------------------------------------------------
+# 変換（_flatten_payload / _formN_apply_order）の不具合を直しても、保存済みの行は変換後の値しか
+# 残っていないため直せなかった。受信した payload を画像データ抜きで残しておき、
+# 直した変換で並列に再処理してストアを作り直せるようにする。
+# ファイルはワーカープロセスの起動ごと（raw-YYYYMMDD-<pid>-<起動時刻>.jsonl.gz）。書きかけの末尾は読み出し時に捨てる。
+# 起動時刻を付けるのは、異常終了したファイルに同じ pid の別プロセスが追記し、途中で読めなくなるのを防ぐため。
+RAW_ARCHIVE_DIR = os.environ.get("APOS_RAW_ARCHIVE_DIR", "/var/www/app/backend/app/raw_archive")
+RAW_ARCHIVE_ENABLED = os.environ.get("APOS_RAW_ARCHIVE", "1").strip().lower() not in ("0", "false", "off")
+
+_archive_lock = threading.Lock()
+_archive_fp = None
+_archive_day: str | None = None
+_archive_token = f"{time.time_ns():x}"
+
+
+def _archive_snapshot(payload: dict) -> dict:
+    """アーカイブ用の控え（画像の DataURL は除き、以降の変換で書き換わらないよう複製する）"""
+    if not RAW_ARCHIVE_ENABLED:
+        return {}
+    stripped = {k: v for k, v in payload.items() if not (isinstance(v, str) and v.startswith("data:"))}
+    return json.loads(json.dumps(stripped, ensure_ascii=False, default=str))
+
+
+def _archive_raw_payload(path: str, form_id: str, submitted_at: datetime | None, payload: dict, image_files=None) -> None:
+    """1送信分を追記する（失敗しても保存処理は止めない）"""
+    global _archive_fp, _archive_day
+    if not RAW_ARCHIVE_ENABLED:
+        return
+    received = datetime.now(timezone(timedelta(hours=9)))
+    record = {
+        "received_at": received.strftime("%Y-%m-%d %H:%M:%S"),
+        "timestamp": (submitted_at or received).strftime("%Y-%m-%d %H:%M:%S"),
+        "path": path,
+        "form_id": form_id,
+        "images": list(image_files or []),
+        "payload": payload,
+    }
+    line = (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+    day = received.strftime("%Y%m%d")
+    try:
+        with _archive_lock:
+            if _archive_fp is None or _archive_day != day:
+                if _archive_fp is not None:
+                    _archive_fp.close()
+                os.makedirs(RAW_ARCHIVE_DIR, exist_ok=True)
+                _archive_fp = gzip.open(os.path.join(RAW_ARCHIVE_DIR, f"raw-{day}-{os.getpid()}-{_archive_token}.jsonl.gz"), "ab")
+                _archive_day = day
+            _archive_fp.write(line)
+            # 行単位で読み出せるところまで圧縮ストリームを吐き出す（プロセスが落ちても前の行は残る）
+            _archive_fp.flush()
+    except Exception as e:
+        print("⚠️ raw payload archive failed:", e)
+
+
+def _archive_close() -> None:
+    global _archive_fp, _archive_day
+    with _archive_lock:
+        if _archive_fp is not None:
+            _archive_fp.close()
+        _archive_fp = None
+        _archive_day = None
+
+
+def _iter_archive_records(since: str | None = None, until: str | None = None):
+    """アーカイブを日付順に読み出す（since / until は YYYY-MM-DD、受信日で絞り込み）"""
+    lo = (since or "").replace("-", "")
+    hi = (until or "").replace("-", "")
+    try:
+        names = sorted(f for f in os.listdir(RAW_ARCHIVE_DIR) if re.fullmatch(r"raw-\d{8}-\d+(-[0-9a-f]+)?\.jsonl\.gz", f))
+    except FileNotFoundError:
+        return
+    for name in names:
+        day = name[4:12]
+        if (lo and day < lo) or (hi and day > hi):
+            continue
+        try:
+            with gzip.open(os.path.join(RAW_ARCHIVE_DIR, name), "rt", encoding="utf-8") as rf:
+                for line in rf:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(rec, dict) and isinstance(rec.get("payload"), dict):
+                        yield rec
+        except (EOFError, OSError, zlib.error) as e:
+            # 書き込み中・異常終了したファイルの末尾
+            print(f"⚠️ archive {name}: truncated tail ignored ({e})")
+
+
+def _reprocess_transform(rec: dict) -> tuple[str, dict]:
+    """アーカイブ1件 → (form_id, 保存行)。受信時と同じ組み立て（/api/form{n} かそれ以外）を使う"""
+    form_id = str(rec.get("form_id") or "").strip()
+    now = _parse_import_timestamp(rec.get("timestamp")) or datetime.now(timezone(timedelta(hours=9)))
+    payload = dict(rec["payload"])
+    builder = _build_section_row if re.fullmatch(r"/api/form\d+", str(rec.get("path", ""))) else _build_production_row
+    row = builder(payload, form_id, now, list(rec.get("images") or []))
+    if not str(row.get("user_id", "") or "").strip():
+        raise ValueError("user_id is required")
+    return form_id, row
+
+
+def _reprocess_chunk(chunk: list[tuple[int, dict]]) -> list[tuple]:
+    """ワーカープロセスで実行: [(通し番号, アーカイブ1件)] → [(通し番号, form_id, 行, エラー)]"""
+    out = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for seq, rec in chunk:
+            try:
+                form_id, row = _reprocess_transform(rec)
+                out.append((seq, form_id, row, None))
+            except Exception as e:
+                out.append((seq, None, None, str(e)))
+    return out
+
+
+def _reprocess_archive(since: str | None = None, until: str | None = None,
+                       workers: int | None = None, dry_run: bool = False) -> dict:
+    """
+    アーカイブを現在の変換で再処理し、ストアの該当行を作り直す。
+    同じユーザー・フォームは送信順に重ねた結果で行を丸ごと置き換える（直した変換で不要になった列は空欄）。
+    再処理中に届いた新しい保存（ストアの timestamp の方が新しい行）は上書きしない。
+    """
+    started = time.monotonic()
+    workers = workers or IMPORT_WORKERS
+    chunks: list[list[tuple[int, dict]]] = [[]]
+    total = 0
+    for rec in _iter_archive_records(since, until):
+        if len(chunks[-1]) >= IMPORT_CHUNK_ROWS:
+            chunks.append([])
+        chunks[-1].append((total, rec))
+        total += 1
+    chunks = [c for c in chunks if c]
+    read_at = time.monotonic()
+
+    errors: list[dict] = []
+    transformed: list[tuple] = []
+    if workers <= 1 or len(chunks) <= 1:
+        results = (r for chunk in chunks for r in _reprocess_chunk(chunk))
+        pool = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=min(workers, len(chunks)))
+        results = (r for rs in pool.map(_reprocess_chunk, chunks) for r in rs)
+    try:
+        for seq, form_id, row, error in results:
+            if error is not None:
+                errors.append({"record": seq, "error": error})
+            else:
+                transformed.append((str(row.get("timestamp", "")), seq, form_id, row))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    transformed_at = time.monotonic()
+
+    # (シャード, パーティション) → user_id → 送信順に重ねた行
+    merged: dict[tuple[str, str], dict[str, dict]] = {}
+    for _ts, _seq, form_id, row in sorted(transformed, key=lambda t: (t[0], t[1])):
+        uid = str(row.get("user_id", "")).strip()
+        users = merged.setdefault((_shard_of_user(uid), _partition_name(form_id)), {})
+        users.setdefault(uid, {}).update(row)
+
+    rebuilt = skipped = 0
+    if not dry_run and merged:
+        _store_flush()
+        for (shard, name), users in sorted(merged.items()):
+            with _shard_lock(shard):
+                current = {uid: str(r.get("timestamp", "")) for uid, r in _iter_partition_rows(shard, name)}
+                rows = [r for uid, r in users.items() if str(r.get("timestamp", "")) >= current.get(uid, "")]
+                skipped += len(users) - len(rows)
+                if rows:
+                    rebuilt += _upsert_rows(
+                        _partition_path(shard, name), rows, KEY_FIELDS,
+                        master_header=_partition_master_header(name), sort_key="user_id", replace=True,
+                    )
+                    _journal_mark_dirty(shard, name)
+        if _journal_enabled():
+            _journal_checkpoint()
+    finished = time.monotonic()
+
+    elapsed = finished - started
+    return {
+        "status": "ok" if not errors else "partial",
+        "records": total,
+        "rows": sum(len(u) for u in merged.values()),
+        "rebuilt": rebuilt,
+        "skipped_newer": skipped,
+        "failed": len(errors),
+        "dry_run": dry_run,
+        "workers": min(workers, max(1, len(chunks))),
+        "elapsed_sec": round(elapsed, 3),
+        "records_per_sec": round(total / elapsed, 1) if elapsed > 0 else None,
+        "phases_sec": {
+            "read": round(read_at - started, 3),
+            "transform": round(transformed_at - read_at, 3),
+            "store": round(finished - transformed_at, 3),
+        },
+        "errors": errors[:IMPORT_MAX_ERRORS],
+    }
+
+
 # ------------------------------------------------------------
 # 🔹 ディレクトリ存在確認（本番・デモ用）
 # ------------------------------------------------------------
@@ -495,6 +1171,7 @@ def _ensure_dirs():
     """保存先ディレクトリを確実に作成"""
     os.makedirs(os.path.dirname(RECORDS_CSV_PATH), exist_ok=True)
     os.makedirs(os.path.dirname(DEMO_CSV_PATH), exist_ok=True)
+    os.makedirs(RECORDS_PARTITION_DIR, exist_ok=True)
     os.makedirs(UPLOADS_DIR, exist_ok=True)
 
 
@@ -502,21 +1179,21 @@ def _ensure_dirs():
 # 🔹 CSVエクスポートAPI（本番・デモ）
 # ------------------------------------------------------------
 @app.get("/api/export")
-async def get_export():
-    """CSVプレビュー"""
-    csv_path = RECORDS_CSV_PATH
-    if os.path.exists(csv_path):
-        return FileResponse(csv_path, media_type="text/csv", filename="records.csv")
+async def get_export(office_id: str | None = None):
+    """CSVプレビュー（フォーム別パーティションを結合した横持ちビュー。office_id 指定でその事業所のみ）"""
+    resp = _export_records_response("records.csv", office_id)
+    if resp is not None:
+        return resp
     else:
         return {"error": "CSV file not found"}
 
 
 @app.get("/api/export/download")
-async def download_export():
+async def download_export(office_id: str | None = None):
     """本番CSVダウンロード"""
-    csv_path = RECORDS_CSV_PATH
-    if os.path.exists(csv_path):
-        return FileResponse(csv_path, media_type="text/csv", filename="records.csv")
+    resp = _export_records_response(f"records_{office_id}.csv" if office_id else "records.csv", office_id)
+    if resp is not None:
+        return resp
     else:
         return {"error": "CSV file not found"}
 
@@ -544,34 +1221,102 @@ async def download_export_demo():
 # ------------------------------------------------------------
 # 🔹 DB → CSV エクスポートAPI（最新）
 # ------------------------------------------------------------
+# form_records（APOS_DB_URL）をサーバー側カーソルで APOS_DB_EXPORT_CHUNK_ROWS 行ずつ読み、
+# そのまま CSV のチャンクとして返す（中間ファイル無し・メモリ一定・ヘッダは即座に返る）。
+DB_EXPORT_CHUNK_ROWS = int(os.environ.get("APOS_DB_EXPORT_CHUNK_ROWS", "1000"))
+
+
+def _db_office_clause(office_id: str):
+    """user_id が「事業所番号_」で始まる行（LIKE の特殊文字はエスケープ）"""
+    escaped = office_id.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return _db_table.c.user_id.like(f"{escaped}\\_%", escape="\\")
+
+
+def _db_export_has_rows(office_id: str | None = None) -> bool:
+    from sqlalchemy import select
+    engine = _db_engine()
+    query = select(_db_table.c.id).limit(1)
+    if office_id:
+        query = query.where(_db_office_clause(office_id))
+    with engine.connect() as conn:
+        return conn.execute(query).first() is not None
+
+
+def _iter_db_export_csv(office_id: str | None = None):
+    """form_records を id 順に CSV（BOM付き UTF-8）のチャンクとして逐次生成する"""
+    from sqlalchemy import select
+    header = ["id", "form_id", "submitted_at"] + _master_header()
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=header, extrasaction="ignore")
+    buf.write("\ufeff")
+    writer.writeheader()
+    yield buf.getvalue().encode("utf-8")
+    t = _db_table
+    query = select(t.c.id, t.c.form_id, t.c.submitted_at, t.c.data).order_by(t.c.id)
+    if office_id:
+        query = query.where(_db_office_clause(office_id))
+    with _db_engine().connect() as conn:
+        result = conn.execution_options(stream_results=True, max_row_buffer=DB_EXPORT_CHUNK_ROWS).execute(query)
+        try:
+            while True:
+                chunk = result.fetchmany(DB_EXPORT_CHUNK_ROWS)
+                if not chunk:
+                    break
+                buf.seek(0)
+                buf.truncate(0)
+                for rid, form_id, submitted_at, data in chunk:
+                    try:
+                        row = json.loads(data)
+                    except ValueError:
+                        row = {}
+                    row.update({"id": rid, "form_id": form_id, "submitted_at": submitted_at})
+                    writer.writerow(row)
+                yield buf.getvalue().encode("utf-8")
+        finally:
+            result.close()
+
+
 @app.get("/api/export/records-csv")
-async def export_records_csv():
+async def export_records_csv(office_id: str | None = None):
     """
-    DBに保存された全レコードを CSV にエクスポートして返す。
-    ユーティリティが無い/データ0件の場合は既存の records.csv を返すフォールバック。
+    DBに保存された全レコードを CSV で返す（APOS_DB_URL の form_records をストリーミング）。
+    DB が無い/データ0件の場合は保存済みの records.csv（パーティション結合ビュー）を返すフォールバック。
     """
     try:
-        out_path = "/var/www/app/backend/app/records_latest.csv"
-        exported = -1
-        if export_all_records_to_csv:
+        if DB_URL:
+            try:
+                if await run_in_threadpool(_db_export_has_rows, office_id):
+                    filename = f"records_latest_{office_id}.csv" if office_id else "records_latest.csv"
+                    return StreamingResponse(
+                        _iter_db_export_csv(office_id),
+                        media_type="text/csv",
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+                    )
+            except Exception as e:
+                print("⚠ export db -> csv failed:", e)
+        elif export_all_records_to_csv and not office_id:
+            # 旧ユーティリティはファイルへ書き出す形なので、リクエストごとの一時ファイルにして送信後に消す
+            import tempfile
+            from starlette.background import BackgroundTask
+            fd, out_path = tempfile.mkstemp(prefix="records_latest_", suffix=".csv")
+            os.close(fd)
             try:
                 exported = export_all_records_to_csv(out_path)
             except Exception as e:
                 print("⚠ export db -> csv failed:", e)
-        # DBで0件 or ユーティリティ無し → 既存CSVがあれば返す
-        if (exported is None or exported <= 0) and os.path.exists(RECORDS_CSV_PATH):
-            return FileResponse(
-                RECORDS_CSV_PATH,
-                media_type="text/csv",
-                filename="records.csv",
-            )
-        # DBエクスポート成功時
-        if os.path.exists(out_path):
-            return FileResponse(
-                out_path,
-                media_type="text/csv",
-                filename="records_latest.csv",
-            )
+                exported = -1
+            if exported is not None and exported > 0:
+                return FileResponse(
+                    out_path,
+                    media_type="text/csv",
+                    filename="records_latest.csv",
+                    background=BackgroundTask(os.remove, out_path),
+                )
+            os.remove(out_path)
+        # DBで0件 or DB無し → 保存済みCSV（パーティション結合ビュー）があれば返す
+        resp = _export_records_response("records.csv", office_id)
+        if resp is not None:
+            return resp
         return {"detail": "No data"}
     except Exception as e:
         return {"detail": str(e)}
@@ -585,19 +1330,121 @@ async def get_demo_row(user_id: str):
     try:
         if not os.path.exists(DEMO_CSV_PATH):
             return {"data": None}
-        hit = None
-        with open(DEMO_CSV_PATH, "r", encoding="utf-8-sig", newline="") as rf:
-            reader = csv.DictReader(rf)
-            for row in reader:
-                if (row.get("user_id") or "").strip() == user_id.strip():
-                    hit = row
-        return {"data": hit}
+        return {"data": _read_model_row(DEMO_CSV_PATH, user_id)}
     except Exception as e:
         return {"error": str(e)}
 
 
 
 
+# ------------------------------------------------------------
+# 🔹 行キーの接頭辞索引（_formN_apply_order 系の「base_ で始まる列」の検索用）
+# ------------------------------------------------------------
+# 変換関数は「base + "_" で始まるキーが1つでもあるか」「その列をすべて」を base ごとに全キー走査で
+# 調べていたため、1件の変換がキー数 × base 数で伸びていた。受信時に行を _KeyedRow にしておき、
+# 最初の接頭辞問い合わせで「キーの "_" 区切りの各接頭辞 → キー」の索引を1回だけ作り、以後は追加・削除に
+# 合わせて保つ（"a_b_c" は "a" と "a_b" に載る）。問い合わせのない行には索引の費用がかからない。
+# 普通の dict が渡された場合、_has_key_prefix / _keys_with_prefix は従来どおり走査する。
+class _KeyedRow(dict):
+    """接頭辞索引つきの行（dict と同じように使える。索引は初回の問い合わせで作る）"""
+
+    __slots__ = ("_groups",)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._groups: dict[str, dict[str, None]] | None = None
+
+    def __reduce__(self):
+        # ワーカープロセスとの受け渡し用（索引は受け取り側で必要になったときに作り直す）
+        return (_KeyedRow, (dict(self),))
+
+    def _prefix_groups(self) -> dict[str, dict[str, None]]:
+        groups = self._groups
+        if groups is None:
+            groups = self._groups = {}
+            for key in self:
+                self._index(key)
+        return groups
+
+    def _index(self, key) -> None:
+        if isinstance(key, str):
+            i = key.find("_")
+            while i >= 0:
+                self._groups.setdefault(key[:i], {})[key] = None
+                i = key.find("_", i + 1)
+
+    def _unindex(self, key) -> None:
+        if isinstance(key, str):
+            i = key.find("_")
+            while i >= 0:
+                group = self._groups.get(key[:i])
+                if group is not None:
+                    group.pop(key, None)
+                    if not group:
+                        del self._groups[key[:i]]
+                i = key.find("_", i + 1)
+
+    def __setitem__(self, key, value):
+        if self._groups is not None and key not in self:
+            self._index(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self._groups is not None:
+            self._unindex(key)
+
+    def pop(self, key, *default):
+        if self._groups is not None and key in self:
+            self._unindex(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        key, value = super().popitem()
+        if self._groups is not None:
+            self._unindex(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if self._groups is None:
+            super().update(*args, **kwargs)
+            return
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        self._groups = None
+
+    def copy(self):
+        return _KeyedRow(self)
+
+
+def _has_key_prefix(row: dict, base: str) -> bool:
+    """row に base + "_" で始まるキーがあるか"""
+    if isinstance(row, _KeyedRow):
+        return base in row._prefix_groups()
+    prefix = base + "_"
+    return any(isinstance(k, str) and k.startswith(prefix) for k in row)
+
+
+def _keys_with_prefix(row: dict, base: str) -> list[str]:
+    """base + "_" で始まるキー（行の並び順。変更しながら回せるよう list で返す）"""
+    if isinstance(row, _KeyedRow):
+        return list(row._prefix_groups().get(base, ()))
+    prefix = base + "_"
+    return [k for k in row if isinstance(k, str) and k.startswith(prefix)]
+
+
 CHOICE_MASTER = {
     "sex": ["男", "女", "指定なし", "NA"],
     "request_route": ["CM", "MSW", "病院医師", "病院NS", "開業医師", "福祉職員", "保健所・保健センター職員", "家族", "その他"],
@@ -859,6 +1706,9 @@ FORM0_ORDER = [
 ]
 
 
+# 電話・Fax は Excel で先頭の 0 が落ちないよう '0800… の形で保存する
+_FORM0_PHONE_COLS = {"requestor_tel", "requestor_fax"}
+
 _FORM0_TEXT_COLS = {
     # 空欄は0ではなく空文字で保存したいテキスト/日付系
     "interview_location_other_text",
@@ -901,9 +1751,8 @@ def _form0_apply_aliases_and_order(row: dict) -> dict:
     # 生値（base）だけが来た場合でも one-hot を補完してからエイリアス変換する
     def _ensure_one_hot_from_raw(target: dict, bases: list[str]) -> None:
         for base in bases:
-            prefix = base + "_"
             # 既に one-hot があればスキップ
-            if any(k.startswith(prefix) for k in target.keys()):
+            if _has_key_prefix(target, base):
                 continue
             if base not in target:
                 continue
@@ -932,9 +1781,7 @@ def _form0_apply_aliases_and_order(row: dict) -> dict:
     # one-hot のサフィックス置換
     for base, mapping in FORM0_ONEHOT_ALIASES.items():
         prefix = base + "_"
-        for k in list(row.keys()):
-            if not k.startswith(prefix):
-                continue
+        for k in _keys_with_prefix(row, base):
             token = k[len(prefix):]
             alias = mapping.get(str(token))
             if alias:
@@ -945,7 +1792,6 @@ def _form0_apply_aliases_and_order(row: dict) -> dict:
         row["interview_location_other_text"] = row.get("interview_location_other", "")
 
     # 列順固定と欠損補完
-    phone_like_cols = {"requestor_tel", "requestor_fax"}
     out: dict = {}
     for col in FORM0_ORDER:
         if col in ("timestamp", "user_id"):
@@ -959,7 +1805,7 @@ def _form0_apply_aliases_and_order(row: dict) -> dict:
                 if isinstance(v, str) and v.strip() == "":
                     v = 0
             # 電話・FaxはExcelで先頭0が落ちないよう文字列化（'0800… 形式）
-            if col in phone_like_cols:
+            if col in _FORM0_PHONE_COLS:
                 sval = "" if v is None else str(v)
                 if sval != "" and not sval.startswith("'"):
                     # 先頭0 または 全数字は文字列として扱う
@@ -1124,8 +1970,7 @@ def _form1_apply_aliases_and_order(row: dict) -> dict:
     def _ensure_one_hot_bases(target: dict, bases: list[str]) -> None:
         for base in bases:
             # 既に one-hot が1つでもある場合はスキップ
-            prefix = base + "_"
-            if any(k.startswith(prefix) for k in target.keys()):
+            if _has_key_prefix(target, base):
                 continue
             # 生値が無ければスキップ
             if base not in target:
@@ -1180,9 +2025,7 @@ def _form1_apply_aliases_and_order(row: dict) -> dict:
     # one-hot のサフィックス置換
     for base, mapping in FORM1_ONEHOT_ALIASES.items():
         prefix = base + "_"
-        for k in list(row.keys()):
-            if not k.startswith(prefix):
-                continue
+        for k in _keys_with_prefix(row, base):
             token = k[len(prefix):]
             alias = mapping.get(str(token))
             if alias:
@@ -1214,7 +2057,7 @@ def _form1_apply_aliases_and_order(row: dict) -> dict:
     for i in ("1", "2", "3", "4"):
         raw_key = f"care_burden_{i}"
         # 既に one-hot 済みならスキップ
-        if any(k.startswith(raw_key + "_") for k in row.keys()):
+        if _has_key_prefix(row, raw_key):
             continue
         if raw_key in row:
             val = str(row.get(raw_key, "")).strip()
@@ -1224,7 +2067,7 @@ def _form1_apply_aliases_and_order(row: dict) -> dict:
 
     # care_status, care_status_nursing のフォールバック one-hot
     # 支援レベル（要支援1/2）
-    if "care_status" in row and not any(k.startswith("care_status_") for k in row.keys()):
+    if "care_status" in row and not _has_key_prefix(row, "care_status"):
         val = str(row.get("care_status", "")).strip()
         for choice in ["要支援1", "要支援2", "要介護1", "要介護2", "要介護3", "要介護4", "要介護5"]:
             if choice.startswith("要支援"):
@@ -1234,7 +2077,7 @@ def _form1_apply_aliases_and_order(row: dict) -> dict:
                 row[f"care_status_nursing_{choice}"] = 1 if val == choice else 0
         row.pop("care_status", None)
     # 介護レベル（要介護1〜5）
-    if "care_status_nursing" in row and not any(k.startswith("care_status_nursing_") for k in row.keys()):
+    if "care_status_nursing" in row and not _has_key_prefix(row, "care_status_nursing"):
         val = str(row.get("care_status_nursing", "")).strip()
         for choice in ["要介護1", "要介護2", "要介護3", "要介護4", "要介護5"]:
             row[f"care_status_nursing_{choice}"] = 1 if val == choice else 0
@@ -1340,14 +2183,12 @@ def _form2_apply_order(row: dict) -> dict:
         "その他": "other_flag",
     }
     # 既に目標列がひとつも無い場合のみ、補完して立てる
-    if not any(k.startswith("economic_status_3_") and k.split("_")[-1] in econ_map.values() for k in row.keys()):
+    if not any(k.split("_")[-1] in econ_map.values() for k in _keys_with_prefix(row, "economic_status_3")):
         # いったん全部0に初期化
         for suffix in econ_map.values():
             row[f"economic_status_3_{suffix}"] = 0
         # 立っている difficulties_* 列を走査して1にする
-        for k, v in list(row.items()):
-            if not k.startswith("economic_status_3_difficulties_"):
-                continue
+        for k, v in [(k, row[k]) for k in _keys_with_prefix(row, "economic_status_3_difficulties")]:
             # 自由記述のテキスト欄は one-hot 集約対象から除外（値はそのままCSVへ出す）
             if k == "economic_status_3_difficulties_other":
                 continue
@@ -1491,12 +2332,40 @@ FORM3_ORDER = [
     "social_service_reason_text",
 ]
 
+# one-hot の日本語サフィックス → 英別名（prefill の逆変換でも使う）
+FORM3_ONEHOT_ALIASES = {
+    "reform_place": {
+        "居室": "room",
+        "浴室": "bathroom",
+        "脱衣室": "datsuishitsu",
+        "浴槽": "bathtub",
+        "トイレ": "toilet",
+        "便器": "benki",
+        "廊下": "hallway",
+        "玄関": "entrance",
+        "庭": "garden",
+        "階段": "stairs",
+        "その他": "other",
+    },
+    "care_tool_type": {
+        "移動用具": "move",
+        "生活用具": "life",
+        "介助用具": "assist",
+    },
+    "equipment_type": {
+        "障害者用生活用具": "life_tool",
+        "電気": "electric",
+        "冷暖房機": "aircon",
+        "エレベータ": "elevator",
+        "その他": "other_flag",
+    },
+}
+
 def _form3_apply_order_and_image(row: dict) -> dict:
     # ベース値しか来ていない場合の one-hot 補完
     def _ensure_one_hot_from_raw(target: dict, bases: list[str]) -> None:
         for base in bases:
-            prefix = base + "_"
-            if any(k.startswith(prefix) for k in target.keys()):
+            if _has_key_prefix(target, base):
                 continue
             if base not in target:
                 continue
@@ -1528,38 +2397,9 @@ def _form3_apply_order_and_image(row: dict) -> dict:
     )
 
     # one-hot のサフィックス置換（日本語→英別名）
-    FORM3_ONEHOT_ALIASES = {
-        "reform_place": {
-            "居室": "room",
-            "浴室": "bathroom",
-            "脱衣室": "datsuishitsu",
-            "浴槽": "bathtub",
-            "トイレ": "toilet",
-            "便器": "benki",
-            "廊下": "hallway",
-            "玄関": "entrance",
-            "庭": "garden",
-            "階段": "stairs",
-            "その他": "other",
-        },
-        "care_tool_type": {
-            "移動用具": "move",
-            "生活用具": "life",
-            "介助用具": "assist",
-        },
-        "equipment_type": {
-            "障害者用生活用具": "life_tool",
-            "電気": "electric",
-            "冷暖房機": "aircon",
-            "エレベータ": "elevator",
-            "その他": "other_flag",
-        },
-    }
     for base, mapping in FORM3_ONEHOT_ALIASES.items():
         prefix = base + "_"
-        for k in list(row.keys()):
-            if not k.startswith(prefix):
-                continue
+        for k in _keys_with_prefix(row, base):
             token = k[len(prefix):]
             alias = mapping.get(str(token))
             if alias:
@@ -1690,11 +2530,9 @@ def _form5_get_bool(row: dict, col: str) -> int:
             return 0 if v.strip() == "" else (1 if v not in ("0","false","False") else 0)
         return 1 if v else 0
     # 代替: col_XXX の列が立っていれば 1 とみなす
-    prefix = col + "_"
-    for k, v in row.items():
-        if k.startswith(prefix):
-            if str(v) not in ("", "0", "false", "False"):
-                return 1
+    for k in _keys_with_prefix(row, col):
+        if str(row[k]) not in ("", "0", "false", "False"):
+            return 1
     return 0
 
 def _form5_apply_order(row: dict) -> dict:
@@ -1722,7 +2560,7 @@ def _form5_apply_order(row: dict) -> dict:
         pass
     # 2) 対人関係（1..4 → 0..3）
     try:
-        if not any(k.startswith("relationship_status_") for k in row.keys()):
+        if not _has_key_prefix(row, "relationship_status"):
             raw = str(row.get("relationship_status", "")).strip()
             if raw.isdigit():
                 idx = max(0, int(raw) - 1)
@@ -1732,7 +2570,7 @@ def _form5_apply_order(row: dict) -> dict:
         pass
     # 3) 相談の有無（1/2 → 0/1）
     try:
-        if not any(k.startswith("consultation_status_") for k in row.keys()):
+        if not _has_key_prefix(row, "consultation_status"):
             raw = str(row.get("consultation_status", "")).strip()
             if raw in ("1","2"):
                 idx = 0 if raw == "1" else 1
@@ -1757,9 +2595,7 @@ def _form5_apply_order(row: dict) -> dict:
             "その他": "other_flag",
         }
         # _flatten_payload により supporter_＜日本語＞=1 形式が来るため、それを英別名へ立て直す
-        for k, v in list(row.items()):
-            if not k.startswith("supporter_"):
-                continue
+        for k, v in [(k, row[k]) for k in _keys_with_prefix(row, "supporter")]:
             token = k[len("supporter_"):]
             if token in supporter_aliases:
                 alias = supporter_aliases[token]
@@ -1784,7 +2620,7 @@ def _form5_apply_order(row: dict) -> dict:
         else:
             v = row.get(col, None)
             if v is None:
-                out[col] = _form5_get_bool(row, col) if (col.startswith("supporter_") or col.startswith("relationship_status_") or col.startswith("consultation_status_") or col.startswith("enjoyment_") or col.startswith("social_participation_1_")) else 0
+                out[col] = _form5_get_bool(row, col) if col.startswith(("supporter_", "relationship_status_", "consultation_status_", "enjoyment_", "social_participation_1_")) else 0
             else:
                 if isinstance(v, str) and v.strip() == "":
                     out[col] = 0
@@ -1826,8 +2662,7 @@ def _form6_apply_order(row: dict) -> dict:
     # ベース値しか来ていない場合の one-hot 補完（form6）
     try:
         def _ensure_one_hot_from_raw(target: dict, base: str, choices: list[str]) -> None:
-            prefix = base + "_"
-            if any(k.startswith(prefix) for k in target.keys()):
+            if _has_key_prefix(target, base):
                 return
             if base not in target:
                 return
@@ -1844,7 +2679,7 @@ def _form6_apply_order(row: dict) -> dict:
         _ensure_one_hot_from_raw(row, "vaccination_status", ["0","1"])
         _ensure_one_hot_from_raw(row, "infection_control", ["0","1","2","3","4"])
         # disease_type は複数選択の可能性があるため、raw が残っていた場合の補完にも対応
-        if not any(k.startswith("disease_type_") for k in row.keys()):
+        if not _has_key_prefix(row, "disease_type"):
             if "disease_type" in row:
                 raw = row.get("disease_type")
                 tokens: list[str] = []
@@ -1936,8 +2771,7 @@ def _form7_apply_order(row: dict) -> dict:
             return val
 
         def _ensure_one_hot_from_raw(target: dict, base: str, choices: list[str]) -> None:
-            prefix = base + "_"
-            if any(k.startswith(prefix) for k in target.keys()):
+            if _has_key_prefix(target, base):
                 return
             if base not in target:
                 return
@@ -1960,7 +2794,7 @@ def _form7_apply_order(row: dict) -> dict:
             row.pop("oral_denture_condition", None)
         else:
             # 既に oral_teeth_gum_* が立っている場合は新列へコピー
-            if any(k.startswith("oral_teeth_gum_") for k in row.keys()):
+            if _has_key_prefix(row, "oral_teeth_gum"):
                 for c in ["0","1","2"]:
                     flag = row.get(f"oral_teeth_gum_{c}", 0)
                     row.setdefault(f"oral_denture_condition_{c}", flag)
@@ -2143,7 +2977,7 @@ def _form11_apply_order(row: dict) -> dict:
     # A項目（A.1〜A.5）の「はい」回答数を計算し、a_positive_count に格納
     try:
         # 認知状態 (nutrition_self_management) が raw 値の場合は one-hot 化
-        if not any(k.startswith("nutrition_self_management_") for k in row.keys()):
+        if not _has_key_prefix(row, "nutrition_self_management"):
             val = str(row.get("nutrition_self_management", "")).strip()
             # 値が 'nutrition_self_management_a' のような形式でも a〜h に正規化
             if val.startswith("nutrition_self_management_"):
@@ -2210,7 +3044,7 @@ def _form12_apply_order(row: dict) -> dict:
     # NPI-Q 合計点（各領域の重症度 0〜3 の総和）を算出
     try:
         # has_psy の one-hot 補完（'0' なし / '1' あり）
-        if not any(k.startswith("has_psy_") for k in row.keys()):
+        if not _has_key_prefix(row, "has_psy"):
             val = str(row.get("has_psy", "")).strip()
             if val in ("0","1"):
                 row["has_psy_0"] = 1 if val == "0" else 0
@@ -2833,7 +3667,7 @@ _FORM16_TEXT_COLS = {"wound_total_score","pain_image_front","pain_image_back","m
 def _form16_apply_order(row: dict) -> dict:
     # raw has_bedsore → one-hot 補完
     try:
-        if not any(k.startswith("has_bedsore_") for k in row.keys()):
+        if not _has_key_prefix(row, "has_bedsore"):
             val = str(row.get("has_bedsore", "")).strip()
             if val in ("0","1"):
                 row["has_bedsore_0"] = 1 if val == "0" else 0
@@ -2859,21 +3693,15 @@ def _form16_apply_order(row: dict) -> dict:
 async def list_uploads(user_id: str | None = None, from_: str | None = Query(None, alias="from"), to: str | None = None):
     files: list[str] = []
     try:
-        # ユーザー指定があれば CSV から紐づくファイル名を取得
-        if user_id and os.path.exists(RECORDS_CSV_PATH):
+        # ユーザー指定があればレコードストアから紐づくファイル名を取得
+        if user_id:
             try:
-                with open(RECORDS_CSV_PATH, "r", encoding="utf-8-sig", newline="") as rf:
-                    reader = csv.DictReader(rf)
-                    for row in reader:
-                        if str(row.get("user_id", "")) != str(user_id):
-                            continue
-                        img = row.get("image_file", "")
-                        if not img:
-                            continue
-                        for name in str(img).split(";"):
-                            name = name.strip()
-                            if name:
-                                files.append(name)
+                row = _store_read_user(user_id)
+                img = (row or {}).get("image_file", "")
+                for name in str(img or "").split(";"):
+                    name = name.strip()
+                    if name:
+                        files.append(name)
             except Exception:
                 pass
 
@@ -3000,12 +3828,11 @@ def _form17_apply_order(row: dict) -> dict:
     except Exception:
         pass
     # medicine_detail の alias（[] が付いていた場合に対応）
-    for key in list(row.keys()):
-        if key.startswith("medicine_detail[]_"):
-            suffix = key.split("_", 1)[1]  # 例: []_a
-            alias = suffix.replace("[]_", "").lstrip("_")
-            target = f"medicine_detail_{alias}"
-            row[target] = row.get(key, 0)
+    for key in _keys_with_prefix(row, "medicine_detail[]"):
+        suffix = key.split("_", 1)[1]  # 例: []_a
+        alias = suffix.replace("[]_", "").lstrip("_")
+        target = f"medicine_detail_{alias}"
+        row[target] = row.get(key, 0)
 
     # medicine_usage の逆変換
     if "medicine_usage" not in row:
@@ -3305,8 +4132,9 @@ def _form19_apply_order(row: dict) -> dict:
     # --- 受信値 → 固定スキーマ one-hot の補完（UIの name を列名へ変換）---
     # 事前クリア: 自動保存等で送られてくる既存 one-hot 値（FORM19_ORDERに含まれる列）は一旦除去して再計算する
     try:
+        order_cols = set(FORM19_ORDER)
         for key in list(row.keys()):
-            if key in FORM19_ORDER:
+            if key in order_cols:
                 row.pop(key, None)
     except Exception:
         pass
@@ -3482,26 +4310,12 @@ def _read_header(path: str) -> list[str] | None:
 # ------------------------------------------------------------
 # 🔹 CSV アップサート（ユーザー1人＝1行）
 # ------------------------------------------------------------
-def _upsert_row(path: str, row: dict, key_fields: list[str] | None = None):
-    """
-    key_fields（例: user_id）で既存行を特定し、見つかればその行を更新、なければ追加。
-    - 列は自動で拡張（既存列 + 新規列）
-    - 同一フォームから送られた値は空文字でも上書き（テキストのクリア操作を反映）
-    """
-    key_fields = key_fields or ["user_id"]
-    # 必須キーが無い場合は保存をスキップ（行を増やさない）
-    if all((not str(row.get(k, "")).strip()) for k in key_fields):
-        print(f"⚠️ upsert: 必須キー {key_fields} が空のためスキップします。")
-        return
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-
+@functools.lru_cache(maxsize=1)
+def _legacy_drop_columns() -> frozenset[str]:
+    """旧仕様・表記ゆれなど、ヘッダ/行から除去するレガシー列の集合（スキーマ移行 v1 と、移行前のファイルへの保存で使う）"""
     drop_columns = {"session", "form_id", "pain_management_suppository", "side_effect"}
     # 旧仕様の「activity_*（時間帯の後半が無い）」列は廃止して新仕様 activity_6_8 等へ一本化
-    legacy_activity_cols = {
-        "activity_6","activity_8","activity_10","activity_12","activity_14",
-        "activity_16","activity_18","activity_20","activity_22",
-    }
-    drop_columns |= legacy_activity_cols
+    drop_columns |= _LEGACY_ACTIVITY_COLS
     # form19 のレガシー列（表記ゆれ）
     legacy_form19_cols = {
         "back_curv",  # 正式名は back_curved
@@ -3529,88 +4343,157 @@ def _upsert_row(path: str, row: dict, key_fields: list[str] | None = None):
     # form17 のレガシー列（単一列 0/1 → one-hot に移行）
     legacy_form17_cols = {f"med_name_{i}" for i in range(1, 25)}
     drop_columns |= legacy_form17_cols
+    return frozenset(drop_columns)
 
-    existing_header = _read_header(path)
-    if existing_header is not None:
-        existing_header = [h for h in existing_header if h not in drop_columns]
-    rows = []
-    if existing_header is not None:
-        try:
-            with open(path, "r", encoding="utf-8-sig", newline="") as rf:
-                reader = csv.DictReader(rf)
-                loaded = list(reader)
-                # 既存行からも不要列を除去して保持
-                rows = []
-                for r in loaded:
-                    filtered = {k: v for k, v in r.items() if k not in drop_columns}
-                    rows.append(filtered)
-        except Exception as e:
-            print("⚠️ 既存データ読み込み失敗:", e)
-            rows = []
 
-    # ヘッダをマージ
-    if existing_header is None:
-        # 新規作成時は全フォームの固定スキーマを統合したマスタヘッダで初期化
-        def _get_master_header() -> list[str]:
-            base = ["timestamp", "office_id", "personal_id", "user_id"]
-            orders: list[list[str]] = []
-            for i in range(0, 20):
-                name = f"FORM{i}_ORDER"
-                if name in globals():
-                    orders.append(list(globals()[name]))
-            seen = set(base)
-            header = list(base)
-            for order in orders:
-                for col in order:
-                    if col not in seen:
-                        header.append(col)
-                        seen.add(col)
-            # 画像列は最後尾に
-            for col in ("image_file", "image_url"):
-                if col not in seen:
-                    header.append(col)
-                    seen.add(col)
-            # 念のため現在の行キーも取り込む
-            for col in row.keys():
-                if col not in seen:
-                    header.append(col)
-                    seen.add(col)
-            return header
+_LEGACY_ACTIVITY_COLS = {
+    "activity_6","activity_8","activity_10","activity_12","activity_14",
+    "activity_16","activity_18","activity_20","activity_22",
+}
 
-        merged_header = [h for h in _get_master_header() if h not in drop_columns]
-    else:
-        # 既存 + マスタヘッダ + 今回の行 で欠けを補完
-        def _get_master_header() -> list[str]:
-            base = ["timestamp", "user_id"]
-            orders: list[list[str]] = []
-            for i in range(0, 20):
-                name = f"FORM{i}_ORDER"
-                if name in globals():
-                    orders.append(list(globals()[name]))
-            seen = set(base)
-            header = list(base)
-            for order in orders:
-                for col in order:
-                    if col not in seen:
-                        header.append(col)
-                        seen.add(col)
-            for col in ("image_file", "image_url"):
+
+def _master_header(include_ids: bool = True) -> list[str]:
+    """全フォームの固定スキーマ（FORMn_ORDER）を統合したマスタヘッダ"""
+    base = ["timestamp", "office_id", "personal_id", "user_id"] if include_ids else ["timestamp", "user_id"]
+    orders: list[list[str]] = []
+    for i in range(0, 20):
+        name = f"FORM{i}_ORDER"
+        if name in globals():
+            orders.append(list(globals()[name]))
+    seen = set(base)
+    header = list(base)
+    for order in orders:
+        for col in order:
+            if col not in seen:
+                header.append(col)
+                seen.add(col)
+    # 画像列は最後尾に
+    for col in ("image_file", "image_url"):
+        if col not in seen:
+            header.append(col)
+            seen.add(col)
+    return header
+
+
+def _infer_one_hot_bases(headers: list[str]) -> set[str]:
+    """既存ヘッダとCHOICE_MASTERから one-hot のベース候補を推定"""
+    bases: set[str] = set(CHOICE_MASTER.keys())
+    for col in headers:
+        if "_" in col and col not in {"timestamp", "form_id", "image_file", "image_url", "user_id", "office_id", "personal_id"}:
+            base = col.rsplit("_", 1)[0]
+            if base:
+                bases.add(base)
+    return bases
+
+
+def _is_one_hot_col(col: str, one_hot_bases: set[str]) -> bool:
+    # form2 の activity_* はテキスト列なので one-hot 対象外
+    if isinstance(col, str) and col.startswith("activity_"):
+        return False
+    # form2 の自由記述や詳細テキストは one-hot 対象外
+    if isinstance(col, str) and (
+        col.startswith("option_detail_")
+        or col in {
+            "public_medical_reason",
+            "public_medical_detail_other",
+            "medical_disease_name",
+            "economic_status_3_difficulties_other",
+            "room_safety",
+            "room_photo_image_filename",
+            "social_service_reason_text",
+        }
+    ):
+        return False
+    if "_" not in col:
+        return False
+    base = col.rsplit("_", 1)[0]
+    return base in one_hot_bases
+
+
+def _upsert_row(path: str, row: dict, key_fields: list[str] | None = None,
+                master_header: list[str] | None = None, sort_key: str | None = None):
+    """
+    key_fields（例: user_id）で既存行を特定し、見つかればその行を更新、なければ追加。
+    - 列は自動で拡張（既存列 + 新規列）
+    - 同一フォームから送られた値は空文字でも上書き（テキストのクリア操作を反映）
+    """
+    _upsert_rows(path, [row], key_fields, master_header=master_header, sort_key=sort_key)
+
+
+def _upsert_rows(path: str, new_rows: list[dict], key_fields: list[str] | None = None,
+                 master_header: list[str] | None = None, sort_key: str | None = None,
+                 replace: bool = False) -> int:
+    """
+    複数行をまとめてアップサートし、ファイルの書き換えは1回で済ませる（_upsert_row の本体）。
+    - master_header: 新規作成時/列補完に使う固定スキーマ（未指定なら全フォームのマスタヘッダ）
+    - sort_key: 指定するとその列の順に並べて保存（パーティションのマージ結合用）
+    - replace: 既存行と重ねずに丸ごと置き換える（新しい行に無い列は空欄。アーカイブ再処理用）
+    戻り値は反映した行数。
+    """
+    key_fields = key_fields or ["user_id"]
+    pending: list[dict] = []
+    for row in new_rows:
+        # 必須キーが無い場合は保存をスキップ（行を増やさない）
+        if all((not str(row.get(k, "")).strip()) for k in key_fields):
+            print(f"⚠️ upsert: 必須キー {key_fields} が空のためスキップします。")
+            continue
+        pending.append(row)
+    if not pending:
+        return 0
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    drop_columns = _legacy_drop_columns()
+    # スキーマ移行済みのパーティションにはレガシー列が無いので、既存のヘッダ/行の除去は省く
+    migrated = _store_schema_current(path)
+
+    prev_sig = _file_sig(path)
+    existing_header = _read_header(path)
+    if existing_header is not None and not migrated:
+        existing_header = [h for h in existing_header if h not in drop_columns]
+    rows = []
+    if existing_header is not None:
+        try:
+            with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+                reader = csv.DictReader(rf)
+                if migrated:
+                    rows = list(reader)
+                else:
+                    # 既存行からも不要列を除去して保持
+                    rows = [{k: v for k, v in r.items() if k not in drop_columns} for r in reader]
+        except Exception as e:
+            print("⚠️ 既存データ読み込み失敗:", e)
+            rows = []
+
+    # ヘッダをマージ
+    if existing_header is None:
+        # 新規作成時は全フォームの固定スキーマを統合したマスタヘッダで初期化
+        base_header = list(master_header) if master_header is not None else _master_header(include_ids=True)
+        seen = set(base_header)
+        # 念のため現在の行キーも取り込む
+        for row in pending:
+            for col in row.keys():
                 if col not in seen:
-                    header.append(col)
+                    base_header.append(col)
                     seen.add(col)
-            return header
-
-        master_header = [h for h in _get_master_header() if h not in drop_columns]
+        merged_header = [h for h in base_header if h not in drop_columns]
+    else:
+        # 既存 + マスタヘッダ + 今回の行 で欠けを補完
+        base_header = list(master_header) if master_header is not None else _master_header(include_ids=False)
+        base_header = [h for h in base_header if h not in drop_columns]
         seen_order = list(existing_header)
+        seen = set(seen_order)
         # まず既存を基準に保持
         # 次にマスタにあるが既存に無い列を追加
-        for k in master_header:
-            if k not in seen_order:
-                seen_order.append(k)
-        # 最後に今回の行で新規の列を追加
-        for k in row.keys():
-            if k not in seen_order:
+        for k in base_header:
+            if k not in seen:
                 seen_order.append(k)
+                seen.add(k)
+        # 最後に今回の行で新規の列を追加（レガシー列は増やさない）
+        for row in pending:
+            for k in row.keys():
+                if k not in seen and k not in drop_columns:
+                    seen_order.append(k)
+                    seen.add(k)
         # 並び順の補正：physical_activity_f18_* を pain_* より前（かつ physical_activity_score_* の直後）に移動
         try:
             pa_f18_cols = [c for c in seen_order if c.startswith("physical_activity_f18_")]
@@ -3643,100 +4526,78 @@ def _upsert_row(path: str, row: dict, key_fields: list[str] | None = None):
 
     # デバッグ: レガシー activity 列の残存とヘッダ先頭の確認
     try:
-        legacy_present = [c for c in merged_header if c in legacy_activity_cols]
+        legacy_present = [c for c in merged_header if c in _LEGACY_ACTIVITY_COLS]
         if legacy_present:
             print("⚠️ legacy activity columns still present in header (will be dropped):", legacy_present)
         print("📋 merged header sample:", merged_header[:40])
     except Exception:
         pass
 
-    # 既存ヘッダとCHOICE_MASTERから one-hot のベース候補を推定
-    def infer_one_hot_bases(headers: list[str]) -> set[str]:
-        bases: set[str] = set(CHOICE_MASTER.keys())
-        for col in headers:
-            if "_" in col and col not in {"timestamp", "form_id", "image_file", "image_url", "user_id", "office_id", "personal_id"}:
-                base = col.rsplit("_", 1)[0]
-                if base:
-                    bases.add(base)
-        return bases
-
-    one_hot_bases = infer_one_hot_bases(merged_header)
-
-    def is_one_hot_col(col: str) -> bool:
-        # form2 の activity_* はテキスト列なので one-hot 対象外
-        if isinstance(col, str) and col.startswith("activity_"):
-            return False
-        # form2 の自由記述や詳細テキストは one-hot 対象外
-        if isinstance(col, str) and (
-            col.startswith("option_detail_")
-            or col in {
-                "public_medical_reason",
-                "public_medical_detail_other",
-                "medical_disease_name",
-                "economic_status_3_difficulties_other",
-                "room_safety",
-                "room_photo_image_filename",
-                "social_service_reason_text",
-            }
-        ):
-            return False
-        if "_" not in col:
-            return False
-        base = col.rsplit("_", 1)[0]
-        return base in one_hot_bases
-
-    # 既存行の検索
-    def match_key_set(keys: list[str], r: dict) -> bool:
-        for k in keys:
-            if str(r.get(k, "")).strip() != str(row.get(k, "")).strip():
-                return False
-        return True
+    one_hot_bases = _infer_one_hot_bases(merged_header)
+    one_hot_cols = {k for k in merged_header if _is_one_hot_col(k, one_hot_bases)}
 
-    # マッチ候補（user_id が無ければ office_id+personal_id で探す）
-    key_candidates: list[list[str]] = []
-    key_candidates.append(key_fields)
-    if (not row.get("user_id")) and row.get("office_id") and row.get("personal_id"):
-        key_candidates.append(["office_id","personal_id"])
+    # 既存行の索引（key_fields の値 → 行番号）
+    def key_of(r: dict, keys: list[str]) -> tuple:
+        return tuple(str(r.get(k, "")).strip() for k in keys)
 
-    matched_index = None
+    index: dict[tuple, int] = {}
     for idx, r in enumerate(rows):
-        for keys in key_candidates:
-            if match_key_set(keys, r):
-                matched_index = idx
-                break
-        if matched_index is not None:
-            break
+        index.setdefault(key_of(r, key_fields), idx)
+
+    target_indices: list[int] = []
+    # 集計の差分更新用（変更前の行, 変更後の行）と、来訪履歴のセッション
+    changes: list[tuple[dict | None, dict]] = []
+    sessions: list[str] = []
+    for row in pending:
+        matched_index = index.get(key_of(row, key_fields))
+        # マッチ候補（user_id が無ければ office_id+personal_id で探す）
+        if matched_index is None and (not row.get("user_id")) and row.get("office_id") and row.get("personal_id"):
+            alt = key_of(row, ["office_id", "personal_id"])
+            for idx, r in enumerate(rows):
+                if key_of(r, ["office_id", "personal_id"]) == alt:
+                    matched_index = idx
+                    break
 
-    def choose_value(col: str, old: str):
-        if col in row:
-            v = row[col]
+        if matched_index is None:
+            # 新規追加（キー欠落時はappend）
+            for k in key_fields:
+                if k not in row or row[k] in (None, ""):
+                    # user_id が無いが office_id+personal_id がある場合は生成
+                    if k == "user_id" and row.get("office_id") and row.get("personal_id"):
+                        row["user_id"] = f"{row.get('office_id')}_{row.get('personal_id')}"
+                    else:
+                        print(f"⚠️ upsert: key '{k}' が無く1行化できません。appendします。")
+            new_row = {}
+            for k in merged_header:
+                v = row.get(k, "")
+                # 未入力は one-hot 列なら 0 を入れる
+                if (v == "" or v is None) and k in one_hot_cols:
+                    v = "0"
+                new_row[k] = v
+            rows.append(new_row)
+            target_index = len(rows) - 1
+            index.setdefault(key_of(new_row, key_fields), target_index)
+            changes.append((None, new_row))
+            sessions.append(str(row.get("session", "") or ""))
+        else:
+            cur = rows[matched_index]
             # フォーム側で空欄にした場合は空文字で上書きしてクリアを反映する
-            return v
-        return old
-
-    if matched_index is None:
-        # 新規追加（キー欠落時はappend）
-        for k in key_fields:
-            if k not in row or row[k] in (None, ""):
-                # user_id が無いが office_id+personal_id がある場合は生成
-                if k == "user_id" and row.get("office_id") and row.get("personal_id"):
-                    row["user_id"] = f"{row.get('office_id')}_{row.get('personal_id')}"
-                else:
-                    print(f"⚠️ upsert: key '{k}' が無く1行化できません。appendします。")
-        new_row = {}
-        for k in merged_header:
-            v = row.get(k, "")
-            # 未入力は one-hot 列なら 0 を入れる
-            if (v == "" or v is None) and is_one_hot_col(k):
-                v = "0"
-            new_row[k] = v
-        rows.append(new_row)
-        target_index = len(rows) - 1
-    else:
-        cur = rows[matched_index]
-        updated = {k: choose_value(k, cur.get(k, "")) for k in merged_header}
-        rows[matched_index] = updated
-        target_index = matched_index
+            if replace:
+                rows[matched_index] = {k: row.get(k, "") for k in merged_header}
+            else:
+                rows[matched_index] = {k: (row[k] if k in row else cur.get(k, "")) for k in merged_header}
+            target_index = matched_index
+            changes.append((cur, rows[matched_index]))
+            sessions.append(str(row.get("session", "") or ""))
+        target_indices.append(target_index)
+
+    # 単一行のときだけ書き込み直前のデバッグを出す（一括反映時はログが膨らむため）
+    debug_index = target_indices[0] if len(target_indices) == 1 else None
+    if sort_key:
+        order = sorted(range(len(rows)), key=lambda i: str(rows[i].get(sort_key, "")))
+        rows = [rows[i] for i in order]
+        if debug_index is not None:
+            debug_index = order.index(debug_index)
 
     tmp_path = f"{path}.tmp"
     with open(tmp_path, "w", encoding="utf-8-sig", newline="") as wf:
@@ -3746,11 +4607,11 @@ def _upsert_row(path: str, row: dict, key_fields: list[str] | None = None):
             out_row = {}
             for k in merged_header:
                 v = r.get(k, "")
-                if (v == "" or v is None) and is_one_hot_col(k):
+                if (v == "" or v is None) and k in one_hot_cols:
                     v = "0"
                 out_row[k] = v
             # デバッグ: 書き込み直前の form2 用 activity_* を確認
-            if idx == target_index:
+            if idx == debug_index:
                 try:
                     # テキスト列フラグの確認を同時に出力
                     try:
@@ -3779,252 +4640,4080 @@ def _upsert_row(path: str, row: dict, key_fields: list[str] | None = None):
                     pass
             writer.writerow(out_row)
     os.replace(tmp_path, path)
+    _read_model_put(path, merged_header, rows, one_hot_cols)
+    _stats_apply(path, prev_sig, changes, one_hot_cols)
+    _bitmap_apply(path, prev_sig, changes, one_hot_cols)
+    _search_apply(path, changes)
+    _history_apply(path, changes, sessions, one_hot_cols)
+    return len(pending)
 
 
 # ------------------------------------------------------------
-# 🔹 動作確認用ルート
+# 🔹 読み出しモデル（CSV ファイルの内容をメモリに保持）
 # ------------------------------------------------------------
-@app.get("/")
-async def root():
-    """動作確認用のルート"""
-    return {"status": "running", "message": "FastAPI server for APOS-HC is active."}
+# ユーザー1行・画像一覧・デモ行・パーティション走査の読み出しは、これまで毎回 CSV を読み直していた。
+# ファイルごとに「共有ヘッダ + user_id → 値タプル」の形で保持し、書き込み側（_upsert_rows）が
+# 書いた内容でそのまま差し替える。別ワーカーの書き込みはファイルの (inode, mtime, size) の変化で
+# 検知して読み直す。上限（APOS_READ_MODEL_MAX_MB、0 で無効）を超えたら使われていないファイルから
+# 外し、外れたファイルや上限の 1/4 を超える大きなファイルはディスクから直接読む。
+READ_MODEL_MAX_BYTES = int(float(os.environ.get("APOS_READ_MODEL_MAX_MB", "128")) * 1024 * 1024)
+
+_read_model_lock = threading.Lock()
+# path → (ファイル署名, ヘッダ, {user_id: 値タプル}, 推定バイト数)
+_read_model: "OrderedDict[str, tuple]" = OrderedDict()
+_read_model_bytes = 0
+
+
+def _file_sig(path: str) -> tuple | None:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def _compact_rows(header: tuple, value_lists) -> tuple[dict, int]:
+    """値のリスト群 → {user_id: 値タプル}。短い値は intern して共有し、おおよそのメモリ量も返す"""
+    width = len(header)
+    uid_idx = header.index("user_id") if "user_id" in header else None
+    rows: dict[str, tuple] = {}
+    nbytes = 0
+    for values in value_lists:
+        if len(values) < width:
+            values = list(values) + [""] * (width - len(values))
+        vals = tuple(sys.intern(v) if len(v) <= 16 else v for v in values[:width])
+        uid = vals[uid_idx].strip() if uid_idx is not None else ""
+        rows[uid] = vals
+        nbytes += 64 + 8 * width + sum(49 + len(v) for v in vals if len(v) > 1)
+    return rows, nbytes
+
+
+def _read_model_store(path: str, entry: tuple) -> None:
+    global _read_model_bytes
+    with _read_model_lock:
+        old = _read_model.pop(path, None)
+        if old is not None:
+            _read_model_bytes -= old[3]
+        _read_model[path] = entry
+        _read_model_bytes += entry[3]
+        while _read_model_bytes > READ_MODEL_MAX_BYTES and len(_read_model) > 1:
+            _evicted_path, evicted = _read_model.popitem(last=False)
+            _read_model_bytes -= evicted[3]
+
+
+def _read_model_drop(path: str) -> None:
+    global _read_model_bytes
+    with _read_model_lock:
+        old = _read_model.pop(path, None)
+        if old is not None:
+            _read_model_bytes -= old[3]
+
+
+def _read_model_put(path: str, header: list[str], rows: list[dict], one_hot_cols=()) -> None:
+    """書き込み直後の内容で差し替える（_upsert_rows から呼ぶ。書いた値と同じく one-hot の空欄は 0）"""
+    if READ_MODEL_MAX_BYTES <= 0:
+        return
+    sig = _file_sig(path)
+    if sig is None or sig[2] > READ_MODEL_MAX_BYTES // 4:
+        _read_model_drop(path)
+        return
+
+    def values():
+        for r in rows:
+            out = []
+            for k in header:
+                v = r.get(k, "")
+                if (v == "" or v is None) and k in one_hot_cols:
+                    v = "0"
+                out.append("" if v is None else str(v))
+            yield out
+
+    compact, nbytes = _compact_rows(tuple(header), values())
+    _read_model_store(path, (sig, tuple(header), compact, nbytes))
+
+
+def _read_model_get(path: str, load: bool = True) -> tuple | None:
+    """最新の内容を保持していればそれを返す。無ければ読み込んで保持する（大きすぎる場合は None）"""
+    if READ_MODEL_MAX_BYTES <= 0:
+        return None
+    sig = _file_sig(path)
+    if sig is None:
+        _read_model_drop(path)
+        return None
+    with _read_model_lock:
+        entry = _read_model.get(path)
+        if entry is not None and entry[0] == sig:
+            _read_model.move_to_end(path)
+            return entry
+    if not load or sig[2] > READ_MODEL_MAX_BYTES // 4:
+        return None
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+            reader = csv.reader(rf)
+            header = tuple(next(reader, []))
+            compact, nbytes = _compact_rows(header, reader)
+    except FileNotFoundError:
+        return None
+    entry = (sig, header, compact, nbytes)
+    # 読んでいる間に書き換わっていたら保持しない（次の読み出しで読み直す）
+    if _file_sig(path) == sig:
+        _read_model_store(path, entry)
+    return entry
+
+
+def _read_model_row(path: str, user_id: str) -> dict | None:
+    """指定 user_id の行（同じ user_id が複数あれば最後の行）"""
+    uid = str(user_id or "").strip()
+    entry = _read_model_get(path)
+    if entry is not None:
+        vals = entry[2].get(uid)
+        return dict(zip(entry[1], vals)) if vals is not None else None
+    # 保持できない大きなファイル・無効時はディスクから探す
+    hit = None
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+            for r in csv.DictReader(rf):
+                if (r.get("user_id") or "").strip() == uid:
+                    hit = r
+    except FileNotFoundError:
+        return None
+    return hit
+
+
+def _read_model_rows(path: str):
+    """ファイルの全行を dict で返す（保持していればメモリから、無ければディスクから）"""
+    entry = _read_model_get(path)
+    if entry is not None:
+        header = entry[1]
+        for vals in entry[2].values():
+            yield dict(zip(header, vals))
+        return
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+            yield from csv.DictReader(rf)
+    except FileNotFoundError:
+        return
+
+
+def _read_model_warm() -> int:
+    """起動時: パーティションとデモCSVを上限の範囲で読み込んでおく（戻り値は保持したファイル数）"""
+    if READ_MODEL_MAX_BYTES <= 0:
+        return 0
+    paths = [os.path.join(_shard_dir(s), f"{n}.csv") for s in _list_shards() for n in _list_partitions(s)]
+    paths.append(DEMO_CSV_PATH)
+    loaded = 0
+    for path in paths:
+        if _read_model_bytes >= READ_MODEL_MAX_BYTES * 0.9:
+            break
+        try:
+            if _read_model_get(path) is not None:
+                loaded += 1
+        except Exception as e:
+            print("⚠️ read model warm-up failed:", path, e)
+    print(f"🧠 読み出しモデル: {loaded} ファイル / 約 {_read_model_bytes // 1024} KiB")
+    return loaded
+
 
 # ------------------------------------------------------------
-# 🔹 本番用ヘルパー群（画像保存/ディレクトリ作成/Refererからform_id抽出）
+# 🔹 回答分布の集計（one-hot 列ごと・事業所ごとの件数を保存のたびに差分更新）
 # ------------------------------------------------------------
-def _ensure_dirs():
-    os.makedirs(os.path.dirname(RECORDS_CSV_PATH), exist_ok=True)
-    os.makedirs(os.path.dirname(DEMO_CSV_PATH), exist_ok=True)
-    os.makedirs(UPLOADS_DIR, exist_ok=True)
+# 「事業所ごとに care_status_要介護3 が何人か」を見るのに CSV 全件を落として数えていた。
+# パーティションファイルごとに {事業所: {列: 1 の件数}} と行数を持ち、_upsert_rows が書き換えた行について
+# 変更前の行の 1 を引き、変更後の行の 1 を足す。初回の問い合わせ・別ワーカーの書き込み（ファイル署名の
+# 不一致）・一括置き換えの後はファイルから数え直す。/api/stats はこの集計を足し合わせるだけで返す。
+_stats_lock = threading.Lock()
+# path → {"sig": ファイル署名, "offices": {事業所: Counter(列 → 件数)}, "rows": Counter(事業所 → 行数)}
+_stats_cache: dict[str, dict] = {}
 
 
-def _extract_form_id_from_referer(referer: str | None) -> str | None:
-    if not referer:
-        return None
-    m = re.search(r"/forms/(form\d+)\.html", referer)
-    if m:
-        return m.group(1)
-    m = re.search(r"/(form\d+)\.html", referer)
-    return m.group(1) if m else None
+def _stats_flags(row: dict, one_hot_cols) -> list[str]:
+    """行の one-hot 列のうち 1 が立っている列"""
+    return [k for k, v in row.items() if k in one_hot_cols and str(v).strip() == "1"]
 
 
-def _decode_and_save_images(payload: dict, form_id: str, now: datetime):
+def _stats_build(path: str) -> dict | None:
+    """パーティションファイルを数え直す（ファイルが無ければ None）"""
+    sig = _file_sig(path)
+    if sig is None:
+        return None
+    header = _read_header(path) or []
+    one_hot_bases = _infer_one_hot_bases(header)
+    one_hot_cols = {k for k in header if _is_one_hot_col(k, one_hot_bases)}
+    offices: dict[str, Counter] = {}
+    rows: Counter = Counter()
+    for r in _read_model_rows(path):
+        office = _office_of_user(r.get("user_id", ""))
+        rows[office] += 1
+        offices.setdefault(office, Counter()).update(_stats_flags(r, one_hot_cols))
+    return {"sig": sig, "offices": offices, "rows": rows}
+
+
+def _stats_apply(path: str, prev_sig, changes: list[tuple[dict | None, dict]], one_hot_cols) -> None:
+    """_upsert_rows の書き込み後に呼ぶ: 集計を持っているファイルなら差分だけ反映する"""
+    with _stats_lock:
+        entry = _stats_cache.get(path)
+        if entry is None:
+            return
+        if entry["sig"] != prev_sig:
+            # 書き込み前の時点で既に古い（別ワーカーの書き込みを取りこぼしている）→ 次の問い合わせで数え直す
+            del _stats_cache[path]
+            return
+        for old, new in changes:
+            if old is not None:
+                office = _office_of_user(old.get("user_id", ""))
+                entry["rows"][office] -= 1
+                counts = entry["offices"].setdefault(office, Counter())
+                counts.subtract(_stats_flags(old, one_hot_cols))
+            office = _office_of_user(new.get("user_id", ""))
+            entry["rows"][office] += 1
+            entry["offices"].setdefault(office, Counter()).update(_stats_flags(new, one_hot_cols))
+        entry["sig"] = _file_sig(path)
+
+
+def _stats_get(path: str) -> dict | None:
+    """最新の集計（署名が変わっていれば数え直す）"""
+    sig = _file_sig(path)
+    with _stats_lock:
+        entry = _stats_cache.get(path)
+        if entry is not None and entry["sig"] == sig:
+            return entry
+    entry = _stats_build(path)
+    with _stats_lock:
+        if entry is None:
+            _stats_cache.pop(path, None)
+        elif _file_sig(path) == entry["sig"]:
+            _stats_cache[path] = entry
+    return entry
+
+
+def _answer_stats(form_id: str | None = None, office_id: str | None = None,
+                  prefix: str | None = None, by_office: bool = False) -> dict:
     """
-    画像DataURLを保存し、(保存ファイル一覧, 元キー名→ファイル名の対応) を返す。
+    パーティションの集計を足し合わせる。
+    - form_id: 対象フォーム（未指定なら全フォーム。列名はフォームごとに異なるのでそのまま合算）
+    - office_id: 対象事業所（未指定なら全事業所）
+    - prefix: 列名の前方一致で絞る（例: care_status → care_status_要介護3 など）
+    - by_office: 事業所ごとの内訳も返す
     """
-    saved_files: list[str] = []
-    key_to_filename: dict[str, str] = {}
-    ts = now.strftime("%Y%m%d_%H%M%S")
-    idx = 1
-    for k, v in list(payload.items()):
-        if not isinstance(v, str):
-            continue
-        if not v.startswith("data:image/"):
-            continue
-        try:
-            header, b64data = v.split(",", 1)
-        except ValueError:
-            continue
-        # 画像タイプの許容（JPEG/PNG）。PNGでも受け取り、拡張子はjpgで保存
-        lower = header.lower()
-        if not (lower.startswith("data:image/jpeg") or lower.startswith("data:image/jpg") or lower.startswith("data:image/png")):
-            continue
-        try:
-            binary = base64.b64decode(b64data, validate=True)
-        except Exception:
-            continue
-        fname = f"{form_id}_{ts}_{idx}.jpg"
-        fpath = os.path.join(UPLOADS_DIR, fname)
-        with open(fpath, "wb") as wf:
-            wf.write(binary)
-        saved_files.append(fname)
-        key_to_filename[k] = fname
-        idx += 1
-        # CSVが肥大化しないよう、payloadから画像データを除去
-        del payload[k]
-    return saved_files, key_to_filename
+    _store_flush()
+    fid = str(form_id or "").strip()
+    names = {_partition_name(f"form{fid}" if fid.isdigit() else fid)} if fid else None
+    office = str(office_id or "").strip() or None
+    counts: Counter = Counter()
+    users: Counter = Counter()
+    per_office: dict[str, Counter] = {}
+    for shard in _export_shards(office):
+        for name in _list_partitions(shard):
+            if names is not None and name not in names:
+                continue
+            entry = _stats_get(os.path.join(_shard_dir(shard), f"{name}.csv"))
+            if entry is None:
+                continue
+            # 保存時の _stats_apply が同じ Counter を書き換えるので、足し合わせはロックの中で行う
+            with _stats_lock:
+                for off, office_counts in entry["offices"].items():
+                    if office is not None and off != office:
+                        continue
+                    users[name] += entry["rows"][off]
+                    for col, n in office_counts.items():
+                        if n and (not prefix or col.startswith(prefix)):
+                            counts[col] += n
+                            if by_office:
+                                per_office.setdefault(off, Counter())[col] += n
+    result = {
+        "status": "ok",
+        "form_id": form_id,
+        "office_id": office,
+        "users": dict(users),
+        "counts": dict(sorted(counts.items())),
+    }
+    if by_office:
+        result["by_office"] = {off: dict(sorted(c.items())) for off, c in sorted(per_office.items())}
+    return result
 
 
+@app.get("/api/stats")
+async def get_answer_stats(form_id: str | None = None, office_id: str | None = None,
+                           prefix: str | None = None, by_office: bool = False):
+    """one-hot 列ごとの「1」の件数（事業所・フォームで絞り込み可）"""
+    try:
+        return await run_in_threadpool(_answer_stats, form_id, office_id, prefix, by_office)
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
 
 
 # ------------------------------------------------------------
-# 🟩 共通保存エンドポイント（form0, form1, form2…を統一管理）
+# 🔹 対象者の絞り込み（one-hot 列ごとのビットマップ索引 + /api/query）
 # ------------------------------------------------------------
-@app.post("/api/form{form_num}")
-async def save_form_section(form_num: int, request: Request):
+# 「dementia_exist_1 かつ fall_anxiety_2 かつ residence_type_apartment の利用者」を出すには records.csv を
+# 落として絞るしかなかった。user_id ごとにプロセス内の通し番号を振り、パーティションファイルごとに
+# 「列 → その列が 1 の利用者のビット集合」を Python の int（任意長ビット列）で持つ。1 が1件も無い列は持たない。
+# 保存時は回答分布の集計と同じく _upsert_rows の（変更前, 変更後）の行で該当ビットだけを立て直し、
+# 別ワーカーの書き込みなどでファイル署名が合わなければ数え直す。式の評価は列ごとのビット集合の &, |, ~ で済む。
+_bitmap_lock = threading.Lock()
+# user_id ↔ 通し番号（追記のみ）
+_bitmap_ids: dict[str, int] = {}
+_bitmap_uids: list[str] = []
+# path → {"sig": ファイル署名, "users": 在籍ビット, "cols": one-hot 列の集合, "bits": {列: ビット}}
+_bitmap_cache: dict[str, dict] = {}
+
+
+def _bitmap_id(user_id: str) -> int:
+    """user_id の通し番号（_bitmap_lock 内で呼ぶ）"""
+    uid = str(user_id or "").strip()
+    bid = _bitmap_ids.get(uid)
+    if bid is None:
+        bid = _bitmap_ids[uid] = len(_bitmap_uids)
+        _bitmap_uids.append(uid)
+    return bid
+
+
+def _bits_from_ids(ids) -> int:
+    """番号の集まり → ビット集合（1ビットずつ int を作り直さず、バイト列から一度に作る）"""
+    ids = list(ids)
+    if not ids:
+        return 0
+    buf = bytearray(max(ids) // 8 + 1)
+    for i in ids:
+        buf[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(buf, "little")
+
+
+def _ids_from_bits(bits: int) -> list[int]:
+    """ビット集合 → 番号（昇順）"""
+    if bits <= 0:
+        return []
+    text = bin(bits)[:1:-1]
+    out = []
+    i = text.find("1")
+    while i >= 0:
+        out.append(i)
+        i = text.find("1", i + 1)
+    return out
+
+
+def _bitmap_build(path: str) -> dict | None:
+    """パーティションファイルから作り直す（ファイルが無ければ None）"""
+    sig = _file_sig(path)
+    if sig is None:
+        return None
+    header = _read_header(path) or []
+    one_hot_bases = _infer_one_hot_bases(header)
+    one_hot_cols = {k for k in header if _is_one_hot_col(k, one_hot_bases)}
+    users: list[int] = []
+    ids_by_col: dict[str, list[int]] = {}
+    rows = list(_read_model_rows(path))
+    with _bitmap_lock:
+        for r in rows:
+            bid = _bitmap_id(r.get("user_id", ""))
+            users.append(bid)
+            for col in _stats_flags(r, one_hot_cols):
+                ids_by_col.setdefault(col, []).append(bid)
+    return {
+        "sig": sig,
+        "users": _bits_from_ids(users),
+        "cols": one_hot_cols,
+        "bits": {col: _bits_from_ids(ids) for col, ids in ids_by_col.items()},
+    }
+
+
+def _bitmap_apply(path: str, prev_sig, changes: list[tuple[dict | None, dict]], one_hot_cols) -> None:
+    """_upsert_rows の書き込み後に呼ぶ: 索引を持っているファイルなら変わった行のビットだけ立て直す"""
+    with _bitmap_lock:
+        entry = _bitmap_cache.get(path)
+        if entry is None:
+            return
+        if entry["sig"] != prev_sig:
+            del _bitmap_cache[path]
+            return
+        bits = entry["bits"]
+        for old, new in changes:
+            mask = 1 << _bitmap_id(new.get("user_id", ""))
+            if old is not None:
+                for col in _stats_flags(old, one_hot_cols):
+                    if col in bits:
+                        bits[col] &= ~mask
+                        if not bits[col]:
+                            del bits[col]
+            for col in _stats_flags(new, one_hot_cols):
+                bits[col] = bits.get(col, 0) | mask
+            entry["users"] |= mask
+        entry["cols"] = entry["cols"] | set(one_hot_cols)
+        entry["sig"] = _file_sig(path)
+
+
+def _bitmap_get(path: str) -> dict | None:
+    """最新の索引（署名が変わっていれば作り直す）"""
+    sig = _file_sig(path)
+    with _bitmap_lock:
+        entry = _bitmap_cache.get(path)
+        if entry is not None and entry["sig"] == sig:
+            return entry
+    entry = _bitmap_build(path)
+    with _bitmap_lock:
+        if entry is None:
+            _bitmap_cache.pop(path, None)
+        elif _file_sig(path) == entry["sig"]:
+            _bitmap_cache[path] = entry
+    return entry
+
+
+_QUERY_TOKEN_RE = re.compile(r"\s*(?:(\()|(\))|(&&?|\|\|?|!)|([^\s()&|!]+))")
+
+
+def _parse_cohort_query(text: str):
     """
-    form0.html / form1.html / form2.html などのページデータを共通保存
+    絞り込み式 → 構文木。列名と AND / OR / NOT（& | ! も可）と括弧が使える。優先順位は NOT > AND > OR。
+    例: dementia_exist_1 AND (fall_anxiety_2 OR NOT residence_type_apartment)
+    """
+    tokens: list[tuple[str, str]] = []
+    pos = 0
+    text = str(text or "")
+    while pos < len(text):
+        m = _QUERY_TOKEN_RE.match(text, pos)
+        if not m or m.end() == pos:
+            if text[pos:].strip():
+                raise ValueError(f"式を解釈できません: {text[pos:]!r}")
+            break
+        pos = m.end()
+        lparen, rparen, op, word = m.groups()
+        if lparen:
+            tokens.append(("(", lparen))
+        elif rparen:
+            tokens.append((")", rparen))
+        elif op:
+            tokens.append(({"&": "AND", "&&": "AND", "|": "OR", "||": "OR", "!": "NOT"}[op], op))
+        elif word.upper() in ("AND", "OR", "NOT"):
+            tokens.append((word.upper(), word))
+        else:
+            tokens.append(("COL", word))
+    if not tokens:
+        raise ValueError("式が空です")
+
+    def peek():
+        return tokens[0][0] if tokens else None
+
+    def parse_or():
+        node = parse_and()
+        while peek() == "OR":
+            tokens.pop(0)
+            node = ("or", node, parse_and())
+        return node
+
+    def parse_and():
+        node = parse_not()
+        while peek() == "AND":
+            tokens.pop(0)
+            node = ("and", node, parse_not())
+        return node
+
+    def parse_not():
+        if peek() == "NOT":
+            tokens.pop(0)
+            return ("not", parse_not())
+        if peek() == "(":
+            tokens.pop(0)
+            node = parse_or()
+            if peek() != ")":
+                raise ValueError("括弧が閉じていません")
+            tokens.pop(0)
+            return node
+        if peek() == "COL":
+            return ("col", tokens.pop(0)[1])
+        raise ValueError(f"列名が必要な位置に {tokens[0][1] if tokens else '（式の終わり）'!r} があります")
+
+    tree = parse_or()
+    if tokens:
+        raise ValueError(f"余分な記述があります: {tokens[0][1]!r}")
+    return tree
+
+
+def _query_columns(tree) -> set[str]:
+    if tree[0] == "col":
+        return {tree[1]}
+    return set().union(*(_query_columns(t) for t in tree[1:]))
+
+
+def _cohort_query(q: str, office_id: str | None = None) -> dict:
+    """絞り込み式を評価して該当する user_id（昇順）を返す"""
+    tree = _parse_cohort_query(q)
+    columns = _query_columns(tree)
+    _store_flush()
+    office = str(office_id or "").strip() or None
+    universe = 0
+    col_bits = {col: 0 for col in columns}
+    known: set[str] = set()
+    for shard in _export_shards(office):
+        for name in _list_partitions(shard):
+            entry = _bitmap_get(os.path.join(_shard_dir(shard), f"{name}.csv"))
+            if entry is None:
+                continue
+            universe |= entry["users"]
+            known |= columns & entry["cols"]
+            for col in columns:
+                b = entry["bits"].get(col)
+                if b:
+                    col_bits[col] |= b
+
+    def ev(node) -> int:
+        kind = node[0]
+        if kind == "col":
+            return col_bits[node[1]]
+        if kind == "not":
+            return universe & ~ev(node[1])
+        if kind == "and":
+            return ev(node[1]) & ev(node[2])
+        return ev(node[1]) | ev(node[2])
+
+    hits = ev(tree) & universe
+    with _bitmap_lock:
+        user_ids = sorted(_bitmap_uids[i] for i in _ids_from_bits(hits))
+    if office is not None:
+        user_ids = [u for u in user_ids if _office_of_user(u) == office]
+    return {"user_ids": user_ids, "unknown_columns": sorted(columns - known)}
+
+
+@app.get("/api/query")
+async def query_cohort(q: str, office_id: str | None = None, format: str = "json",
+                       limit: int = 1000, offset: int = 0):
+    """
+    one-hot 列の論理式で利用者を絞り込む。
+    - format=json: 該当件数と user_id（offset/limit で切り出し）
+    - format=csv: 該当者の横持ち行を CSV でストリーミング
     """
     try:
-        _ensure_dirs()
+        result = await run_in_threadpool(_cohort_query, q, office_id)
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    user_ids = result["user_ids"]
+    if format == "csv":
+        return StreamingResponse(
+            _iter_export_csv(office_id, user_ids=set(user_ids)),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": 'attachment; filename="query.csv"'},
+        )
+    offset = max(0, offset)
+    return {
+        "status": "ok",
+        "query": q,
+        "office_id": office_id,
+        "count": len(user_ids),
+        "user_ids": user_ids[offset:offset + max(0, limit)],
+        "unknown_columns": result["unknown_columns"],
+    }
 
-        payload = await request.json()
-        if not isinstance(payload, dict):
-            return {"status": "error", "message": "Invalid JSON"}
 
-        # form_idを自動設定
-        form_id = payload.get("form_id") or f"form{form_num}"
-        now = datetime.now(timezone(timedelta(hours=9)))
-        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+# ------------------------------------------------------------
+# 🔹 自由記述の全文検索（SQLite FTS5 の trigram 索引 + /api/search）
+# ------------------------------------------------------------
+# 診断名・副作用・メモなどの自由記述は、エクスポートした CSV を grep するしかなかった。
+# パーティションへの保存（_upsert_rows）のたびに、その行の自由記述列を SQLite の索引へ反映する。
+# 日本語は分かち書きせず 3 文字単位（trigram）で索引し、2 文字以下の語は索引対象の本文を LIKE で探す。
+# 索引はワーカー間で共有する1ファイル（WAL）。導入前からあるデータは起動時にシャード単位で取り込む。
+SEARCH_ENABLED = os.environ.get("APOS_SEARCH", "1").strip().lower() not in ("0", "false", "off", "")
+# 未指定なら records_parts/_search/answers.sqlite3
+SEARCH_DB_PATH = os.environ.get("APOS_SEARCH_DB", "")
+# 名前で対象にする列（_FORMn_TEXT_COLS と語尾による判定に加えて）
+SEARCH_EXTRA_COLS = {
+    "doctor_diagnosis_note", "side_effect_detail", "treatment_other_detail", "room_safety", "memo",
+}
+_SEARCH_COL_RE = re.compile(r"(?:^diagnosis_\d+|_(?:detail|note|other|text|reason|memo|comment))$")
+# 数字・日付・時刻だけの値は索引しない
+_SEARCH_SKIP_VALUE_RE = re.compile(r"[\d\s.,:/+\-]*")
+_SEARCH_SNIPPET_CHARS = 24
 
-        # 画像保存 + データをフラット化（DataURL → jpg ファイル）
-        image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
-        field_types = payload.pop("field_types", None)
-        flattened = _flatten_payload(payload, field_types)
+_search_lock = threading.Lock()
+_search_conn = None
+_search_text_cols: set[str] | None = None
 
-        # ユーザー識別
-        uid = (payload.get("user_id") or flattened.get("user_id") or "").strip()
-        office_id = (payload.get("office_id") or flattened.get("office_id") or "").strip()
-        personal_id = (payload.get("personal_id") or flattened.get("personal_id") or "").strip()
-        if not uid and office_id and personal_id:
-            uid = f"{office_id}_{personal_id}"
-            flattened["user_id"] = uid
 
-        # 行データ作成
-        row = {"timestamp": timestamp, "form_id": form_id}
-        row.update(flattened)
-        if uid:
-            row["user_id"] = uid
+def _search_db_path() -> str:
+    return SEARCH_DB_PATH or os.path.join(RECORDS_PARTITION_DIR, "_search", "answers.sqlite3")
 
-        # 画像列は常に出力（無ければ空文字）
-        row["image_file"] = ";".join(image_files) if image_files else ""
-        row["image_url"] = ";".join(f"{BASE_UPLOAD_URL}/{fname}" for fname in image_files) if image_files else ""
 
-     
+def _search_db():
+    """索引への接続（初回に作成。_search_lock 内で呼ぶ。使えない環境では None）"""
+    global _search_conn, SEARCH_ENABLED
+    if _search_conn is not None or not SEARCH_ENABLED:
+        return _search_conn
+    if sqlite3 is None:
+        SEARCH_ENABLED = False
+        return None
+    path = _search_db_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS answer_text (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                office_id TEXT NOT NULL,
+                form TEXT NOT NULL,
+                col TEXT NOT NULL,
+                body TEXT NOT NULL,
+                UNIQUE (user_id, form, col)
+            );
+            CREATE INDEX IF NOT EXISTS ix_answer_text_office ON answer_text (office_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS answer_text_fts USING fts5(
+                body, content='answer_text', content_rowid='id', tokenize='trigram'
+            );
+            CREATE TRIGGER IF NOT EXISTS answer_text_ai AFTER INSERT ON answer_text BEGIN
+                INSERT INTO answer_text_fts(rowid, body) VALUES (new.id, new.body);
+            END;
+            CREATE TRIGGER IF NOT EXISTS answer_text_ad AFTER DELETE ON answer_text BEGIN
+                INSERT INTO answer_text_fts(answer_text_fts, rowid, body) VALUES ('delete', old.id, old.body);
+            END;
+            CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+    except Exception as e:
+        # FTS5 / trigram の無い SQLite（3.34 未満など）
+        print("⚠️ 全文検索を無効にします:", e)
+        conn.close()
+        SEARCH_ENABLED = False
+        return None
+    _search_conn = conn
+    return conn
+
+
+def _search_is_text_col(col: str) -> bool:
+    global _search_text_cols
+    if _search_text_cols is None:
+        cols = set(SEARCH_EXTRA_COLS)
+        for name, value in globals().items():
+            if re.fullmatch(r"_FORM\d+_TEXT_COLS", name):
+                cols |= set(value)
+        _search_text_cols = cols
+    return col in _search_text_cols or bool(_SEARCH_COL_RE.search(col))
+
+
+def _search_docs(row: dict) -> dict[str, str]:
+    """行の自由記述列（空・数字だけの値は除く）"""
+    docs = {}
+    for col, value in row.items():
+        if not isinstance(col, str) or not _search_is_text_col(col):
+            continue
+        text = "" if value is None else str(value).strip()
+        if text and not _SEARCH_SKIP_VALUE_RE.fullmatch(text):
+            docs[col] = text
+    return docs
 
-         elif form_id == "form2":
-            form2_only = _form2_apply_order(row)
-            # デバッグ: _form2_apply_order 適用後の主要列を確認
-            try:
-                debug_after_activity = {
-                    k: form2_only.get(k, "")
-                    for k in (
-                        "activity_6_8","activity_8_10","activity_10_12","activity_12_14",
-                        "activity_14_16","activity_16_18","activity_18_20","activity_20_22","activity_22_6",
-                    )
-                }
-                debug_after_public = {
-                    k: form2_only.get(k, "")
-                    for k in form2_only.keys()
-                    if isinstance(k, str)
-                    and (
-                        k.startswith("public_medical_")
-                        or k.startswith("expensive_cost_")
-                        or k.startswith("economic_status_")
-                        or k.startswith("option_detail_")
-                    )
-                }
-                print("✅ after _form2_apply_order (activity):", debug_after_activity)
-                print("✅ after _form2_apply_order (public/exp/econ/option):", debug_after_public)
-            except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form2_only["timestamp"], "form_id": form_id, "user_id": uid}, **form2_only, **img_cols}
-        elif form_id == "form3":
-            form3_only = _form3_apply_order_and_image(row)
-            # デバッグ: form3 の主要 one-hot / 数値・テキスト列を確認
-            try:
-                debug_f3 = {}
-                for k in list(form3_only.keys()):
-                    if (
-                        k.startswith("residence_type_")
-                        or k.startswith("elevator_")
-                        or k.startswith("entrance_to_road_")
-                        or k.startswith("reform_need_")
-                        or k.startswith("reform_place_")
-                        or k.startswith("care_tool_need_")
-                        or k.startswith("care_tool_type_")
-                        or k.startswith("equipment_need_")
-                        or k.startswith("equipment_type_")
-                        or k.startswith("social_service_usage_")
-                        or k in ("apartment_floor","room_safety","room_photo_image_filename","social_service_reason_text")
-                    ):
-                        debug_f3[k] = form3_only.get(k, "")
-                print("🏠 form3 payload (residence/elevator/entrance/reform/tools/equipment):", debug_f3)
-            except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form3_only["timestamp"], "form_id": form_id, "user_id": uid}, **form3_only, **img_cols}
-        elif form_id == "form4":
-            form4_only = _form4_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form4_only["timestamp"], "form_id": form_id, "user_id": uid}, **form4_only, **img_cols}
-        elif form_id == "form5":
-            form5_only = _form5_apply_order(row)
-            # デバッグ: form5 の主要列を確認
+
+def _search_write(conn, form: str, rows) -> None:
+    """行ごとに、その利用者・フォームの文書を入れ替える（呼び出し側でトランザクションを張る）"""
+    for row in rows:
+        uid = str(row.get("user_id", "") or "").strip()
+        if not uid:
+            continue
+        docs = _search_docs(row)
+        current = dict(conn.execute(
+            "SELECT col, body FROM answer_text WHERE user_id = ? AND form = ?", (uid, form)
+        ).fetchall())
+        stale = [col for col, body in current.items() if docs.get(col) != body]
+        if stale:
+            conn.executemany(
+                "DELETE FROM answer_text WHERE user_id = ? AND form = ? AND col = ?",
+                [(uid, form, col) for col in stale],
+            )
+        fresh = [(uid, _office_of_user(uid), form, col, body) for col, body in docs.items() if current.get(col) != body]
+        if fresh:
+            conn.executemany(
+                "INSERT INTO answer_text (user_id, office_id, form, col, body) VALUES (?, ?, ?, ?, ?)", fresh
+            )
+
+
+def _search_apply(path: str, changes: list[tuple[dict | None, dict]]) -> None:
+    """_upsert_rows の書き込み後に呼ぶ: パーティションの変わった行を索引へ反映する（失敗しても保存は止めない）"""
+    if not SEARCH_ENABLED or not changes:
+        return
+    if os.path.dirname(os.path.dirname(os.path.abspath(path))) != os.path.abspath(RECORDS_PARTITION_DIR):
+        return
+    form = os.path.basename(path)[:-4]
+    try:
+        with _search_lock:
+            conn = _search_db()
+            if conn is None:
+                return
+            conn.execute("BEGIN IMMEDIATE")
             try:
-                keys_rel = [f"relationship_status_{i}" for i in range(4)]
-                keys_con = [f"consultation_status_{i}" for i in range(2)]
-                keys_sp1 = [f"social_participation_1_{t}" for t in ("a","b","c","d")]
-                debug_f5 = {k: form5_only.get(k, "") for k in (keys_rel + keys_con + keys_sp1)}
-                print("🏷 form5 payload (rel/consult/sp1):", debug_f5)
+                _search_write(conn, form, (new for _old, new in changes))
+                conn.execute("COMMIT")
             except Exception:
-                pass
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form5_only["timestamp"], "form_id": form_id, "user_id": uid}, **form5_only, **img_cols}
-        elif form_id == "form6":
-            form6_only = _form6_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form6_only["timestamp"], "form_id": form_id, "user_id": uid}, **form6_only, **img_cols}
-        elif form_id == "form7":
-            form7_only = _form7_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form7_only["timestamp"], "form_id": form_id, "user_id": uid}, **form7_only, **img_cols}
-        elif form_id == "form8":
-            form8_only = _form8_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form8_only["timestamp"], "form_id": form_id, "user_id": uid}, **form8_only, **img_cols}
-        elif form_id == "form9":
-            form9_only = _form9_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form9_only["timestamp"], "form_id": form_id, "user_id": uid}, **form9_only, **img_cols}
-        elif form_id == "form10":
-            form10_only = _form10_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            # form10 は URL 列は不要
-            img_cols.pop("image_url", None)
-            row = {**{"timestamp": form10_only["timestamp"], "form_id": form_id, "user_id": uid}, **form10_only, **img_cols}
-        elif form_id == "form11":
-            form11_only = _form11_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form11_only["timestamp"], "form_id": form_id, "user_id": uid}, **form11_only, **img_cols}
-        elif form_id == "form12":
-            form12_only = _form12_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form12_only["timestamp"], "form_id": form_id, "user_id": uid}, **form12_only, **img_cols}
-        elif form_id == "form13":
-            form13_only = _form13_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form13_only["timestamp"], "form_id": form_id, "user_id": uid}, **form13_only, **img_cols}
-        elif form_id == "form14":
-            form14_only = _form14_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form14_only["timestamp"], "form_id": form_id, "user_id": uid}, **form14_only, **img_cols}
-        elif form_id == "form15":
-            form15_only = _form15_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form15_only["timestamp"], "form_id": form_id, "user_id": uid}, **form15_only, **img_cols}
-        elif form_id == "form16":
-            form16_only = _form16_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form16_only["timestamp"], "form_id": form_id, "user_id": uid}, **form16_only, **img_cols}
-        elif form_id == "form17":
-            form17_only = _form17_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form17_only["timestamp"], "form_id": form_id, "user_id": uid}, **form17_only, **img_cols}
-        elif form_id == "form18":
-            form18_only = _form18_apply_order(row)
-            img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
-            row = {**{"timestamp": form18_only["timestamp"], "form_id": form_id, "user_id": uid}, **form18_only, **img_cols}
-        # 不要列をCSVから除外
-        for k in ("session", "form_id"):
-            row.pop(k, None)
+                conn.execute("ROLLBACK")
+                raise
+    except Exception as e:
+        print("⚠️ search index update failed:", e)
+
+
+def _search_backfill() -> int:
+    """既存のパーティションを索引へ取り込む（初回のみ。シャードのロック中に読むので保存と競合しない）"""
+    with _search_lock:
+        conn = _search_db()
+        if conn is None:
+            return 0
+        done = conn.execute("SELECT value FROM search_meta WHERE key = 'backfilled'").fetchone()
+    if done:
+        return 0
+    total = 0
+    for shard in _list_shards():
+        with _shard_lock(shard):
+            for name in _list_partitions(shard):
+                rows = list(_read_model_rows(os.path.join(_shard_dir(shard), f"{name}.csv")))
+                with _search_lock:
+                    conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        _search_write(conn, name, rows)
+                        conn.execute("COMMIT")
+                    except Exception:
+                        conn.execute("ROLLBACK")
+                        raise
+                total += len(rows)
+    with _search_lock:
+        conn.execute("INSERT OR REPLACE INTO search_meta (key, value) VALUES ('backfilled', ?)",
+                     (datetime.now().isoformat(timespec="seconds"),))
+    print(f"🔎 全文検索の索引: {total} 行を取り込みました")
+    return total
+
+
+def _search_snippet(body: str, terms: list[str]) -> str:
+    """最初に見つかった語の前後を切り出し、その範囲にあるすべての語を【】で囲む（LIKE で探した場合用）"""
+    # 長い語を先に試す（"高血圧" と "血圧" の両方が語にあれば長い方で囲む）
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(set(terms), key=len, reverse=True)), re.IGNORECASE)
+    hits = [(m.start(), m.end()) for m in pattern.finditer(body)]
+    if not hits:
+        return body[:_SEARCH_SNIPPET_CHARS * 2]
+    start = max(0, hits[0][0] - _SEARCH_SNIPPET_CHARS)
+    end = min(len(body), hits[0][1] + _SEARCH_SNIPPET_CHARS)
+    parts = []
+    pos = start
+    for hit_start, hit_end in hits:
+        if hit_start >= end:
+            break
+        # 範囲の端にかかった語は切らずに含める
+        end = max(end, hit_end)
+        parts.append(body[pos:hit_start] + "【" + body[hit_start:hit_end] + "】")
+        pos = hit_end
+    text = "".join(parts) + body[pos:end]
+    return ("…" if start else "") + text + ("…" if end < len(body) else "")
+
+
+def _search_answers(q: str, form_id: str | None = None, office_id: str | None = None,
+                    column: str | None = None, limit: int = 50) -> dict:
+    """
+    自由記述を検索する。空白区切りの語はすべて含むもの（AND）。
+    3 文字以上の語は trigram 索引で引き、2 文字以下の語は本文の部分一致で絞る。
+    """
+    terms = [t for t in str(q or "").split() if t]
+    if not terms:
+        raise ValueError("検索語が空です")
+    _store_flush()
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
+    where: list[str] = []
+    params: list = []
+    if form_id:
+        fid = str(form_id).strip()
+        where.append("d.form = ?")
+        params.append(_partition_name(f"form{fid}" if fid.isdigit() else fid))
+    if office_id:
+        where.append("d.office_id = ?")
+        params.append(str(office_id).strip())
+    if column:
+        where.append("d.col = ?")
+        params.append(column)
+    for t in short_terms:
+        escaped = t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        where.append("d.body LIKE ? ESCAPE '\\'")
+        params.append(f"%{escaped}%")
+    if long_terms:
+        match = " AND ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+        sql = (
+            "SELECT d.user_id, d.form, d.col, d.body, "
+            f"snippet(answer_text_fts, 0, '【', '】', '…', {_SEARCH_SNIPPET_CHARS // 2}) "
+            "FROM answer_text_fts JOIN answer_text d ON d.id = answer_text_fts.rowid "
+            "WHERE answer_text_fts MATCH ?"
+            + "".join(f" AND {w}" for w in where)
+            + " ORDER BY bm25(answer_text_fts) LIMIT ?"
+        )
+        params = [match] + params
+    else:
+        sql = (
+            "SELECT d.user_id, d.form, d.col, d.body, NULL FROM answer_text d"
+            + (" WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY d.user_id, d.form, d.col LIMIT ?"
+        )
+    params.append(max(1, int(limit)))
+    with _search_lock:
+        conn = _search_db()
+        if conn is None:
+            raise RuntimeError("全文検索は無効です（APOS_SEARCH / SQLite の FTS5 を確認してください）")
+        found = conn.execute(sql, params).fetchall()
+    hits = [
+        {
+            "user_id": uid,
+            "form_id": form,
+            "column": col,
+            "snippet": snippet if snippet and not short_terms else _search_snippet(body, terms),
+        }
+        for uid, form, col, body, snippet in found
+    ]
+    return {"hits": hits, "user_ids": sorted({h["user_id"] for h in hits})}
+
+
+@app.get("/api/search")
+async def search_answers(q: str, form_id: str | None = None, office_id: str | None = None,
+                         column: str | None = None, limit: int = 50):
+    """自由記述の全文検索（該当した user_id と、該当箇所を【】で囲んだ抜粋）"""
+    try:
+        result = await run_in_threadpool(_search_answers, q, form_id, office_id, column, limit)
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    return {"status": "ok", "query": q, "count": len(result["hits"]), **result}
+
+
+# ------------------------------------------------------------
+# 🔹 来訪履歴（保存ごとの版を差分で追記。最新版はこれまでどおりパーティション）
+# ------------------------------------------------------------
+# パーティションは1ユーザー1行で、再評価のたびに前回の回答を上書きしていた。_upsert_rows が書いた行ごとに
+# 「前回の版から変わった列だけ」を履歴ファイルへ追記する（HISTORY_KEYFRAME_EVERY 回ごと・初回は全列）。
+# 来訪のキーは (user_id, session)。session の無い保存は timestamp で区別する。
+# 最新版はパーティション（読み出しモデル）のままなので、エクスポートとプレフィルの読み出しは変わらない。
+#   records_parts/_history/<事業所>/form5.jsonl  1行 = {"u", "s", "t", "k"(全列なら1), "d": {列: 値}}
+# 履歴ファイルは追記のみ。user_id → 行の位置の索引をメモリに持ち、ファイルが伸びていれば伸びた分だけ読み足す。
+HISTORY_ENABLED = os.environ.get("APOS_HISTORY", "1").strip().lower() not in ("0", "false", "off", "")
+HISTORY_KEYFRAME_EVERY = max(1, int(os.environ.get("APOS_HISTORY_KEYFRAME_EVERY", "8")))
+
+_history_lock = threading.Lock()
+# 履歴ファイル → {"size": 索引済みのバイト数, "users": {user_id: [(位置, 全列か), ...]}}
+_history_index: dict[str, dict] = {}
+
+
+def _set_visit_session(row: dict, payload: dict, flattened: dict) -> None:
+    """来訪履歴のキーにする session を行に残す（session はレガシー列扱いなので CSV には書かれない）"""
+    session = str(payload.get("session") or flattened.get("session") or "").strip()
+    if session:
+        row["session"] = session
+
+
+def _history_path(user_id: str, name: str) -> str:
+    # シャード方式を変えても動かないよう、事業所番号で分ける
+    office = _office_of_user(user_id)
+    bucket = office if re.fullmatch(r"[0-9A-Za-z-]{1,64}", office) else hashlib.sha1(office.encode("utf-8")).hexdigest()[:12]
+    return os.path.join(RECORDS_PARTITION_DIR, "_history", f"o{bucket}", f"{name}.jsonl")
+
+
+def _history_sync(path: str) -> dict:
+    """索引を最新にする（別ワーカーが追記した分だけ読み足す。_history_lock 内で呼ぶ）"""
+    entry = _history_index.setdefault(path, {"size": 0, "users": {}})
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    if size < entry["size"]:
+        entry = _history_index[path] = {"size": 0, "users": {}}
+    if size > entry["size"]:
+        with open(path, "rb") as rf:
+            rf.seek(entry["size"])
+            pos = entry["size"]
+            for line in rf:
+                if not line.endswith(b"\n"):
+                    # 書きかけの行は次回読み直す
+                    break
+                with contextlib.suppress(ValueError):
+                    rec = json.loads(line)
+                    entry["users"].setdefault(rec.get("u", ""), []).append((pos, bool(rec.get("k"))))
+                pos += len(line)
+            entry["size"] = pos
+    return entry
+
+
+def _history_cell(k: str, v, one_hot_cols: set) -> str:
+    # CSV に書かれる値にそろえる（int の 0 と "0"、one-hot の空欄と "0" を同じ値として比べる）
+    v = "" if v is None else str(v)
+    return "0" if v == "" and k in one_hot_cols else v
+
+
+def _history_apply(path: str, changes: list[tuple[dict | None, dict]], sessions: list[str],
+                   one_hot_cols: set | None = None) -> None:
+    """_upsert_rows の書き込み後に呼ぶ: パーティションで変わった行を履歴へ追記する（失敗しても保存は止めない）"""
+    if not HISTORY_ENABLED or not changes:
+        return
+    if os.path.dirname(os.path.dirname(os.path.abspath(path))) != os.path.abspath(RECORDS_PARTITION_DIR):
+        return
+    name = os.path.basename(path)[:-4]
+    one_hot_cols = one_hot_cols or set()
+    by_file: dict[str, list[tuple[str, dict | None, dict, str]]] = {}
+    for (old, new), session in zip(changes, sessions):
+        uid = str(new.get("user_id", "") or "").strip()
+        if uid:
+            by_file.setdefault(_history_path(uid, name), []).append((uid, old, new, session))
+    try:
+        with _history_lock:
+            for hpath, items in by_file.items():
+                os.makedirs(os.path.dirname(hpath), exist_ok=True)
+                with open(hpath, "ab") as af:
+                    if fcntl is not None:
+                        fcntl.flock(af.fileno(), fcntl.LOCK_EX)
+                    try:
+                        entry = _history_sync(hpath)
+                        pos = entry["size"]
+                        chunks = []
+                        for uid, old, new, session in items:
+                            visits = entry["users"].setdefault(uid, [])
+                            since_key = next((i for i, (_p, k) in enumerate(reversed(visits)) if k), None)
+                            keyframe = old is None or since_key is None or since_key + 1 >= HISTORY_KEYFRAME_EVERY
+                            cells = {k: _history_cell(k, v, one_hot_cols) for k, v in new.items()}
+                            if old is not None:
+                                # timestamp は保存のたびに変わるので "t" にだけ持ち、差分の判定には使わない
+                                delta = {k: v for k, v in cells.items()
+                                         if k != "timestamp" and _history_cell(k, old.get(k), one_hot_cols) != v}
+                                if not delta:
+                                    # 何も変わっていない保存は全列の版の番でも書かない
+                                    continue
+                            if keyframe:
+                                delta = {k: v for k, v in cells.items() if v != ""}
+                            rec = {"u": uid, "s": session, "t": new.get("timestamp", ""), "k": 1 if keyframe else 0, "d": delta}
+                            line = (json.dumps(rec, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+                            visits.append((pos, keyframe))
+                            chunks.append(line)
+                            pos += len(line)
+                        af.write(b"".join(chunks))
+                        af.flush()
+                        entry["size"] = pos
+                    finally:
+                        if fcntl is not None:
+                            fcntl.flock(af.fileno(), fcntl.LOCK_UN)
+    except Exception as e:
+        # 索引は次回ファイルから作り直す
+        _history_index.clear()
+        print("⚠️ history append failed:", e)
+
+
+def _history_visits(user_id: str, name: str):
+    """1フォーム分の来訪を古い順に返す（差分を重ねて各版の全列を復元する）"""
+    path = _history_path(user_id, name)
+    with _history_lock:
+        entry = _history_sync(path)
+        offsets = list(entry["users"].get(user_id, ()))
+    if not offsets:
+        return
+    state: dict = {}
+    with open(path, "rb") as rf:
+        for pos, _keyframe in offsets:
+            rf.seek(pos)
+            rec = json.loads(rf.readline())
+            if rec.get("k"):
+                state = {}
+            state.update(rec.get("d") or {})
+            yield {
+                "form_id": name,
+                "session": rec.get("s", ""),
+                "timestamp": rec.get("t", ""),
+                "changed": sorted(rec.get("d") or {}) if not rec.get("k") else None,
+                "data": dict(state),
+            }
+
+
+def _history_names(user_id: str) -> list[str]:
+    directory = os.path.dirname(_history_path(user_id, "x"))
+    try:
+        return sorted(f[:-6] for f in os.listdir(directory) if f.endswith(".jsonl"))
+    except FileNotFoundError:
+        return []
+
+
+def _iter_history_ndjson(user_id: str, form_id: str | None = None,
+                         since: str | None = None, until: str | None = None):
+    """利用者の来訪を timestamp 順に1行1件の JSON で返す（フォームをまたいで時系列にマージ）"""
+    _store_flush(_shard_of_user(user_id))
+    names = [_partition_name(form_id)] if form_id else _history_names(user_id)
+    streams = [_history_visits(user_id, n) for n in names]
+    for visit in heapq.merge(*streams, key=lambda v: v["timestamp"]):
+        if since and visit["timestamp"] < since:
+            continue
+        if until and visit["timestamp"] > until:
+            continue
+        yield (json.dumps(visit, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+
+
+@app.get("/api/history")
+async def get_user_history(user_id: str, form_id: str | None = None,
+                           since: str | None = None, until: str | None = None):
+    """
+    利用者の来訪履歴（NDJSON）。1行 = 1回の保存で、data はその時点の全列、changed は前回から変わった列
+    （全列を記録した回は null）。最新版は /api/form{n}/prefill・エクスポートと同じパーティションの行。
+    """
+    uid = str(user_id or "").strip()
+    if not uid:
+        return {"status": "error", "message": "user_id is required"}
+    fid = str(form_id or "").strip()
+    return StreamingResponse(
+        _iter_history_ndjson(uid, f"form{fid}" if fid.isdigit() else fid or None, since, until),
+        media_type="application/x-ndjson",
+    )
+
+
+# ------------------------------------------------------------
+# 🔹 レコードストア（事業所シャード × フォーム別パーティション）
+# ------------------------------------------------------------
+# records.csv は全フォームの列を1行に持つため、form5 の保存でも form17 の薬剤列や画像列まで
+# 全ユーザー分を書き直していた。保存はフォームごとのパーティション（user_id キー、user_id 順）に分け、
+# 1ユーザー=1行の横持ちビューはエクスポート時にマージ結合で組み立てる。
+# さらに全事業所が同じファイルを共有しないよう、パーティションは事業所（office_id）単位の
+# シャードに置き、シャードごとのロックで別事業所の保存は並行して進められるようにする。
+#   records_parts/<shard>/form5.csv
+RECORDS_PARTITION_DIR = "/var/www/app/backend/app/records_parts"
+_PARTITION_MISC = "misc"
+# シャードの切り方: "office"（user_id 先頭の事業所番号）/ "hash"（user_id のハッシュで均等分散）
+RECORD_SHARD_MODE = os.environ.get("APOS_RECORD_SHARD_MODE", "office")
+RECORD_SHARD_COUNT = int(os.environ.get("APOS_RECORD_SHARD_COUNT", "16"))
+_STORE_LAYOUT_FILE = "layout.json"
+
+_shard_locks: dict[str, threading.Lock] = {}
+_shard_locks_guard = threading.Lock()
+
+
+def _office_of_user(user_id: str) -> str:
+    """user_id（{office_id}_{personal_id}）から事業所番号を取り出す"""
+    return str(user_id or "").strip().split("_", 1)[0]
+
+
+def _shard_of_user(user_id: str) -> str:
+    """user_id → シャード名（ディレクトリ名として安全な文字列）"""
+    uid = str(user_id or "").strip()
+    if RECORD_SHARD_MODE == "hash":
+        digest = hashlib.sha1(uid.encode("utf-8")).hexdigest()
+        return f"h{int(digest, 16) % max(1, RECORD_SHARD_COUNT):02d}"
+    office = _office_of_user(uid)
+    if office and re.fullmatch(r"[0-9A-Za-z-]{1,64}", office):
+        return f"o{office}"
+    # 記号や全角を含む事業所番号はハッシュ名にする
+    return "o" + hashlib.sha1(office.encode("utf-8")).hexdigest()[:12]
+
+
+def _shard_dir(shard: str, root: str | None = None) -> str:
+    # root はスナップショットのディレクトリ（省略時は現在のパーティション）
+    return os.path.join(root or RECORDS_PARTITION_DIR, shard)
+
+
+@contextlib.contextmanager
+def _shard_lock(shard: str):
+    """シャード単位の排他（スレッド間は threading.Lock、ワーカープロセス間は flock）"""
+    with _shard_locks_guard:
+        lock = _shard_locks.setdefault(shard, threading.Lock())
+    with lock:
+        os.makedirs(_shard_dir(shard), exist_ok=True)
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(_shard_dir(shard), ".lock"), "a") as lf:
+            fcntl.flock(lf.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lf.fileno(), fcntl.LOCK_UN)
+
+
+def _partition_name(form_id) -> str:
+    """form_id → パーティション名（form0〜form19 以外は misc にまとめる）"""
+    fid = str(form_id or "").strip().lower()
+    return fid if re.fullmatch(r"form\d{1,2}", fid) else _PARTITION_MISC
+
+
+def _partition_path(shard: str, form_id) -> str:
+    return os.path.join(_shard_dir(shard), f"{_partition_name(form_id)}.csv")
+
+
+def _partition_master_header(form_id) -> list[str]:
+    """パーティションの固定スキーマ（そのフォームの FORMn_ORDER のみ）"""
+    name = _partition_name(form_id)
+    header = ["timestamp", "user_id"]
+    order = globals().get(f"{name.upper()}_ORDER") if name != _PARTITION_MISC else None
+    for col in list(order or []) + ["image_file", "image_url"]:
+        if col not in header:
+            header.append(col)
+    return header
+
+
+def _list_shards() -> list[str]:
+    try:
+        return sorted(
+            d for d in os.listdir(RECORDS_PARTITION_DIR)
+            if not d.startswith("_") and os.path.isdir(os.path.join(RECORDS_PARTITION_DIR, d))
+        )
+    except FileNotFoundError:
+        return []
+
+
+def _list_partitions(shard: str, root: str | None = None) -> list[str]:
+    """シャード内に存在するパーティション名（form番号順、misc は最後）"""
+    try:
+        names = [f[:-4] for f in os.listdir(_shard_dir(shard, root)) if f.endswith(".csv")]
+    except FileNotFoundError:
+        return []
+
+    def order(n: str):
+        m = re.fullmatch(r"form(\d+)", n)
+        return (0, int(m.group(1)), n) if m else (1, 0, n)
+
+    return sorted(names, key=order)
+
+
+def _store_has_data() -> bool:
+    return any(_list_partitions(s) for s in _list_shards())
+
+
+def _partition_header(shard: str, name: str, root: str | None = None) -> list[str]:
+    return _read_header(os.path.join(_shard_dir(shard, root), f"{name}.csv")) or []
+
+
+def _wide_header(shards: list[str], root: str | None = None) -> list[str]:
+    """横持ちビューのヘッダ（マスタヘッダ + 各パーティションの追加列）"""
+    drop_columns = _legacy_drop_columns()
+    header = [h for h in _master_header(include_ids=True) if h not in drop_columns]
+    seen = set(header)
+    for shard in shards:
+        for name in _list_partitions(shard, root):
+            for col in _partition_header(shard, name, root):
+                if col not in seen and col not in drop_columns:
+                    header.append(col)
+                    seen.add(col)
+    return header
+
+
+def _iter_partition_rows(shard: str, name: str, root: str | None = None):
+    """パーティションを user_id 順に読み出す（(user_id, 行) を返す。root 指定時はスナップショットの版）"""
+    if root:
+        rows = _snapshot_rows(os.path.join(_shard_dir(shard, root), f"{name}.csv"),
+                              os.path.join(_shard_dir(shard), f"{name}.csv"))
+    else:
+        rows = _read_model_rows(os.path.join(_shard_dir(shard), f"{name}.csv"))
+    for r in rows:
+        yield str(r.get("user_id", "")).strip(), r
+
+
+def _merge_user_rows(parts: list[dict]) -> dict:
+    """同一ユーザーの各パーティション行を timestamp 順に重ねる（後勝ち＝従来の choose_value と同じ）"""
+    merged: dict = {}
+    for r in sorted(parts, key=lambda x: str(x.get("timestamp", ""))):
+        merged.update(r)
+    return merged
+
+
+def _iter_merged_rows(shard: str, header: list[str], root: str | None = None):
+    """
+    シャード内の各パーティションを user_id でストリーミングにマージ結合し、1ユーザー=1行の横持ち行を返す。
+    パーティションは user_id 順に保存されているため、全件をメモリに載せずに済む。
+    """
+    one_hot_cols = {k for k in header if _is_one_hot_col(k, _infer_one_hot_bases(header))}
+    streams = [
+        ((uid, pi, r) for uid, r in _iter_partition_rows(shard, name, root))
+        for pi, name in enumerate(_list_partitions(shard, root))
+    ]
+    current_uid = None
+    group: list[dict] = []
+
+    def emit(parts: list[dict]) -> dict:
+        merged = _merge_user_rows(parts)
+        out = {}
+        for k in header:
+            v = merged.get(k, "")
+            if (v == "" or v is None) and k in one_hot_cols:
+                v = "0"
+            out[k] = v
+        return out
+
+    for uid, _pi, r in heapq.merge(*streams, key=lambda t: (t[0], t[1])):
+        if group and uid != current_uid:
+            yield emit(group)
+            group = []
+        current_uid = uid
+        group.append(r)
+    if group:
+        yield emit(group)
+
+
+def _store_read_user(user_id: str) -> dict | None:
+    """指定ユーザーの横持ち行（そのユーザーのシャードだけを走査して結合）"""
+    uid = str(user_id or "").strip()
+    if not uid:
+        return None
+    shard = _shard_of_user(uid)
+    _store_flush(shard)
+    parts: list[dict] = []
+    for name in _list_partitions(shard):
+        r = _read_model_row(os.path.join(_shard_dir(shard), f"{name}.csv"), uid)
+        if r is not None:
+            parts.append(r)
+    return _merge_user_rows(parts) if parts else None
+
+
+def _store_read_partition(user_id: str, form_id) -> dict | None:
+    """指定ユーザーの1フォーム分の行（そのパーティションだけを引く）"""
+    uid = str(user_id or "").strip()
+    if not uid:
+        return None
+    shard = _shard_of_user(uid)
+    _store_flush(shard)
+    return _read_model_row(_partition_path(shard, form_id), uid)
+
+
+def _export_shards(office_id: str | None = None) -> list[str]:
+    """エクスポート対象のシャード（事業所指定時は、その事業所のシャードだけ）"""
+    shards = _list_shards()
+    if office_id and RECORD_SHARD_MODE != "hash":
+        target = _shard_of_user(f"{office_id}_")
+        return [s for s in shards if s == target]
+    return shards
+
+
+def _iter_shard_csv_chunks(shard: str, header: list[str], office_id: str | None = None, chunk_size: int = 64 * 1024,
+                           user_ids: set[str] | None = None, root: str | None = None, progress: dict | None = None):
+    """
+    1シャード分の横持ち行を CSV 本文（ヘッダ無し）のチャンクとして生成する（user_ids 指定時はその利用者のみ）。
+    progress を渡すと {シャード: 書いた行数} を更新する（シャードごとに別スレッドなのでキーを分ける）。
+    """
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=header)
+    for r in _iter_merged_rows(shard, header, root):
+        if office_id and _office_of_user(r.get("user_id", "")) != office_id:
+            continue
+        if user_ids is not None and str(r.get("user_id", "")).strip() not in user_ids:
+            continue
+        writer.writerow(r)
+        if progress is not None:
+            progress[shard] = progress.get(shard, 0) + 1
+        if buf.tell() >= chunk_size:
+            yield buf.getvalue().encode("utf-8")
+            buf.seek(0)
+            buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue().encode("utf-8")
+
+
+def _prefetch_in_threads(factories: list, max_workers: int = 4, depth: int = 8):
+    """
+    複数のジェネレータをスレッドで並行に先読みし、元の順番どおりに連結して返す。
+    各ジェネレータの先読みは depth チャンクまで（メモリ上限）。
+    """
+    if not factories:
+        return
+    done = object()
+    queues = [queue.Queue(maxsize=depth) for _ in factories]
+    cancelled = threading.Event()
+
+    def put(q, item) -> bool:
+        # 読み手が中断した（cancelled）後は積まずに抜ける（満杯のキューで止まったままにしない）
+        while not cancelled.is_set():
+            try:
+                q.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run(factory, q):
+        try:
+            for chunk in factory():
+                if not put(q, chunk):
+                    return
+        except Exception as e:
+            put(q, e)
+        finally:
+            put(q, done)
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(factories))))
+    try:
+        for factory, q in zip(factories, queues):
+            pool.submit(run, factory, q)
+        for q in queues:
+            while True:
+                item = q.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False)
+
+
+def _iter_export_csv(office_id: str | None = None, user_ids: set[str] | None = None, progress: dict | None = None):
+    """
+    横持ちビューを CSV（BOM付き UTF-8）のチャンクとして逐次生成する（シャードは並行に先読み）。
+    開始時点のスナップショットから読むので、送信中の保存はこのダウンロードに混ざらず、保存も待たせない。
+    """
+    shards = _export_shards(office_id)
+    if user_ids is not None:
+        wanted = {_shard_of_user(u) for u in user_ids}
+        shards = [s for s in shards if s in wanted]
+    with _store_snapshot(shards) as root:
+        header = _wide_header(shards, root)
+        buf = io.StringIO()
+        buf.write("\ufeff")
+        csv.DictWriter(buf, fieldnames=header).writeheader()
+        yield buf.getvalue().encode("utf-8")
+        yield from _prefetch_in_threads([
+            (lambda s=s: _iter_shard_csv_chunks(s, header, office_id, user_ids=user_ids, root=root, progress=progress))
+            for s in shards
+        ])
+
+
+def _export_records_response(filename: str = "records.csv", office_id: str | None = None):
+    """本番CSVのレスポンス（パーティションがあれば結合ビュー、無ければ従来の records.csv）"""
+    _store_flush()
+    if _store_has_data():
+        return StreamingResponse(
+            _iter_export_csv(office_id),
+            media_type="text/csv",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+    if os.path.exists(RECORDS_CSV_PATH) and not office_id:
+        return FileResponse(RECORDS_CSV_PATH, media_type="text/csv", filename=filename)
+    return None
+
+
+def _store_bulk_upsert(rows_by_partition: dict[str, list[dict]], newer_only: bool = False) -> int:
+    """
+    {パーティション名: 行リスト} をシャードごとにまとめて反映する（各パーティションの書き換えは1回）。
+    newer_only=True なら、保存済みの行より timestamp の古い行は反映しない（後追いの取り込みで新しい回答を戻さない）。
+    """
+    per_shard: dict[str, dict[str, list[dict]]] = {}
+    for name, rows in rows_by_partition.items():
+        for r in rows:
+            uid = str(r.get("user_id", "") or "").strip()
+            if uid:
+                per_shard.setdefault(_shard_of_user(uid), {}).setdefault(name, []).append(r)
+    written = 0
+    for shard, parts in per_shard.items():
+        with _shard_lock(shard):
+            for name, rows in parts.items():
+                if newer_only:
+                    current = {uid: str(r.get("timestamp", "")) for uid, r in _iter_partition_rows(shard, name)}
+                    rows = [r for r in rows
+                            if str(r.get("timestamp", "")) >= current.get(str(r.get("user_id", "")).strip(), "")]
+                    if not rows:
+                        continue
+                written += _upsert_rows(
+                    _partition_path(shard, name), rows, KEY_FIELDS,
+                    master_header=_partition_master_header(name), sort_key="user_id",
+                )
+                _journal_mark_dirty(shard, name)
+    return written
+
+
+def _read_store_layout() -> dict:
+    try:
+        with open(os.path.join(RECORDS_PARTITION_DIR, _STORE_LAYOUT_FILE), "r", encoding="utf-8") as rf:
+            return json.load(rf)
+    except Exception:
+        return {}
+
+
+def _write_store_layout(layout: dict) -> None:
+    os.makedirs(RECORDS_PARTITION_DIR, exist_ok=True)
+    path = os.path.join(RECORDS_PARTITION_DIR, _STORE_LAYOUT_FILE)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as wf:
+        json.dump(layout, wf, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def _current_shard_layout() -> dict:
+    return {"shard_mode": RECORD_SHARD_MODE, "shard_count": RECORD_SHARD_COUNT if RECORD_SHARD_MODE == "hash" else None}
+
+
+def _reshard_leftovers() -> list[str]:
+    """中断した再配置が退避したまま残したファイル（formN.csv.resharded.*。古い順）"""
+    found = []
+    for directory in [RECORDS_PARTITION_DIR] + [_shard_dir(s) for s in _list_shards()]:
+        try:
+            found += [os.path.join(directory, f) for f in os.listdir(directory) if ".csv.resharded" in f]
+        except FileNotFoundError:
+            continue
+    return sorted(found, key=os.path.getmtime)
+
+
+def _reshard_store() -> int:
+    """
+    シャード方式（layout.json）が現在の設定と異なる場合、全パーティションを読み直して振り分け直す。
+    シャード導入前の直下パーティション（records_parts/formN.csv）もここで取り込む。
+    前回の再配置が途中で落ちていれば、退避ファイルから読み直してやり直す。
+    """
+    layout = _read_store_layout()
+    want = _current_shard_layout()
+    flat = []
+    try:
+        flat = [f for f in os.listdir(RECORDS_PARTITION_DIR) if f.endswith(".csv")]
+    except FileNotFoundError:
+        pass
+    leftovers = _reshard_leftovers()
+    if not flat and not leftovers and (not _list_shards() or {k: layout.get(k) for k in want} == want):
+        _write_store_layout({**layout, **want})
+        return 0
+    buckets: dict[str, list[dict]] = {}
+    # 退避ファイルを先に読み、その後に書かれた現在のパーティションの行を後から重ねる
+    for path in leftovers:
+        with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+            buckets.setdefault(os.path.basename(path).split(".csv.resharded", 1)[0], []).extend(csv.DictReader(rf))
+    sources: list[str] = []
+    for f in flat:
+        path = os.path.join(RECORDS_PARTITION_DIR, f)
+        sources.append(path)
+        with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+            buckets.setdefault(f[:-4], []).extend(csv.DictReader(rf))
+    for shard in _list_shards():
+        for name in _list_partitions(shard):
+            path = os.path.join(_shard_dir(shard), f"{name}.csv")
+            sources.append(path)
+            with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+                buckets.setdefault(name, []).extend(csv.DictReader(rf))
+    # 読み込んだ旧ファイルは退避してから書き直す（同名パスへの書き込みと衝突しないように）。
+    # 退避ファイルは書き直しが終わるまで消さない（途中で落ちても次回の起動でここから読み直す）
+    suffix = f".resharded.{time.time_ns():x}"
+    for path in sources:
+        os.replace(path, f"{path}{suffix}")
+    moved = _store_bulk_upsert(buckets)
+    for path in leftovers + [f"{p}{suffix}" for p in sources]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    # 空になった旧シャードのディレクトリを片付ける
+    for shard in _list_shards():
+        if not _list_partitions(shard):
+            try:
+                lock_path = os.path.join(_shard_dir(shard), ".lock")
+                if os.path.exists(lock_path):
+                    os.remove(lock_path)
+                os.rmdir(_shard_dir(shard))
+            except OSError:
+                pass
+    _write_store_layout({**layout, **want})
+    print(f"📦 レコードストアのシャード再配置: {moved} 行 → {want}")
+    return moved
+
+
+def _migrate_legacy_records_csv() -> int:
+    """
+    既存の records.csv（横持ち）をフォーム別パーティションへ分割する（パーティションが空の時のみ1回）。
+    列は FORMn_ORDER に従って振り分け、どのフォームにも属さない列は misc へ入れる。
+    """
+    if _store_has_data() or not os.path.exists(RECORDS_CSV_PATH):
+        return 0
+    col_to_parts: dict[str, list[str]] = {}
+    for i in range(0, 20):
+        for col in globals().get(f"FORM{i}_ORDER", []):
+            if col in ("timestamp", "user_id"):
+                continue
+            col_to_parts.setdefault(col, []).append(f"form{i}")
+    buckets: dict[str, list[dict]] = {}
+    with open(RECORDS_CSV_PATH, "r", encoding="utf-8-sig", newline="") as rf:
+        for r in csv.DictReader(rf):
+            uid = str(r.get("user_id", "")).strip()
+            if not uid:
+                continue
+            per_part: dict[str, dict] = {}
+            for col, v in r.items():
+                if col in ("timestamp", "user_id") or col is None:
+                    continue
+                for name in col_to_parts.get(col, [_PARTITION_MISC]):
+                    per_part.setdefault(name, {})[col] = v
+            for name, cols in per_part.items():
+                # 未回答（空欄/0のみ）のフォームは行を作らない
+                if all(str(v).strip() in ("", "0") for v in cols.values()):
+                    continue
+                buckets.setdefault(name, []).append({"timestamp": r.get("timestamp", ""), "user_id": uid, **cols})
+    migrated = _store_bulk_upsert(buckets)
+    _write_store_layout({**_read_store_layout(), **_current_shard_layout()})
+    print(f"📦 records.csv → パーティション分割: {migrated} 行 ({len(buckets)} パーティション)")
+    return migrated
+
+
+# ------------------------------------------------------------
+# 🔹 スナップショット（エクスポート用の時点固定ビュー）
+# ------------------------------------------------------------
+# エクスポートはシャード・パーティションを順に読むため、送信中に保存が入ると「前半は古い版・後半は新しい版」の
+# 混ざった CSV になりうる。パーティションの書き換えは常に tmp → os.replace（既存ファイルは書き換えない）なので、
+# 開始時に対象シャードのロックをまとめて取り、各パーティションを _snapshots/<id>/ にハードリンクすれば、
+# その時点の版を不変のファイルとして固定できる（ロックはリンクを作る間だけ。送信中の保存は待たされない）。
+# 送信が終われば（中断でも）ディレクトリを消し、置き換え済みの古い版はそこで解放される。
+# 落ちたワーカーが残したものは、所有プロセスがいない・APOS_SNAPSHOT_MAX_AGE_SEC を過ぎたものを掃除する。
+SNAPSHOT_MAX_AGE_SEC = float(os.environ.get("APOS_SNAPSHOT_MAX_AGE_SEC", str(6 * 3600)))
+_SNAPSHOT_DIRNAME = "_snapshots"
+
+_snapshot_lock = threading.Lock()
+_snapshot_seq = 0
+# このプロセスで使用中のスナップショット
+_snapshot_active: set[str] = set()
+
+
+def _snapshot_root() -> str:
+    return os.path.join(RECORDS_PARTITION_DIR, _SNAPSHOT_DIRNAME)
+
+
+def _snapshot_create(shards: list[str]) -> str:
+    """保留中の書き込みを反映し、対象シャードの現在の版をハードリンクで固定する（戻り値はスナップショットのディレクトリ）"""
+    global _snapshot_seq
+    _store_flush()
+    _snapshot_gc()
+    with _snapshot_lock:
+        _snapshot_seq += 1
+        root = os.path.join(_snapshot_root(), f"{time.time_ns():x}-{os.getpid()}-{_snapshot_seq}")
+        _snapshot_active.add(root)
+    try:
+        with contextlib.ExitStack() as stack:
+            # 全シャードで同じ時点にそろえる（デッドロックしないよう名前順に取る）
+            for shard in sorted(set(shards)):
+                stack.enter_context(_shard_lock(shard))
+            for shard in shards:
+                names = _list_partitions(shard)
+                if names:
+                    os.makedirs(_shard_dir(shard, root), exist_ok=True)
+                for name in names:
+                    src = os.path.join(_shard_dir(shard), f"{name}.csv")
+                    dst = os.path.join(_shard_dir(shard, root), f"{name}.csv")
+                    try:
+                        os.link(src, dst)
+                    except FileNotFoundError:
+                        continue
+                    except OSError:
+                        # ハードリンクできないファイルシステムではコピー（ロック中なので内容は同じ時点）
+                        shutil.copyfile(src, dst)
+    except Exception:
+        _snapshot_release(root)
+        raise
+    return root
+
+
+def _snapshot_release(root: str) -> None:
+    with _snapshot_lock:
+        _snapshot_active.discard(root)
+    shutil.rmtree(root, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def _store_snapshot(shards: list[str]):
+    """with の間だけ有効なスナップショット（ジェネレータ内で使えば、送信の完了・中断で解放される）"""
+    root = _snapshot_create(shards)
+    try:
+        yield root
+    finally:
+        _snapshot_release(root)
+
+
+def _snapshot_gc() -> int:
+    """所有プロセスがいない、または APOS_SNAPSHOT_MAX_AGE_SEC を過ぎたスナップショットを消す（戻り値は消した数）"""
+    try:
+        entries = os.listdir(_snapshot_root())
+    except FileNotFoundError:
+        return 0
+    removed = 0
+    now = time.time()
+    for entry in entries:
+        root = os.path.join(_snapshot_root(), entry)
+        with _snapshot_lock:
+            if root in _snapshot_active:
+                continue
+        try:
+            pid = int(entry.split("-")[1])
+            created = int(entry.split("-")[0], 16) / 1e9
+        except (IndexError, ValueError):
+            pid, created = None, 0.0
+        alive = pid is not None and pid != os.getpid() and _pid_alive(pid)
+        if alive and now - created < SNAPSHOT_MAX_AGE_SEC:
+            continue
+        shutil.rmtree(root, ignore_errors=True)
+        removed += 1
+    return removed
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        # 別ユーザーのプロセス・Windows では判定できないので生きている扱い（期限で消す）
+        return True
+    return True
+
+
+def _pid_start_token(pid: int) -> str | None:
+    """プロセスの起動時刻（/proc/<pid>/stat の starttime）。pid の再利用を見分けるのに使う（取れない環境では None）"""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as rf:
+            stat = rf.read()
+        # comm に空白や括弧が入ることがあるので最後の ")" の後ろから数える
+        return stat[stat.rindex(b")") + 2:].split()[19].decode("ascii")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _snapshot_rows(path: str, live_path: str):
+    """
+    スナップショットのファイルの全行を dict で返す。
+    ライブのパーティションがまだ同じ版（同じ inode・mtime・サイズ）で読み出しモデルにあればメモリから読む。
+    """
+    sig = _file_sig(path)
+    with _read_model_lock:
+        entry = _read_model.get(live_path)
+    if sig is not None and entry is not None and entry[0] == sig:
+        header = entry[1]
+        for vals in list(entry[2].values()):
+            yield dict(zip(header, vals))
+        return
+    try:
+        with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+            yield from csv.DictReader(rf)
+    except FileNotFoundError:
+        return
+
+
+# ------------------------------------------------------------
+# 🔹 ストアのスキーマ移行（layout.json の schema_version まで1回ずつ適用）
+# ------------------------------------------------------------
+# 保存のたびに既存ヘッダと全行からレガシー列（_legacy_drop_columns）を除去していた。移行は版番号つきで
+# 登録し、起動時に layout.json の schema_version より新しいものだけを全パーティションへ1回ずつ流して版を記録する。
+# 版が最新のストアのパーティションへの保存では、既存行の除去を省く（新しい行のレガシー列は引き続きヘッダに足さない）。
+# 移行はシャードのロック中にファイルを1行ずつ書き直し、ジャーナルの base も移行後の版に取り直す。
+STORE_SCHEMA_VERSION = 1
+
+# 移行済みと確認できたストアの版（起動時の移行が終わるまでは 0 = 従来どおり除去する）
+_store_schema_version = 0
+
+
+def _store_schema_current(path: str) -> bool:
+    """path が最新版まで移行済みのストアのパーティションか"""
+    if _store_schema_version < STORE_SCHEMA_VERSION:
+        return False
+    parent = os.path.dirname(os.path.dirname(os.path.abspath(path)))
+    return parent == os.path.abspath(RECORDS_PARTITION_DIR)
+
+
+def _rewrite_partition_columns(path: str, keep) -> bool:
+    """パーティションから keep(列名) が偽の列を除いて1行ずつ書き直す（除く列が無ければ何もしない）"""
+    with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+        reader = csv.reader(rf)
+        header = next(reader, None)
+        if header is None:
+            return False
+        idx = [i for i, col in enumerate(header) if keep(col)]
+        if len(idx) == len(header):
+            return False
+        tmp_path = f"{path}.migrate"
+        with open(tmp_path, "w", encoding="utf-8-sig", newline="") as wf:
+            writer = csv.writer(wf)
+            writer.writerow([header[i] for i in idx])
+            for r in reader:
+                writer.writerow([r[i] if i < len(r) else "" for i in idx])
+    os.replace(tmp_path, path)
+    _read_model_drop(path)
+    return True
+
+
+def _migration_drop_legacy_columns(path: str) -> bool:
+    drop_columns = _legacy_drop_columns()
+    return _rewrite_partition_columns(path, lambda col: col not in drop_columns)
+
+
+# (版, 内容, パーティション1つを移行する関数（書き換えたら True）)
+_STORE_MIGRATIONS: list[tuple[int, str, object]] = [
+    (1, "レガシー列（旧 activity_*・back_curv・form3 ベース列・fatigue_2..10 等・med_name_*）の除去",
+     _migration_drop_legacy_columns),
+]
+
+
+def _migrate_store_schema() -> int:
+    """起動時: 未適用のスキーマ移行を順に全パーティションへ適用し、layout.json に版を記録する（戻り値は書き換えたファイル数）"""
+    global _store_schema_version
+    version = int(_read_store_layout().get("schema_version") or 0)
+    rewritten = 0
+    if not _store_has_data():
+        # 空のストアは最新の書式でしか作られない
+        version = STORE_SCHEMA_VERSION
+    for target, title, migrate in _STORE_MIGRATIONS:
+        if target <= version:
+            continue
+        started = time.time()
+        changed = 0
+        for shard in _list_shards():
+            with _shard_lock(shard):
+                for name in _list_partitions(shard):
+                    if migrate(os.path.join(_shard_dir(shard), f"{name}.csv")):
+                        changed += 1
+                        if _journal_enabled():
+                            _journal_snapshot_partition(shard, name)
+        version = target
+        _write_store_layout({**_read_store_layout(), "schema_version": version})
+        rewritten += changed
+        print(f"📦 スキーマ移行 v{target}: {title} / {changed} ファイル ({time.time() - started:.1f} 秒)")
+    if int(_read_store_layout().get("schema_version") or 0) != version:
+        _write_store_layout({**_read_store_layout(), "schema_version": version})
+    _store_schema_version = version
+    return rewritten
+
+
+# ------------------------------------------------------------
+# 🔹 ジャーナル（先行書き込みログ + まとめて fsync）
+# ------------------------------------------------------------
+# パーティションの書き換え（tmp → os.replace）は fsync しないため、電源断で空や途中のファイルが
+# 残りうる。毎回の全体書き換えに fsync を入れるのは遅すぎるので、保存内容を先にジャーナルへ
+# 1行ずつ追記し、fsync は N ミリ秒ごと / M 件ごとにまとめて行う（グループコミット）。
+# チェックポイントで書き換え済みのパーティションを fsync し、その版を base/ にハードリンクで
+# 残してから古いジャーナルを消す。起動時は残っているジャーナルを base の上に再適用する。
+# - strict : fsync 完了まで応答を待つ（応答済みの保存は電源断でも失われない）
+# - group  : fsync を待たずに応答する（最大 N ミリ秒分を失いうる代わりに速い）
+# - off    : ジャーナル無し（従来どおり）
+RECORD_JOURNAL_MODE = os.environ.get("APOS_JOURNAL_MODE", "group").strip().lower()
+RECORD_JOURNAL_FSYNC_MS = float(os.environ.get("APOS_JOURNAL_FSYNC_MS", "20"))
+RECORD_JOURNAL_FSYNC_RECORDS = int(os.environ.get("APOS_JOURNAL_FSYNC_RECORDS", "64"))
+# ジャーナルがこのサイズを超えたらチェックポイント
+RECORD_JOURNAL_CHECKPOINT_BYTES = int(os.environ.get("APOS_JOURNAL_CHECKPOINT_BYTES", str(16 * 1024 * 1024)))
+_JOURNAL_DIRNAME = "_journal"
+
+_journal_cond = threading.Condition()
+_journal_fsync_lock = threading.Lock()
+_journal_ckpt_lock = threading.Lock()
+_journal_fp = None
+_journal_segments: list[str] = []
+_journal_seq = 0
+_journal_lsn = 0
+_journal_synced = 0
+_journal_first_pending: float | None = None
+_journal_bytes = 0
+_journal_active = 0
+_journal_rotating = False
+_journal_dirty: set[tuple[str, str]] = set()
+# 稼働中のセグメント → fsync 済みのバイト数（アウトボックスはここまでしか配送しない）。
+# 別ワーカーの配送役にも見えるよう <セグメント>.synced にも書く
+_journal_synced_pos: dict[str, int] = {}
+_journal_synced_fds: dict[str, int] = {}
+_journal_thread: threading.Thread | None = None
+
+
+def _journal_enabled() -> bool:
+    return RECORD_JOURNAL_MODE in ("group", "strict")
+
+
+def _journal_dir() -> str:
+    return os.path.join(RECORDS_PARTITION_DIR, _JOURNAL_DIRNAME)
+
+
+def _journal_base_path(shard: str, name: str) -> str:
+    return os.path.join(_journal_dir(), "base", shard, f"{name}.csv")
+
+
+def _fsync_path(path: str, directory: bool = False) -> None:
+    """ファイル（directory=True ならディレクトリのエントリ）をディスクへ確定させる"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Windows ではディレクトリを開けない
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        if not directory:
+            raise
+    finally:
+        os.close(fd)
+
+
+def _link_or_copy(src: str, dst: str) -> None:
+    """src と同じ内容の dst を作る（ハードリンクできないファイルシステムではコピー）"""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+        _fsync_path(dst)
+
+
+def _journal_encode(shard: str, name: str, row: dict, form_id=None) -> bytes:
+    rec = {"t": time.time(), "s": shard, "p": name, "r": row}
+    if form_id is not None:
+        # misc パーティションでも元の form_id で配送できるように残す
+        rec["f"] = str(form_id)
+    body = json.dumps(rec, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+    return b"%08x " % (zlib.crc32(body) & 0xFFFFFFFF) + body + b"\n"
+
+
+def _journal_decode(raw: bytes) -> dict | None:
+    """1行を復元する。書きかけ（改行無し・CRC 不一致）なら None"""
+    if not raw.endswith(b"\n"):
+        return None
+    try:
+        crc, body = raw[:-1].split(b" ", 1)
+        if int(crc, 16) != zlib.crc32(body) & 0xFFFFFFFF:
+            return None
+        rec = json.loads(body.decode("utf-8"))
+    except Exception:
+        return None
+    return rec if isinstance(rec, dict) and isinstance(rec.get("r"), dict) else None
+
+
+def _journal_open_locked():
+    """追記先のセグメントを開く（_journal_cond を保持して呼ぶ）"""
+    global _journal_fp, _journal_seq
+    if _journal_fp is not None:
+        return _journal_fp
+    os.makedirs(_journal_dir(), exist_ok=True)
+    _journal_seq += 1
+    path = os.path.join(_journal_dir(), f"{os.getpid()}-{time.time_ns()}-{_journal_seq:06d}.wal")
+    fp = open(path, "ab")
+    if fcntl is not None:
+        # 稼働中のワーカーのセグメントは、他ワーカーの起動時の再適用から外す
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+    _fsync_path(_journal_dir(), directory=True)
+    _journal_fp = fp
+    _journal_segments.append(path)
+    return fp
+
+
+def _journal_append(shard: str, name: str, row: dict, form_id=None) -> int:
+    """1件追記して通し番号（lsn）を返す。fsync は同期スレッドがまとめて行う"""
+    global _journal_lsn, _journal_bytes, _journal_first_pending
+    line = _journal_encode(shard, name, row, form_id)
+    with _journal_cond:
+        fp = _journal_open_locked()
+        fp.write(line)
+        fp.flush()
+        _journal_lsn += 1
+        _journal_bytes += len(line)
+        if _journal_first_pending is None:
+            _journal_first_pending = time.monotonic()
+        lsn = _journal_lsn
+        _journal_cond.notify_all()
+    _ensure_journal_thread()
+    _ensure_outbox_thread()
+    return lsn
+
+
+def _journal_wait(lsn: int) -> None:
+    """lsn までの fsync 完了を待つ"""
+    with _journal_cond:
+        while _journal_synced < lsn:
+            _journal_cond.wait(timeout=1.0)
+
+
+def _journal_mark_synced(path: str, pos: int) -> None:
+    """セグメントの fsync 済みの位置を記録する（_journal_fsync_lock を保持して呼ぶ）"""
+    fd = _journal_synced_fds.get(path)
+    if fd is None:
+        fd = os.open(f"{path}.synced", os.O_CREAT | os.O_WRONLY, 0o644)
+        _journal_synced_fds[path] = fd
+    os.lseek(fd, 0, os.SEEK_SET)
+    os.write(fd, b"%016x" % pos)
+    with _journal_cond:
+        _journal_synced_pos[path] = pos
+
+
+def _journal_drop_synced_mark(path: str) -> None:
+    """書き終えたセグメントの fsync 位置の記録を消す（以降は全体が確定済み）"""
+    with _journal_cond:
+        _journal_synced_pos.pop(path, None)
+    fd = _journal_synced_fds.pop(path, None)
+    if fd is not None:
+        os.close(fd)
+    with contextlib.suppress(OSError):
+        os.remove(f"{path}.synced")
+
+
+def _journal_synced_size(path: str) -> int:
+    """稼働中のセグメントの fsync 済みのバイト数（このプロセスの分はメモリ、別ワーカーの分は .synced から。不明なら 0）"""
+    with _journal_cond:
+        pos = _journal_synced_pos.get(path)
+    if pos is not None:
+        return pos
+    try:
+        with open(f"{path}.synced", "rb") as rf:
+            return int(rf.read(16) or b"0", 16)
+    except (OSError, ValueError):
+        return 0
+
+
+def _journal_sync_now() -> None:
+    global _journal_synced, _journal_first_pending
+    with _journal_fsync_lock:
+        with _journal_cond:
+            target, fp = _journal_lsn, _journal_fp
+            path = _journal_segments[-1] if fp is not None else None
+            end = fp.tell() if fp is not None else 0
+        if fp is not None and target > _journal_synced:
+            os.fsync(fp.fileno())
+            _journal_mark_synced(path, end)
+        with _journal_cond:
+            _journal_synced = max(_journal_synced, target)
+            _journal_first_pending = None if _journal_synced >= _journal_lsn else time.monotonic()
+            _journal_cond.notify_all()
+
+
+def _journal_loop():
+    """N ミリ秒経過か M 件溜まった時点でまとめて fsync するバックグラウンドスレッド"""
+    while True:
+        with _journal_cond:
+            while _journal_synced >= _journal_lsn:
+                _journal_cond.wait()
+            deadline = (_journal_first_pending or time.monotonic()) + RECORD_JOURNAL_FSYNC_MS / 1000.0
+            while (_journal_lsn - _journal_synced < RECORD_JOURNAL_FSYNC_RECORDS
+                   and time.monotonic() < deadline):
+                _journal_cond.wait(timeout=max(0.0, deadline - time.monotonic()))
+        try:
+            _journal_sync_now()
+        except Exception as e:
+            print("⚠️ journal fsync failed:", e)
+            time.sleep(1.0)
+            continue
+        if _journal_bytes >= RECORD_JOURNAL_CHECKPOINT_BYTES:
+            try:
+                _journal_checkpoint()
+            except Exception as e:
+                print("⚠️ journal checkpoint failed:", e)
+
+
+def _ensure_journal_thread():
+    global _journal_thread
+    with _journal_cond:
+        if _journal_thread is None or not _journal_thread.is_alive():
+            _journal_thread = threading.Thread(target=_journal_loop, name="record-journal", daemon=True)
+            _journal_thread.start()
+
+
+@contextlib.contextmanager
+def _journal_gate():
+    """追記〜反映（または保留）を1単位にする（チェックポイントのセグメント切り替えと排他）"""
+    global _journal_active
+    with _journal_cond:
+        while _journal_rotating:
+            _journal_cond.wait()
+        _journal_active += 1
+    try:
+        yield
+    finally:
+        with _journal_cond:
+            _journal_active -= 1
+            _journal_cond.notify_all()
+
+
+def _journal_mark_dirty(shard: str, name: str) -> None:
+    """反映済みだが未 fsync のパーティションとして記録する（次のチェックポイントで確定）"""
+    if _journal_enabled():
+        with _journal_cond:
+            _journal_dirty.add((shard, name))
+
+
+def _journal_snapshot_partition(shard: str, name: str) -> None:
+    """パーティションの現行版を fsync し、base/ にその版を残す（シャードのロック中に呼ぶ）"""
+    path = os.path.join(_shard_dir(shard), f"{name}.csv")
+    base = _journal_base_path(shard, name)
+    if not os.path.exists(path):
+        if os.path.exists(base):
+            os.remove(base)
+        return
+    _fsync_path(path)
+    _fsync_path(_shard_dir(shard), directory=True)
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    # パーティションは常に別ファイルへ書いて置き換えるので、リンク先の内容は変わらない
+    _link_or_copy(path, f"{base}.tmp")
+    os.replace(f"{base}.tmp", base)
+
+
+def _journal_prune_base() -> None:
+    """存在しなくなったパーティション（再配置後の旧シャードなど）の base を消す"""
+    base_root = os.path.join(_journal_dir(), "base")
+    try:
+        shards = os.listdir(base_root)
+    except FileNotFoundError:
+        return
+    for shard in shards:
+        shard_base = os.path.join(base_root, shard)
+        for f in os.listdir(shard_base):
+            if not os.path.exists(os.path.join(_shard_dir(shard), f)):
+                os.remove(os.path.join(shard_base, f))
+        if not os.listdir(shard_base):
+            os.rmdir(shard_base)
+
+
+def _journal_checkpoint(full: bool = False) -> int:
+    """
+    チェックポイント: 追記先を切り替え、旧セグメント分をすべて反映・fsync してから旧セグメントを消す。
+    full=True は書き換えの有無に関わらず全パーティションを確定させる（起動時・再配置後）。
+    戻り値は確定したパーティション数。
+    """
+    global _journal_fp, _journal_bytes, _journal_rotating, _journal_synced, _journal_first_pending
+    with _journal_ckpt_lock:
+        # 1) 追記先を新しいセグメントへ切り替える（追記〜反映の途中の保存は待つ）
+        with _journal_cond:
+            _journal_rotating = True
+            while _journal_active:
+                _journal_cond.wait()
+        try:
+            with _journal_fsync_lock:
+                with _journal_cond:
+                    fp = _journal_fp
+                    retired = list(_journal_segments)
+                    _journal_segments.clear()
+                    _journal_fp = None
+                    _journal_bytes = 0
+                if fp is not None:
+                    os.fsync(fp.fileno())
+                    _journal_mark_synced(retired[-1], fp.tell())
+                    fp.close()
+                with _journal_cond:
+                    _journal_synced = _journal_lsn
+                    _journal_first_pending = None
+        finally:
+            with _journal_cond:
+                _journal_rotating = False
+                _journal_cond.notify_all()
+
+        dirty: set[tuple[str, str]] = set()
+        try:
+            # 2) 旧セグメント分の保留を反映し、他スレッドで実行中の反映の完了を待つ
+            _store_flush()
+            for shard in _list_shards():
+                with _shard_lock(shard):
+                    pass
+            _store_flush()
+            # 3) 書き換えたパーティションを fsync して base/ に残す
+            with _journal_cond:
+                dirty = set(_journal_dirty)
+                _journal_dirty.clear()
+            if full:
+                dirty |= {(s, n) for s in _list_shards() for n in _list_partitions(s)}
+            for shard, name in sorted(dirty):
+                with _shard_lock(shard):
+                    _journal_snapshot_partition(shard, name)
+            if full:
+                _journal_prune_base()
+            for shard in sorted({s for s, _ in dirty}):
+                _fsync_path(os.path.dirname(_journal_base_path(shard, "x")), directory=True)
+        except Exception:
+            # 旧セグメントは次回のチェックポイント（または起動時の再適用）まで残す
+            with _journal_cond:
+                _journal_segments[:0] = retired
+                _journal_dirty.update(dirty)
+            raise
+        # 4) 旧セグメントを消す（二次保存先があれば配送待ちへ移す）
+        for path in retired:
+            _outbox_retire(path)
+        _fsync_path(_journal_dir(), directory=True)
+        return len(dirty)
+
+
+def _journal_replay_partition(shard: str, name: str, rows: list[dict], restore_base: bool) -> int:
+    """ジャーナルの行をパーティションへ再適用する（シャードのロック中に呼ぶ）"""
+    path = os.path.join(_shard_dir(shard), f"{name}.csv")
+    base = _journal_base_path(shard, name)
+    if restore_base and os.path.exists(base):
+        # 電源断で途中になっている可能性がある現行ファイルを、最後に確定した版へ戻す
+        _link_or_copy(base, f"{path}.restore")
+        os.replace(f"{path}.restore", path)
+    # 現行ファイルより古い保存は適用しない（別ワーカーの新しい保存を巻き戻さない）
+    current = {uid: str(r.get("timestamp", "")) for uid, r in _iter_partition_rows(shard, name)}
+    merged: dict[str, dict] = {}
+    for r in rows:
+        uid = str(r.get("user_id", "") or "").strip()
+        if not uid or str(r.get("timestamp", "")) < current.get(uid, ""):
+            continue
+        merged.setdefault(uid, {}).update(r)
+    if not merged:
+        return 0
+    return _upsert_rows(
+        path, list(merged.values()), KEY_FIELDS,
+        master_header=_partition_master_header(name), sort_key="user_id",
+    )
+
+
+def _journal_recover() -> int:
+    """
+    起動時: 前回のプロセスが残したジャーナルを再適用し、確定させてから消す。
+    稼働中の別ワーカーのセグメント（flock 中）は対象外。その場合は base へ戻さず現行ファイルに重ねる。
+    戻り値は再適用した行数。
+    """
+    try:
+        names = sorted(f for f in os.listdir(_journal_dir()) if f.endswith(".wal"))
+    except FileNotFoundError:
+        return 0
+    handles = []
+    records: list[dict] = []
+    live = False
+    try:
+        for f in names:
+            path = os.path.join(_journal_dir(), f)
+            if path in _journal_segments:
+                continue
+            fp = open(path, "rb")
+            if fcntl is not None:
+                try:
+                    fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    fp.close()
+                    live = True
+                    continue
+            handles.append((path, fp))
+            for raw in fp:
+                rec = _journal_decode(raw)
+                if rec is None:
+                    # 書きかけの末尾以降は捨てる
+                    break
+                records.append(rec)
+        if not handles:
+            return 0
+        by_part: dict[tuple[str, str], list[dict]] = {}
+        for rec in sorted(records, key=lambda r: r.get("t", 0)):
+            by_part.setdefault((str(rec.get("s")), str(rec.get("p"))), []).append(rec["r"])
+        applied = 0
+        for (shard, name), rows in by_part.items():
+            with _shard_lock(shard):
+                applied += _journal_replay_partition(shard, name, rows, restore_base=not live)
+            with _journal_cond:
+                _journal_dirty.add((shard, name))
+        _journal_checkpoint()
+        for path, _fp in handles:
+            _outbox_retire(path)
+        _fsync_path(_journal_dir(), directory=True)
+        print(f"📒 ジャーナル再適用: {len(records)} 件 → {applied} 行 ({len(by_part)} パーティション)")
+        return applied
+    finally:
+        for _path, fp in handles:
+            fp.close()
+
+
+# ------------------------------------------------------------
+# 🔹 アウトボックス（ジャーナルを二次保存先への配送キューとして使う）
+# ------------------------------------------------------------
+# CSV とDBを別々に書くと、DB 側の失敗で両者が黙ってずれる。保存はジャーナルへの追記1回で
+# 確定させ、DB・分析ログなどの二次保存先へは配送スレッドがジャーナルを先頭から読んで届ける。
+# - チェックポイントで役目を終えたセグメントは消さずに _journal/outbox/ へ移し、
+#   全配送先が読み終えたら消す（配送先ごとの読み出し位置は <配送先>.offsets.json）
+# - 配送は APOS_OUTBOX_BATCH 件ずつ。失敗したら位置を進めずに間隔を空けて再試行する（少なくとも1回配送）
+# - 複数ワーカーでも配送するのは dispatch.lock を取れた1プロセスだけ
+# - 稼働中のセグメントは fsync 済みの位置（<セグメント>.synced）までしか読まない
+# ジャーナル無効（APOS_JOURNAL_MODE=off）のときは従来どおり DB 書き込みキューへ積む。
+OUTBOX_BATCH = int(os.environ.get("APOS_OUTBOX_BATCH", "500"))
+OUTBOX_POLL_MS = float(os.environ.get("APOS_OUTBOX_POLL_MS", "200"))
+OUTBOX_ANALYTICS_LOG = os.environ.get("APOS_OUTBOX_ANALYTICS_LOG", "").strip()
+
+_outbox_lock = threading.Lock()
+_outbox_thread_guard = threading.Lock()
+_outbox_wake = threading.Event()
+_outbox_thread: threading.Thread | None = None
+_outbox_lock_fp = None
+_outbox_offsets: dict[str, dict[str, int]] = {}
+_outbox_state: dict[str, dict] = {}
+
+
+def _outbox_dir() -> str:
+    return os.path.join(_journal_dir(), "outbox")
+
+
+def _outbox_sinks() -> list[str]:
+    sinks = []
+    if _db_enabled():
+        sinks.append("db")
+    if OUTBOX_ANALYTICS_LOG:
+        sinks.append("analytics")
+    return sinks
+
+
+def _outbox_active() -> bool:
+    return _journal_enabled() and bool(_outbox_sinks())
+
+
+def _outbox_retire(path: str) -> None:
+    """チェックポイント済みのセグメントを配送待ちへ移す（配送先が無ければ消す）"""
+    _journal_drop_synced_mark(path)
+    try:
+        if _outbox_sinks():
+            os.makedirs(_outbox_dir(), exist_ok=True)
+            os.replace(path, os.path.join(_outbox_dir(), os.path.basename(path)))
+        else:
+            os.remove(path)
+    except OSError:
+        pass
+
+
+def _outbox_append_records(items: list[tuple[str, dict]]) -> None:
+    """ジャーナルを通さずに反映した行（一括インポート）を配送待ちのセグメントとして書く"""
+    global _journal_seq
+    if not items:
+        return
+    with _journal_cond:
+        _journal_seq += 1
+        seq = _journal_seq
+    os.makedirs(_outbox_dir(), exist_ok=True)
+    name = f"{os.getpid()}-{time.time_ns()}-{seq:06d}.wal"
+    tmp = os.path.join(_outbox_dir(), f".{name}.tmp")
+    with open(tmp, "wb") as wf:
+        for form_id, row in items:
+            uid = str(row.get("user_id", "") or "").strip()
+            wf.write(_journal_encode(_shard_of_user(uid), _partition_name(form_id), row, form_id))
+        wf.flush()
+        os.fsync(wf.fileno())
+    os.replace(tmp, os.path.join(_outbox_dir(), name))
+    _fsync_path(_outbox_dir(), directory=True)
+    _ensure_outbox_thread()
+    _outbox_wake.set()
+
+
+def _outbox_segments() -> list[tuple[str, str, bool]]:
+    """配送対象のセグメント [(名前, パス, 書き終わりか)] を作成順に返す（稼働中のジャーナルも含む）"""
+    found: dict[str, tuple[str, bool]] = {}
+    for directory, retired in ((_journal_dir(), False), (_outbox_dir(), True)):
+        try:
+            for f in os.listdir(directory):
+                if f.endswith(".wal"):
+                    found[f] = (os.path.join(directory, f), retired)
+        except FileNotFoundError:
+            pass
+
+    def order(name: str):
+        parts = name[:-4].split("-")
+        try:
+            return (int(parts[1]), int(parts[2]), name)
+        except (IndexError, ValueError):
+            return (0, 0, name)
+
+    return [(f, *found[f]) for f in sorted(found, key=order)]
+
+
+def _outbox_offsets_path(sink: str) -> str:
+    return os.path.join(_outbox_dir(), f"{sink}.offsets.json")
+
+
+def _outbox_load_offsets(sink: str) -> dict[str, int]:
+    if sink not in _outbox_offsets:
+        try:
+            with open(_outbox_offsets_path(sink), "r", encoding="utf-8") as rf:
+                _outbox_offsets[sink] = {str(k): int(v) for k, v in json.load(rf).items()}
+        except Exception:
+            _outbox_offsets[sink] = {}
+    return _outbox_offsets[sink]
+
+
+def _outbox_save_offsets(sink: str) -> None:
+    os.makedirs(_outbox_dir(), exist_ok=True)
+    path = _outbox_offsets_path(sink)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as wf:
+        json.dump(_outbox_offsets[sink], wf)
+        wf.flush()
+        os.fsync(wf.fileno())
+    os.replace(f"{path}.tmp", path)
+
+
+def _outbox_read(segments, offsets: dict[str, int], limit: int) -> tuple[list[dict], dict[str, int]]:
+    """各セグメントの読み出し位置から最大 limit 件を読む。戻り値は (記録, 読み終えた位置)"""
+    batch: list[dict] = []
+    advance: dict[str, int] = {}
+    for name, path, retired in segments:
+        pos = offsets.get(name, 0)
+        try:
+            fp = open(path, "rb")
+        except FileNotFoundError:
+            # 読み出し中にチェックポイントで outbox/ へ移った
+            try:
+                fp = open(os.path.join(_outbox_dir(), name), "rb")
+                retired = True
+            except FileNotFoundError:
+                continue
+        with fp:
+            size = os.fstat(fp.fileno()).st_size
+            if not retired:
+                # 稼働中のセグメントは fsync 済みの位置まで（電源断で消えうる行を先に配送しない）
+                size = min(size, _journal_synced_size(path))
+            if pos >= size:
+                continue
+            fp.seek(pos)
+            for raw in fp:
+                if pos + len(raw) > size:
+                    break
+                rec = _journal_decode(raw)
+                if rec is None:
+                    if retired:
+                        # 書き終わったセグメントの壊れた末尾（再適用時と同じく捨てる）
+                        pos = size
+                    break
+                batch.append(rec)
+                pos += len(raw)
+                if len(batch) >= limit:
+                    break
+        advance[name] = pos
+        if len(batch) >= limit:
+            break
+    return batch, advance
+
+
+def _outbox_deliver(sink: str, records: list[dict]) -> None:
+    if sink == "db":
+        _db_write_batch([(str(rec.get("f") or rec.get("p")), rec["r"]) for rec in records])
+    elif sink == "analytics":
+        with open(OUTBOX_ANALYTICS_LOG, "a", encoding="utf-8") as wf:
+            for rec in records:
+                row = rec["r"]
+                wf.write(json.dumps({
+                    "t": rec.get("t"),
+                    "form_id": rec.get("f") or rec.get("p"),
+                    "user_id": row.get("user_id", ""),
+                    "row": row,
+                }, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+            wf.flush()
+            os.fsync(wf.fileno())
+
+
+def _outbox_try_lock() -> bool:
+    """配送役を取る（取れたら保持し続ける）"""
+    global _outbox_lock_fp
+    if _outbox_lock_fp is not None:
+        return True
+    os.makedirs(_outbox_dir(), exist_ok=True)
+    fp = open(os.path.join(_outbox_dir(), "dispatch.lock"), "a")
+    if fcntl is not None:
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            return False
+    _outbox_lock_fp = fp
+    return True
+
+
+def _outbox_dispatch_once() -> int:
+    """全配送先に1バッチずつ届け、読み終えたセグメントを消す。戻り値は配送した件数"""
+    delivered = 0
+    with _outbox_lock:
+        segments = _outbox_segments()
+        names = {name for name, _p, _r in segments}
+        for sink in _outbox_sinks():
+            offsets = _outbox_load_offsets(sink)
+            state = _outbox_state.setdefault(sink, {"delivered": 0, "last_error": None, "retry_at": 0.0, "failures": 0})
+            if time.monotonic() < state["retry_at"]:
+                continue
+            batch, advance = _outbox_read(segments, offsets, OUTBOX_BATCH)
+            try:
+                if batch:
+                    _outbox_deliver(sink, batch)
+            except Exception as e:
+                state["failures"] += 1
+                state["last_error"] = str(e)
+                state["retry_at"] = time.monotonic() + min(30.0, 0.5 * (2 ** min(state["failures"], 6)))
+                print(f"⚠ outbox delivery to {sink} failed (retry):", e)
+                continue
+            state["failures"] = 0
+            state["retry_at"] = 0.0
+            state["delivered"] += len(batch)
+            delivered += len(batch)
+            offsets.update(advance)
+            for name in [n for n in offsets if n not in names]:
+                del offsets[name]
+            if advance or batch:
+                _outbox_save_offsets(sink)
+        # 全配送先が読み終えた書き終わりのセグメントを消す
+        sinks = _outbox_sinks()
+        for name, path, retired in segments:
+            if not retired or not sinks:
+                continue
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            if all(_outbox_load_offsets(s).get(name, 0) >= size for s in sinks):
+                os.remove(path)
+                for s in sinks:
+                    _outbox_offsets[s].pop(name, None)
+                    _outbox_save_offsets(s)
+    return delivered
+
+
+def _outbox_loop():
+    while True:
+        try:
+            if not _outbox_try_lock():
+                time.sleep(1.0)
+                continue
+            if _outbox_dispatch_once():
+                continue
+        except Exception as e:
+            print("⚠ outbox dispatch failed:", e)
+        _outbox_wake.wait(timeout=OUTBOX_POLL_MS / 1000.0)
+        _outbox_wake.clear()
+
+
+def _ensure_outbox_thread():
+    global _outbox_thread
+    if (_outbox_thread is not None and _outbox_thread.is_alive()) or not _outbox_active():
+        return
+    with _outbox_thread_guard:
+        if _outbox_thread is None or not _outbox_thread.is_alive():
+            _outbox_thread = threading.Thread(target=_outbox_loop, name="outbox-dispatch", daemon=True)
+            _outbox_thread.start()
+
+
+def _outbox_drain(timeout: float = 30.0) -> bool:
+    """配送待ちが無くなるまで配送する（停止時・CLI 終了時。配送役を取れない場合は何もしない）"""
+    if not _outbox_active():
+        return True
+    deadline = time.monotonic() + timeout
+    try:
+        if not _outbox_try_lock():
+            return False
+        while time.monotonic() < deadline:
+            if not _outbox_dispatch_once():
+                if all(_outbox_state.get(s, {}).get("failures", 0) == 0 for s in _outbox_sinks()):
+                    return True
+                time.sleep(0.2)
+    except Exception as e:
+        print("⚠ outbox drain failed:", e)
+    return False
+
+
+def _outbox_status() -> dict:
+    segments = _outbox_segments() if _outbox_active() else []
+    sizes = {}
+    for name, path, _retired in segments:
+        try:
+            sizes[name] = os.path.getsize(path)
+        except OSError:
+            pass
+    sinks = {}
+    for sink in _outbox_sinks():
+        offsets = _outbox_load_offsets(sink)
+        state = _outbox_state.get(sink, {})
+        pending = sum(max(0, size - offsets.get(name, 0)) for name, size in sizes.items())
+        sinks[sink] = {
+            "pending_bytes": pending,
+            "pending_segments": sum(1 for name, size in sizes.items() if offsets.get(name, 0) < size),
+            "delivered": state.get("delivered", 0),
+            "last_error": state.get("last_error"),
+        }
+    return {"active": _outbox_active(), "dispatcher": _outbox_lock_fp is not None, "sinks": sinks}
+
+
+@app.get("/api/outbox/status")
+async def get_outbox_status():
+    """二次保存先（DB・分析ログ）への配送の遅れ（このワーカーから見た値）"""
+    try:
+        return {"status": "ok", **_outbox_status()}
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+
+# ------------------------------------------------------------
+# 🔹 書き込みの合流（同一ユーザーの連続保存を1回の書き換えにまとめる）
+# ------------------------------------------------------------
+# フォームの修正中は同じ user_id の保存が数秒おきに続くため、パーティション単位で短時間だけ
+# 保留し、同じユーザーの部分行は choose_value と同じ後勝ちで重ねてから1回で反映する。
+# 0 以下なら従来どおり即時反映。保留中の内容は読み出し/エクスポートの前に必ず反映する。
+RECORD_COALESCE_WINDOW_SEC = float(os.environ.get("APOS_COALESCE_WINDOW_SEC", "0"))
+# 1パーティションに溜める上限（超えたら窓を待たずに反映）
+RECORD_COALESCE_MAX_USERS = int(os.environ.get("APOS_COALESCE_MAX_USERS", "500"))
+
+_coalesce_cond = threading.Condition()
+_coalesce_pending: dict[tuple[str, str], dict[str, dict]] = {}
+_coalesce_deadline: dict[tuple[str, str], float] = {}
+_coalesce_thread: threading.Thread | None = None
+
+
+def _flush_bucket(key: tuple[str, str], extra_rows: list[dict] | None = None) -> int:
+    """保留中の (シャード, パーティション) を反映する。extra_rows は保留分の後に重ねる"""
+    with _shard_lock(key[0]):
+        return _flush_bucket_locked(key, extra_rows)
+
+
+def _flush_bucket_locked(key: tuple[str, str], extra_rows: list[dict] | None = None) -> int:
+    """_flush_bucket の本体（シャードのロック中に呼ぶ）"""
+    shard, name = key
+    with _coalesce_cond:
+        users = _coalesce_pending.pop(key, {})
+        _coalesce_deadline.pop(key, None)
+    rows = list(users.values()) + list(extra_rows or [])
+    if not rows:
+        return 0
+    try:
+        written = _upsert_rows(
+            _partition_path(shard, name), rows, KEY_FIELDS,
+            master_header=_partition_master_header(name), sort_key="user_id",
+        )
+        _journal_mark_dirty(shard, name)
+        return written
+    except Exception:
+        # 反映に失敗した保留分は戻す（その後に届いた値を優先）
+        with _coalesce_cond:
+            current = _coalesce_pending.setdefault(key, {})
+            for uid, r in users.items():
+                current[uid] = {**r, **current.get(uid, {})}
+            _coalesce_deadline.setdefault(key, time.monotonic() + max(RECORD_COALESCE_WINDOW_SEC, 1.0))
+            _coalesce_cond.notify_all()
+        raise
+
+
+def _coalesce_loop():
+    """窓が過ぎたパーティションから順に反映するバックグラウンドスレッド"""
+    while True:
+        with _coalesce_cond:
+            while not _coalesce_deadline:
+                _coalesce_cond.wait()
+            now = time.monotonic()
+            due = [k for k, d in _coalesce_deadline.items() if d <= now]
+            if not due:
+                _coalesce_cond.wait(timeout=max(0.0, min(_coalesce_deadline.values()) - now))
+                continue
+        for key in due:
+            try:
+                _flush_bucket(key)
+            except Exception as e:
+                print("⚠️ coalesced write failed:", key, e)
+
+
+def _ensure_coalesce_thread():
+    global _coalesce_thread
+    with _coalesce_cond:
+        if _coalesce_thread is None or not _coalesce_thread.is_alive():
+            _coalesce_thread = threading.Thread(target=_coalesce_loop, name="record-coalesce", daemon=True)
+            _coalesce_thread.start()
+
+
+def _store_submit(form_id, row: dict, wait: bool = False) -> str:
+    """
+    保存リクエストの書き込み口。戻り値は応答に載せる永続化状態:
+    - "committed": パーティションへ反映済み
+    - "journaled": 合流窓で保留中だが、ジャーナルは fsync 済み（strict）
+    - "buffered": 合流窓で保留中（窓が過ぎると反映）
+    wait=True（X-Durability: committed）はジャーナルの fsync も待つ。
+    """
+    uid = str(row.get("user_id", "") or "").strip()
+    if not uid:
+        print(f"⚠️ upsert: 必須キー {KEY_FIELDS} が空のためスキップします。")
+        return "skipped"
+    key = (_shard_of_user(uid), _partition_name(form_id))
+    journaled = _journal_enabled()
+    lsn = 0
+    with (_journal_gate() if journaled else contextlib.nullcontext()):
+        if journaled:
+            lsn = _journal_append(key[0], key[1], row, form_id)
+        state = _store_apply(key, uid, row, wait)
+    if journaled and (wait or RECORD_JOURNAL_MODE == "strict"):
+        _journal_wait(lsn)
+        if state == "buffered":
+            state = "journaled"
+    return state
+
+
+def _store_submit_many(items: list[tuple[str, dict]], wait: bool = False) -> str:
+    """
+    複数フォーム分の行をまとめて保存する（一括保存用）。
+    ジャーナルへの追記・fsync 待ちは1回、シャードのロックも1回で、各パーティションの書き換えは1回ずつ。
+    戻り値は _store_submit と同じ永続化状態。
+    """
+    keyed: list[tuple[tuple[str, str], str, dict, str]] = []
+    for form_id, row in items:
+        uid = str(row.get("user_id", "") or "").strip()
+        if uid:
+            keyed.append(((_shard_of_user(uid), _partition_name(form_id)), uid, row, form_id))
+    if not keyed:
+        print(f"⚠️ upsert: 必須キー {KEY_FIELDS} が空のためスキップします。")
+        return "skipped"
+    journaled = _journal_enabled()
+    lsn = 0
+    with (_journal_gate() if journaled else contextlib.nullcontext()):
+        if journaled:
+            for key, _uid, row, form_id in keyed:
+                lsn = _journal_append(key[0], key[1], row, form_id)
+        if RECORD_COALESCE_WINDOW_SEC > 0 and not wait:
+            states = [_store_apply(key, uid, row, False) for key, uid, row, _fid in keyed]
+            state = "buffered" if "buffered" in states else "committed"
+        else:
+            by_shard: dict[str, dict[tuple[str, str], list[dict]]] = {}
+            for key, _uid, row, _fid in keyed:
+                by_shard.setdefault(key[0], {}).setdefault(key, []).append(row)
+            for shard, buckets in by_shard.items():
+                with _shard_lock(shard):
+                    for key, rows in buckets.items():
+                        _flush_bucket_locked(key, rows)
+            state = "committed"
+    if journaled and (wait or RECORD_JOURNAL_MODE == "strict"):
+        _journal_wait(lsn)
+        if state == "buffered":
+            state = "journaled"
+    return state
+
+
+def _store_apply(key: tuple[str, str], uid: str, row: dict, wait: bool) -> str:
+    """即時反映するか合流窓に保留する"""
+    if RECORD_COALESCE_WINDOW_SEC <= 0 or wait:
+        # 保留分があればそれも含めて今すぐ反映（順序は保留分 → 今回）
+        _flush_bucket(key, [row])
+        return "committed"
+    session = str(row.get("session", "") or "")
+    while True:
+        with _coalesce_cond:
+            users = _coalesce_pending.setdefault(key, {})
+            # 別の来訪（session 違い）の保留分と重ねると履歴の版が1つ消えるので、先に反映してから保留する
+            if uid not in users or str(users[uid].get("session", "") or "") == session:
+                if uid in users:
+                    users[uid].update(row)
+                else:
+                    users[uid] = dict(row)
+                _coalesce_deadline.setdefault(key, time.monotonic() + RECORD_COALESCE_WINDOW_SEC)
+                overflow = len(users) >= RECORD_COALESCE_MAX_USERS
+                _coalesce_cond.notify_all()
+                break
+        _flush_bucket(key)
+    if overflow:
+        _flush_bucket(key)
+        return "committed"
+    _ensure_coalesce_thread()
+    return "buffered"
+
+
+def _store_flush(shard: str | None = None) -> int:
+    """保留中の書き込みを反映する（shard 指定時はそのシャードのみ）"""
+    with _coalesce_cond:
+        keys = [k for k in _coalesce_pending if shard is None or k[0] == shard]
+    return sum(_flush_bucket(k) for k in keys)
+
+
+# ------------------------------------------------------------
+# 🔹 DB書き込みキュー（保存リクエストは積むだけ、DBへはバックグラウンドでまとめて書く）
+# ------------------------------------------------------------
+# 以前は CSV 反映のあと insert_form_data を1行ずつ同期で呼んでいたため、DB の往復が保存の
+# 応答時間にそのまま乗っていた。キューに積んで専用スレッドが APOS_DB_BATCH_ROWS 件ごと
+# （または APOS_DB_FLUSH_MS 経過ごと）に複数行 INSERT / PostgreSQL は COPY で書き込む。
+# - APOS_DB_URL があれば form_records テーブルへ書く（sqlite:///... を指定すればローカル検証用）
+# - 無ければ utils.db_utils の insert_form_data を同じスレッドから呼ぶ
+# 失敗したバッチは間隔を空けて APOS_DB_RETRIES 回まで再試行する。
+DB_URL = os.environ.get("APOS_DB_URL", "").strip()
+DB_POOL_SIZE = int(os.environ.get("APOS_DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("APOS_DB_MAX_OVERFLOW", "10"))
+DB_POOL_RECYCLE_SEC = int(os.environ.get("APOS_DB_POOL_RECYCLE_SEC", "1800"))
+DB_BATCH_ROWS = int(os.environ.get("APOS_DB_BATCH_ROWS", "500"))
+DB_FLUSH_MS = float(os.environ.get("APOS_DB_FLUSH_MS", "200"))
+DB_QUEUE_MAX = int(os.environ.get("APOS_DB_QUEUE_MAX", "100000"))
+DB_RETRIES = int(os.environ.get("APOS_DB_RETRIES", "3"))
+
+_db_queue: "queue.Queue[tuple[str, dict]]" = queue.Queue(maxsize=DB_QUEUE_MAX)
+_db_thread: threading.Thread | None = None
+_db_thread_guard = threading.Lock()
+_db_engine_obj = None
+_db_table = None
+_db_stats = {"written": 0, "failed": 0, "dropped": 0}
+
+
+def _db_enabled() -> bool:
+    return bool(DB_URL) or insert_form_data is not None
+
+
+def _db_engine():
+    """APOS_DB_URL の接続（プール設定つき）。未設定・SQLAlchemy 無しなら None"""
+    global _db_engine_obj, _db_table
+    if _db_engine_obj is not None or not DB_URL:
+        return _db_engine_obj
+    with _db_thread_guard:
+        if _db_engine_obj is None:
+            _db_engine_obj, _db_table = _db_create_engine()
+    return _db_engine_obj
+
+
+def _db_create_engine():
+    from sqlalchemy import create_engine, MetaData, Table, Column, Integer, String, Text, DateTime, func
+    if DB_URL.startswith("sqlite"):
+        engine = create_engine(DB_URL, connect_args={"check_same_thread": False})
+    else:
+        engine = create_engine(
+            DB_URL,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_recycle=DB_POOL_RECYCLE_SEC,
+            pool_pre_ping=True,
+        )
+    metadata = MetaData()
+    table = Table(
+        "form_records", metadata,
+        Column("id", Integer, primary_key=True, autoincrement=True),
+        Column("form_id", String(32), nullable=False),
+        Column("user_id", String(128), nullable=False, index=True),
+        Column("submitted_at", String(19), nullable=False),
+        Column("data", Text, nullable=False),
+        Column("created_at", DateTime, server_default=func.now()),
+    )
+    metadata.create_all(engine)
+    return engine, table
+
+
+def _db_write_batch(batch: list[tuple[str, dict]]) -> None:
+    """1バッチを書き込む（1トランザクション）"""
+    engine = _db_engine()
+    if engine is None:
+        for form_id, row in batch:
+            insert_form_data(form_id, row)
+        return
+    records = [
+        (str(form_id), str(row.get("user_id", "")), str(row.get("timestamp", "")),
+         json.dumps(row, ensure_ascii=False, default=str))
+        for form_id, row in batch
+    ]
+    cols = "form_id, user_id, submitted_at, data"
+    driver = engine.dialect.driver if engine.dialect.name == "postgresql" else ""
+    if driver in ("psycopg2", "psycopg"):
+        raw = engine.raw_connection()
+        try:
+            cur = raw.cursor()
+            if driver == "psycopg2":
+                buf = io.StringIO()
+                csv.writer(buf).writerows(records)
+                buf.seek(0)
+                cur.copy_expert(f"COPY form_records ({cols}) FROM STDIN WITH (FORMAT csv)", buf)
+            else:
+                with cur.copy(f"COPY form_records ({cols}) FROM STDIN") as cp:
+                    for rec in records:
+                        cp.write_row(rec)
+            raw.commit()
+        except Exception:
+            raw.rollback()
+            raise
+        finally:
+            raw.close()
+        return
+    with engine.begin() as conn:
+        conn.execute(
+            _db_table.insert(),
+            [{"form_id": f, "user_id": u, "submitted_at": t, "data": d} for f, u, t, d in records],
+        )
+
+
+def _db_write_with_retry(batch: list[tuple[str, dict]]) -> bool:
+    for attempt in range(DB_RETRIES + 1):
+        try:
+            _db_write_batch(batch)
+            _db_stats["written"] += len(batch)
+            return True
+        except Exception as e:
+            if attempt >= DB_RETRIES:
+                _db_stats["failed"] += len(batch)
+                print(f"⚠ DB insert failed ({len(batch)} rows):", e)
+                return False
+            time.sleep(min(5.0, 0.5 * (2 ** attempt)))
+    return False
+
+
+def _db_loop():
+    while True:
+        batch = [_db_queue.get()]
+        deadline = time.monotonic() + DB_FLUSH_MS / 1000.0
+        while len(batch) < DB_BATCH_ROWS:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_db_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _db_write_with_retry(batch)
+        finally:
+            for _ in batch:
+                _db_queue.task_done()
+
+
+def _ensure_db_thread():
+    global _db_thread
+    with _db_thread_guard:
+        if _db_thread is None or not _db_thread.is_alive():
+            _db_thread = threading.Thread(target=_db_loop, name="db-writer", daemon=True)
+            _db_thread.start()
+
+
+def _db_enqueue(form_id, row: dict) -> None:
+    """保存済みの行を DB 書き込みキューに積む（待たない）"""
+    if not _db_enabled():
+        return
+    try:
+        _db_queue.put_nowait((str(form_id), dict(row)))
+    except queue.Full:
+        _db_stats["dropped"] += 1
+        print("⚠ DB queue full, row not written to DB:", form_id, row.get("user_id"))
+        return
+    _ensure_db_thread()
+
+
+def _db_insert_many(items: list[tuple[str, dict]]) -> int:
+    """一括インポート用: キューを通さずバッチ単位で書き込む（呼び出し元はスレッド/CLI）"""
+    if not _db_enabled():
+        return 0
+    written = 0
+    for i in range(0, len(items), DB_BATCH_ROWS):
+        batch = items[i:i + DB_BATCH_ROWS]
+        if _db_write_with_retry(batch):
+            written += len(batch)
+    return written
+
+
+def _db_flush(timeout: float = 30.0) -> bool:
+    """キューに残っている行の書き込みを待つ（停止時・CLI 終了時）"""
+    deadline = time.monotonic() + timeout
+    while _db_queue.unfinished_tasks:
+        if time.monotonic() >= deadline:
+            print(f"⚠ DB queue not drained: {_db_queue.unfinished_tasks} rows pending")
+            return False
+        time.sleep(0.05)
+    return True
+
+# ------------------------------------------------------------
+# 🔹 重複送信の抑止（Idempotency-Key / ペイロードのダイジェスト）
+# ------------------------------------------------------------
+# ダブルタップや不安定な回線での再送で同じペイロードが届くと、画像デコード・フラット化・
+# パーティション書き換え・DB保存をすべてやり直していた。直近の応答を TTL 付きで保持し、
+# 同じ送信には保存処理を通さず元の応答を返す（ワーカープロセスごとのキャッシュ）。
+# - Idempotency-Key ヘッダがあればそれをキーにする
+# - 無ければ正規化した JSON のダイジェストを使い、同じユーザー・フォームの「直前の送信」と
+#   同一の場合だけ重複とみなす（A→B→A のように戻した保存は通常どおり反映する）
+IDEMPOTENCY_TTL_SEC = float(os.environ.get("APOS_IDEMPOTENCY_TTL_SEC", "600"))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get("APOS_IDEMPOTENCY_MAX_KEYS", "10000"))
+
+_idem_lock = threading.Lock()
+_idem_responses: "OrderedDict[str, tuple[float, dict]]" = OrderedDict()
+_idem_latest: dict[str, str] = {}
+_idem_inflight: dict[str, asyncio.Future] = {}
+
+
+def _idempotency_key(request: Request, payload: dict) -> tuple[str, str | None]:
+    """(キャッシュキー, 直前送信の照合スコープ) を返す。スコープは派生キーの時のみ"""
+    path = request.url.path
+    header_key = (request.headers.get("idempotency-key") or "").strip()
+    if header_key:
+        return f"{path}|key|{header_key}", None
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+    user = str(payload.get("user_id") or "").strip() or (
+        f"{payload.get('office_id') or ''}_{payload.get('personal_id') or payload.get('person_id') or ''}"
+    )
+    scope = f"{path}|{payload.get('form_id') or ''}|{user}"
+    return f"{scope}|sha256|{digest}", scope
+
+
+def _idem_prune(now: float) -> None:
+    while _idem_responses:
+        key, (expires, _resp) = next(iter(_idem_responses.items()))
+        if expires > now and len(_idem_responses) <= IDEMPOTENCY_MAX_KEYS:
+            break
+        _idem_responses.popitem(last=False)
+
+
+async def _idempotency_begin(key: tuple[str, str | None]):
+    """
+    重複なら元の応答（JSONResponse）を返す。初回なら None を返し、呼び出し側が処理を担当する。
+    同じキーの処理が実行中なら、その完了を待って同じ応答を返す。
+    """
+    cache_key, scope = key
+    while True:
+        with _idem_lock:
+            now = time.monotonic()
+            _idem_prune(now)
+            hit = _idem_responses.get(cache_key)
+            if hit and (scope is None or _idem_latest.get(scope) == cache_key):
+                return JSONResponse(hit[1], headers={"Idempotent-Replayed": "true"})
+            waiting = _idem_inflight.get(cache_key)
+            if waiting is None:
+                _idem_inflight[cache_key] = asyncio.get_running_loop().create_future()
+                return None
+        try:
+            await asyncio.shield(waiting)
+        except Exception:
+            pass
+
+
+def _idempotency_finish(key: tuple[str, str | None] | None, response: dict | None) -> None:
+    """処理結果を記録する（成功時のみキャッシュ。失敗時は次の再送を通常どおり処理させる）"""
+    if key is None:
+        return
+    cache_key, scope = key
+    with _idem_lock:
+        if response is not None and response.get("status") == "ok":
+            _idem_responses[cache_key] = (time.monotonic() + IDEMPOTENCY_TTL_SEC, response)
+            _idem_responses.move_to_end(cache_key)
+            if scope is not None:
+                _idem_latest[scope] = cache_key
+                while len(_idem_latest) > IDEMPOTENCY_MAX_KEYS:
+                    _idem_latest.pop(next(iter(_idem_latest)))
+            _idem_prune(time.monotonic())
+        fut = _idem_inflight.pop(cache_key, None)
+    if fut is not None and not fut.done():
+        fut.set_result(None)
+
+
+# ------------------------------------------------------------
+# 🔹 動作確認用ルート
+# ------------------------------------------------------------
+@app.get("/")
+async def root():
+    """動作確認用のルート"""
+    return {"status": "running", "message": "FastAPI server for APOS-HC is active."}
+
+# ------------------------------------------------------------
+# 🔹 本番用ヘルパー群（画像保存/ディレクトリ作成/Refererからform_id抽出）
+# ------------------------------------------------------------
+def _ensure_dirs():
+    os.makedirs(os.path.dirname(RECORDS_CSV_PATH), exist_ok=True)
+    os.makedirs(os.path.dirname(DEMO_CSV_PATH), exist_ok=True)
+    os.makedirs(RECORDS_PARTITION_DIR, exist_ok=True)
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+
+
+def _wants_commit(request: Request) -> bool:
+    """X-Durability: committed が付いた保存は合流窓を待たずに反映する"""
+    return (request.headers.get("x-durability") or "").strip().lower() in ("committed", "commit", "sync")
+
+
+def _extract_form_id_from_referer(referer: str | None) -> str | None:
+    if not referer:
+        return None
+    m = re.search(r"/forms/(form\d+)\.html", referer)
+    if m:
+        return m.group(1)
+    m = re.search(r"/(form\d+)\.html", referer)
+    return m.group(1) if m else None
+
+
+def _decode_and_save_images(payload: dict, form_id: str, now: datetime):
+    """
+    画像DataURLを保存し、(保存ファイル一覧, 元キー名→ファイル名の対応) を返す。
+    """
+    saved_files: list[str] = []
+    key_to_filename: dict[str, str] = {}
+    ts = now.strftime("%Y%m%d_%H%M%S")
+    idx = 1
+    for k, v in list(payload.items()):
+        if not isinstance(v, str):
+            continue
+        if not v.startswith("data:image/"):
+            continue
+        try:
+            header, b64data = v.split(",", 1)
+        except ValueError:
+            continue
+        # 画像タイプの許容（JPEG/PNG）。PNGでも受け取り、拡張子はjpgで保存
+        lower = header.lower()
+        if not (lower.startswith("data:image/jpeg") or lower.startswith("data:image/jpg") or lower.startswith("data:image/png")):
+            continue
+        try:
+            binary = base64.b64decode(b64data, validate=True)
+        except Exception:
+            continue
+        fname = f"{form_id}_{ts}_{idx}.jpg"
+        fpath = os.path.join(UPLOADS_DIR, fname)
+        with open(fpath, "wb") as wf:
+            wf.write(binary)
+        saved_files.append(fname)
+        key_to_filename[k] = fname
+        idx += 1
+        # CSVが肥大化しないよう、payloadから画像データを除去
+        del payload[k]
+    return saved_files, key_to_filename
+
+
+
+
+# ------------------------------------------------------------
+# 🔹 プレフィル（保存済み回答をフォームの入力値に戻して返す）
+# ------------------------------------------------------------
+# 端末を替えると localStorage に回答が無いため、サーバー側の保存内容から復元する。
+# one-hot 列は CHOICE_MASTER とエイリアス表で入力値へ逆変換し、それ以外の列はそのまま返す。
+_FORM_ONEHOT_ALIASES = {
+    "form0": FORM0_ONEHOT_ALIASES,
+    "form1": FORM1_ONEHOT_ALIASES,
+    "form3": FORM3_ONEHOT_ALIASES,
+}
+
+_prefill_spec_cache: dict[tuple, tuple[dict, list]] = {}
+# 書き込み時に空欄を 0 で埋めているテキスト入力（form0 の依頼者欄など）。入力欄には 0 ではなく空欄で戻す
+_PREFILL_ZERO_FILLED_TEXT_COLS = {
+    "form0": {"age", "request_organization", "requestor_name", "requestor_tel", "requestor_fax",
+              "requestor_email", "reception_staff"},
+    "form1": {"care_sharing_3"},
+}
+# 年月日・時刻の入力欄（同じく空欄が 0 で保存される。0 年・0 月は入力としてありえない。
+# 時・分は 0 時・0 分がありうるので、時と分の両方が 0 のときだけ未入力とみなす）
+_PREFILL_DATE_PART_RE = re.compile(r"_(?:year|month|day)$")
+_PREFILL_TIME_PART_RE = re.compile(r"^(.*)_(?:hour|minute)$")
+# Excel 向けに先頭へ ' を付けて保存している列
+_PREFILL_QUOTED_COLS = {"form0": _FORM0_PHONE_COLS}
+
+
+def _prefill_spec(form_id: str, header=()) -> tuple[dict, list]:
+    """
+    フォームの逆変換表: ({入力名: [(one-hot 列, 入力値), ...]}, そのまま返す列)
+    - 列のサフィックスが選択肢そのもの（sex_男 / エイリアス sex_male）→ 値
+    - 選択肢の番号（relationship_status_0 → "1"）→ 値
+    - form18 の 0-10 スケール（fatigue_score_3 → fatigue="3"）
+    header は保存済みパーティションの列（FORMn_ORDER に無い旧列・生サフィックス列も対象にする）。
+    """
+    cache_key = (form_id, tuple(header))
+    cached = _prefill_spec_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    order = globals().get(f"{form_id.upper()}_ORDER") or []
+    cols = []
+    for c in list(order) + list(header):
+        if c not in ("timestamp", "user_id", "image_file", "image_url") and c not in cols:
+            cols.append(c)
+    col_set = set(cols)
+    aliases = _FORM_ONEHOT_ALIASES.get(form_id, {})
+    groups: dict[str, list[tuple[str, str]]] = {}
+    claimed: set[str] = set()
+
+    for base in FORM18_SCALE_BASES:
+        out_base = FORM18_SCALE_ALIASES.get(base, base)
+        members = [(f"{out_base}_{i}", str(i)) for i in range(11) if f"{out_base}_{i}" in col_set]
+        if not members and base == "physical_activity":
+            members = [(f"physical_activity_f18_{i}", str(i)) for i in range(11) if f"physical_activity_f18_{i}" in col_set]
+        if members:
+            groups[base] = members
+            claimed.update(c for c, _ in members)
+            if base == "physical_activity":
+                # 同じ値の重複出力（physical_activity_f18_*）は入力に戻さない
+                claimed.update(f"physical_activity_f18_{i}" for i in range(11))
+
+    # 長いベース名から割り当てる（care_status_nursing を care_status より先に）
+    for base in sorted(set(CHOICE_MASTER) | set(aliases), key=len, reverse=True):
+        prefix = base + "_"
+        tokens = {c[len(prefix):]: c for c in cols if c.startswith(prefix) and c not in claimed}
+        if not tokens:
+            continue
+        choices = [str(x) for x in CHOICE_MASTER.get(base, [])]
+        if choices and "0" in tokens and "0" not in choices and all(
+            t.isdigit() and int(t) < len(choices) for t in tokens
+        ):
+            token_map = {str(i): c for i, c in enumerate(choices)}
+        else:
+            token_map = {c: c for c in choices}
+            # 複数の入力値が同じ別名になる場合は CHOICE_MASTER の値を優先
+            for value, alias in sorted(aliases.get(base, {}).items(), key=lambda kv: kv[0] not in choices):
+                alias = str(alias)
+                if base == "care_status_nursing" and alias.startswith("nursing_"):
+                    alias = alias[len("nursing_"):]
+                token_map.setdefault(alias, value)
+        members = [(col, token_map[t]) for t, col in tokens.items() if t in token_map]
+        if members:
+            groups[base] = members
+            claimed.update(c for c, _ in members)
+
+    spec = (groups, [c for c in cols if c not in claimed])
+    _prefill_spec_cache[cache_key] = spec
+    return spec
+
+
+def _prefill_input_value(form_id: str, col: str, row: dict):
+    """保存値 → 入力欄に入れる値（書き込み時の 0 埋めと Excel 向けの ' を外す。数値欄の 0 はそのまま）"""
+    v = row.get(col, "")
+    v = "" if v is None else v
+    if col in _PREFILL_QUOTED_COLS.get(form_id, ()) and isinstance(v, str) and v.startswith("'"):
+        return v[1:]
+    if not _is_zero_fill(v):
+        return v
+    if col in _PREFILL_ZERO_FILLED_TEXT_COLS.get(form_id, ()) or _PREFILL_DATE_PART_RE.search(col):
+        return ""
+    m = _PREFILL_TIME_PART_RE.match(col)
+    if m and all(_is_zero_fill(row.get(f"{m.group(1)}_{part}", "")) for part in ("hour", "minute")):
+        return ""
+    return v
+
+
+def _is_zero_fill(v) -> bool:
+    return str("" if v is None else v).strip() in ("", "0", "0.0")
+
+
+def _prefill_values(form_id: str, row: dict, inputs: bool = False) -> dict:
+    """
+    保存行 → フォームの入力値（選択が1つなら文字列、複数ならリスト、未選択は空文字）。
+    inputs=True はプレフィル用: そのまま返す列も入力欄の値に戻す（ラベル化エクスポートは保存値のまま）。
+    """
+    groups, plain = _prefill_spec(form_id, row.keys())
+    data: dict = {}
+    for base, members in groups.items():
+        selected: list[str] = []
+        for col, value in members:
+            # 同じ選択肢が別名列と生サフィックス列の両方に立っている場合は1つにまとめる
+            if str(row.get(col, "") or "").strip() in ("1", "1.0", "True", "true") and value not in selected:
+                selected.append(value)
+        data[base] = selected[0] if len(selected) == 1 else (selected or "")
+    for col in plain:
+        if inputs:
+            data[col] = _prefill_input_value(form_id, col, row)
+        else:
+            v = row.get(col, "")
+            data[col] = "" if v is None else v
+    return data
+
+
+@app.get("/api/form{form_num}/prefill")
+async def get_form_prefill(form_num: int, user_id: str):
+    """指定ユーザーの form{n} の保存済み回答（入力値に逆変換済み）"""
+    try:
+        form_id = f"form{form_num}"
+        uid = (user_id or "").strip()
+        if not uid:
+            return {"status": "error", "message": "user_id is required"}
+        row = await run_in_threadpool(_store_read_partition, uid, form_id)
+        if row is None:
+            return {"status": "ok", "form_id": form_id, "user_id": uid, "data": None}
+        return {
+            "status": "ok",
+            "form_id": form_id,
+            "user_id": uid,
+            "timestamp": row.get("timestamp", ""),
+            "data": _prefill_values(form_id, row, inputs=True),
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e)}
+
+
+# ------------------------------------------------------------
+# 🔹 ラベル化エクスポート（one-hot 列のグループを選択肢ラベルの1列に戻した横持ちCSV）
+# ------------------------------------------------------------
+# care_status_要支援1..要介護5 や pain_0..pain_10 のような列は人が読むには分かりにくく、分析側で
+# ラベル列を作り直していた。プレフィルと同じ逆変換表（_prefill_spec: CHOICE_MASTER・エイリアス表・
+# form18 の 0-10 スケール）でグループごとに1列へまとめる。複数選択は DECODED_MULTI_SEP 区切り。
+# pandas/numpy があればフォームごとに全シャード分をまとめた表で列ごとに計算し、無ければ行ごとに _prefill_values で作る。
+DECODED_MULTI_SEP = os.environ.get("APOS_DECODED_MULTI_SEP", ";")
+# 1回に表へ載せるパーティションファイルの合計サイズの目安
+DECODED_BATCH_BYTES = int(float(os.environ.get("APOS_DECODED_BATCH_MB", "64")) * 1024 * 1024)
+_DECODED_TRUE = ("1", "1.0", "True", "true")
+
+
+def _decoded_partition_columns(name: str, header: list[str]) -> list[str]:
+    """パーティションのラベル化後の列（グループは先頭メンバーの位置にベース名で置く）"""
+    groups, plain = _prefill_spec(name, header)
+    first_member = {}
+    for base, members in groups.items():
+        for col, _value in members:
+            first_member.setdefault(col, base)
+    plain_set = set(plain)
+    out: list[str] = []
+    for col in list(globals().get(f"{name.upper()}_ORDER") or []) + list(header):
+        if col in first_member and first_member[col] not in out:
+            out.append(first_member[col])
+        elif col in plain_set and col not in out:
+            out.append(col)
+    for base in groups:
+        if base not in out:
+            out.append(base)
+    return out
+
+
+def _decoded_header(shards: list[str], root: str | None = None) -> list[str]:
+    header = ["timestamp", "office_id", "personal_id", "user_id"]
+    seen = set(header)
+    names = sorted({n for s in shards for n in _list_partitions(s, root)},
+                   key=lambda n: (0, int(n[4:])) if re.fullmatch(r"form\d+", n) else (1, 0))
+    for name in names:
+        for shard in shards:
+            for col in _decoded_partition_columns(name, _partition_header(shard, name, root)):
+                if col not in seen and col not in ("image_file", "image_url"):
+                    header.append(col)
+                    seen.add(col)
+    return header + [c for c in ("image_file", "image_url") if c not in seen]
+
+
+def _decode_partition_frame(name: str, frame):
+    """パーティション1つ分の DataFrame（全列 str）→ ラベル化した DataFrame（列ごとに計算）"""
+    groups, plain = _prefill_spec(name, list(frame.columns))
+    keep = ["timestamp", "user_id", "image_file", "image_url"] + list(plain)
+    out = {col: frame[col] for col in keep if col in frame.columns}
+    group_cols = [c for members in groups.values() for c, _v in members]
+    position = {c: i for i, c in enumerate(group_cols)}
+    flags = frame[group_cols].isin(_DECODED_TRUE).to_numpy() if group_cols else None
+    n = len(frame)
+    for base, members in groups.items():
+        labels = np.array([v for _c, v in members], dtype=object)
+        selected = flags[:, [position[c] for c, _v in members]]
+        counts = selected.sum(axis=1)
+        values = np.full(n, "", dtype=object)
+        single = counts == 1
+        values[single] = labels[selected[single].argmax(axis=1)]
+        for i in np.flatnonzero(counts > 1):
+            # 同じ選択肢が別名列と生サフィックス列の両方に立っている場合は1つにまとめる
+            values[i] = DECODED_MULTI_SEP.join(dict.fromkeys(labels[selected[i]]))
+        out[base] = pd.Series(values, index=frame.index)
+    return pd.DataFrame(out, index=frame.index)
+
+
+def _decoded_frame(shards: list[str], header: list[str], root: str | None = None):
+    """
+    複数シャード分のラベル化横持ち表。フォームごとに全シャードの行を1つの表にしてから列単位で変換し、
+    利用者ごとに timestamp の古い順に重ねる（空欄も含めて後勝ち＝従来の _merge_user_rows と同じ）。
+    """
+    names = sorted({n for s in shards for n in _list_partitions(s, root)},
+                   key=lambda n: (0, int(n[4:])) if re.fullmatch(r"form\d+", n) else (1, 0))
+    decoded = []
+    for order, name in enumerate(names):
+        parts = []
+        for shard in shards:
+            try:
+                parts.append(pd.read_csv(os.path.join(_shard_dir(shard, root), f"{name}.csv"),
+                                         dtype=object, keep_default_na=False, encoding="utf-8-sig"))
+            except (FileNotFoundError, pd.errors.EmptyDataError):
+                continue
+        frame = pd.concat(parts, ignore_index=True) if parts else None
+        if frame is None or frame.empty or "user_id" not in frame.columns:
+            continue
+        frame["user_id"] = frame["user_id"].str.strip()
+        frame = frame.drop_duplicates("user_id", keep="last")
+        part = _decode_partition_frame(name, frame.fillna(""))
+        if "timestamp" not in part.columns:
+            part = part.assign(timestamp="")
+        decoded.append(part.assign(_order=order))
+    if not decoded:
+        return pd.DataFrame(columns=header)
+    merged = (
+        pd.concat(decoded, ignore_index=True)
+        .sort_values(["timestamp", "_order"], kind="stable")
+        .groupby("user_id", sort=True)
+        .last()
+        # groupby の結果は列ごとのブロックに分かれているので、まとめ直してから user_id を列に戻す
+        .copy()
+        .reset_index()
+    )
+    # office_id / personal_id が空なら user_id から補う（列は assign でまとめて足す）
+    ids = merged["user_id"].str.split("_", n=1)
+    derived = {}
+    for col, fallback in (("office_id", ids.str[0]), ("personal_id", ids.str[1])):
+        current = merged[col].fillna("") if col in merged.columns else pd.Series("", index=merged.index)
+        derived[col] = current.where(current != "", fallback)
+    return merged.assign(**derived).reindex(columns=header).fillna("")
+
+
+def _decoded_rows(shards: list[str], header: list[str], root: str | None = None):
+    """pandas が無い環境用: 行ごとにラベル化して user_id 単位に重ねる（並びは _decoded_frame と同じ）"""
+    merged: dict[str, list] = {}
+    for shard in shards:
+        for name in _list_partitions(shard, root):
+            for uid, r in _iter_partition_rows(shard, name, root):
+                values = _prefill_values(name, r)
+                for base, v in values.items():
+                    if isinstance(v, list):
+                        values[base] = DECODED_MULTI_SEP.join(v)
+                for col in ("timestamp", "image_file", "image_url"):
+                    if col in r:
+                        values[col] = r[col]
+                values["user_id"] = uid
+                merged.setdefault(uid, []).append(values)
+    for uid in sorted(merged):
+        row = _merge_user_rows(merged[uid])
+        office, _, personal = uid.partition("_")
+        row["office_id"] = row.get("office_id") or office
+        row["personal_id"] = row.get("personal_id") or personal
+        yield {k: row.get(k, "") for k in header}
+
+
+def _decoded_batches(shards: list[str], root: str | None = None) -> list[list[str]]:
+    """シャードを DECODED_BATCH_BYTES 程度ずつにまとめる（小さな表を何度も作らず、全件も一度に載せない）"""
+    batches: list[list[str]] = []
+    current: list[str] = []
+    size = 0
+    for shard in shards:
+        for name in _list_partitions(shard, root):
+            with contextlib.suppress(OSError):
+                size += os.path.getsize(os.path.join(_shard_dir(shard, root), f"{name}.csv"))
+        current.append(shard)
+        if size >= DECODED_BATCH_BYTES:
+            batches.append(current)
+            current, size = [], 0
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _iter_decoded_csv(office_id: str | None = None, progress: dict | None = None):
+    """ラベル化した横持ちビューを CSV（BOM付き UTF-8）のチャンクとして逐次生成する（開始時点のスナップショットから読む）"""
+    shards = _export_shards(office_id)
+    with _store_snapshot(shards) as root:
+        header = _decoded_header(shards, root)
+        buf = io.StringIO()
+        buf.write("\ufeff")
+        csv.DictWriter(buf, fieldnames=header).writeheader()
+        yield buf.getvalue().encode("utf-8")
+        for batch in _decoded_batches(shards, root):
+            buf = io.StringIO()
+            if pd is not None:
+                frame = _decoded_frame(batch, header, root)
+                if office_id:
+                    frame = frame[frame["user_id"].map(_office_of_user) == office_id]
+                frame.to_csv(buf, header=False, index=False, lineterminator="\r\n")
+                written = len(frame)
+            else:
+                writer = csv.DictWriter(buf, fieldnames=header)
+                written = 0
+                for r in _decoded_rows(batch, header, root):
+                    if not office_id or _office_of_user(r.get("user_id", "")) == office_id:
+                        writer.writerow(r)
+                        written += 1
+            if progress is not None:
+                progress["decoded"] = progress.get("decoded", 0) + written
+            if buf.tell():
+                yield buf.getvalue().encode("utf-8")
+
+
+@app.get("/api/export/decoded")
+async def download_decoded_export(office_id: str | None = None):
+    """one-hot 列を選択肢ラベルの列に戻した横持ち CSV（office_id 指定でその事業所のみ）"""
+    try:
+        filename = f"records_decoded_{office_id}.csv" if office_id else "records_decoded.csv"
+        return StreamingResponse(
+            _iter_decoded_csv(office_id),
+            media_type="text/csv; charset=utf-8",
+            headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        )
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+
+
+# ------------------------------------------------------------
+# 🔹 エクスポートジョブ（大きなエクスポートをバックグラウンドで作り、成果物を保持して返す）
+# ------------------------------------------------------------
+# 全件 CSV・ラベル化 CSV・画像の一括ダウンロードはリクエストの中で作っていたため、ワーカーを長く占有し、
+# nginx のプロキシの既定タイムアウト（60秒）で切れることがあった。POST /api/export/jobs で投入して job_id を受け取り、
+# GET /api/export/jobs/{job_id} で進捗（rows: 書いた行数、bytes: 書いたバイト数、画像は files/total_files）を見て、
+# 完了後に GET /api/export/jobs/{job_id}/download で受け取る。
+# - 実行は APOS_EXPORT_JOB_WORKERS 本のスレッドプール（待ち・実行中が APOS_EXPORT_JOB_MAX_QUEUED に達したら断る）
+# - job_id は「形式 + 絞り込み + 対象パーティションの版」から決める。同じ内容の投入は実行中のジョブにまとめ、
+#   データが変わっていなければ作成済みの成果物をそのまま返す。状態は _exports/<job_id>.json に置き、別ワーカーとも共有する
+# - 成果物は APOS_EXPORT_JOB_TTL_SEC を過ぎたら消す
+EXPORT_JOB_WORKERS = max(1, int(os.environ.get("APOS_EXPORT_JOB_WORKERS", "2")))
+EXPORT_JOB_MAX_QUEUED = int(os.environ.get("APOS_EXPORT_JOB_MAX_QUEUED", "16"))
+EXPORT_JOB_TTL_SEC = float(os.environ.get("APOS_EXPORT_JOB_TTL_SEC", str(24 * 3600)))
+# 形式 → (拡張子, media_type)
+EXPORT_JOB_FORMATS = {
+    "csv": (".csv", "text/csv; charset=utf-8"),
+    "decoded": (".csv", "text/csv; charset=utf-8"),
+    "images": (".zip", "application/zip"),
+}
+_EXPORT_JOB_DIRNAME = "_exports"
+
+_export_jobs_lock = threading.Lock()
+# このプロセスで投入したジョブ（job_id → 状態）
+_export_jobs: dict[str, dict] = {}
+_export_pool: ThreadPoolExecutor | None = None
+# 停止時に立てる（実行中のジョブは次の書き込みの前に見て取り消す）
+_export_jobs_stopping = threading.Event()
+
+
+def _export_job_dir() -> str:
+    return os.path.join(RECORDS_PARTITION_DIR, _EXPORT_JOB_DIRNAME)
+
+
+def _export_job_meta_path(job_id: str) -> str:
+    return os.path.join(_export_job_dir(), f"{job_id}.json")
+
+
+def _export_job_artifact_path(job: dict) -> str:
+    return os.path.join(_export_job_dir(), job["job_id"] + EXPORT_JOB_FORMATS[job["format"]][0])
+
+
+def _ensure_export_pool() -> ThreadPoolExecutor:
+    global _export_pool
+    with _export_jobs_lock:
+        if _export_pool is None:
+            _export_jobs_stopping.clear()
+            _export_pool = ThreadPoolExecutor(max_workers=EXPORT_JOB_WORKERS, thread_name_prefix="export-job")
+        return _export_pool
+
+
+def _export_jobs_stop() -> None:
+    """停止時: 待ち中のジョブは取り消し、実行中のジョブには取り消しを伝えて終わるのを待つ（次回の投入でやり直す）"""
+    global _export_pool
+    with _export_jobs_lock:
+        pool, _export_pool = _export_pool, None
+        _export_jobs_stopping.set()
+    if pool is None:
+        return
+    pool.shutdown(wait=True, cancel_futures=True)
+    # プールから外された待ち中のジョブも取り消し扱いにする（状態ファイルに queued のまま残さない）
+    with _export_jobs_lock:
+        queued = [j for j in _export_jobs.values() if j["state"] == "queued"]
+        for job in queued:
+            job.update(state="cancelled", finished_at=time.time())
+    for job in queued:
+        with contextlib.suppress(OSError):
+            _export_job_save(job)
+
+
+def _export_job_version(fmt: str, shards: list[str]) -> str:
+    """対象パーティション（画像は uploads も）の版。どれかが書き換われば変わる"""
+    h = hashlib.sha1()
+    for shard in shards:
+        for name in _list_partitions(shard):
+            h.update(repr((shard, name, _file_sig(os.path.join(_shard_dir(shard), f"{name}.csv")))).encode("utf-8"))
+    if fmt == "images":
+        h.update(repr(_file_sig(UPLOADS_DIR)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _export_job_filename(fmt: str, office_id: str | None, q: str | None) -> str:
+    stem = {"csv": "query" if q else "records", "decoded": "records_decoded", "images": "images"}[fmt]
+    return f"{stem}_{office_id}{EXPORT_JOB_FORMATS[fmt][0]}" if office_id else f"{stem}{EXPORT_JOB_FORMATS[fmt][0]}"
+
+
+def _export_job_save(job: dict) -> None:
+    """状態ファイルを書き換える（tmp → os.replace）"""
+    path = _export_job_meta_path(job["job_id"])
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as wf:
+        json.dump(job, wf, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _export_job_read(job_id: str, memory: bool = True) -> dict | None:
+    """ジョブの状態（このプロセスのジョブはメモリから、別ワーカーのものは状態ファイルから）"""
+    if memory:
+        with _export_jobs_lock:
+            job = _export_jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+    try:
+        with open(_export_job_meta_path(job_id), "r", encoding="utf-8") as rf:
+            return json.load(rf)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _export_job_live(job: dict) -> bool:
+    """完了して成果物が残っているか、所有プロセスで待ち・実行中なら有効（失敗・持ち主のいないジョブは作り直す）"""
+    if job.get("state") == "done":
+        return os.path.exists(_export_job_artifact_path(job))
+    if job.get("state") not in ("queued", "running"):
+        return False
+    pid = job.get("pid")
+    if pid == os.getpid() and job.get("pid_start") == _pid_start_token(pid):
+        with _export_jobs_lock:
+            mine = _export_jobs.get(job["job_id"])
+            return (mine is not None and mine["state"] in ("queued", "running")
+                    and mine["created_at"] == job.get("created_at"))
+    if not isinstance(pid, int) or not _pid_alive(pid):
+        return False
+    # pid が別のプロセスに再利用されていれば持ち主はもういない
+    token = _pid_start_token(pid)
+    return token is None or job.get("pid_start") is None or token == job["pid_start"]
+
+
+def _export_job_claim(job: dict) -> dict | None:
+    """
+    状態ファイルを作ってジョブを確保する（書き終えた tmp をハードリンクするので、作成は原子的で中身も欠けない）。
+    別ワーカーの有効なジョブが既にあればそれを返す。
+    """
+    path = _export_job_meta_path(job["job_id"])
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as wf:
+        json.dump(job, wf, ensure_ascii=False)
+    try:
+        for _attempt in range(2):
+            try:
+                os.link(tmp, path)
+                return None
+            except FileExistsError:
+                other = _export_job_read(job["job_id"], memory=False)
+                if other is not None and other.get("created_at") != job["created_at"] and _export_job_live(other):
+                    return other
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            except OSError:
+                # ハードリンクできないファイルシステムでは排他なしで置く
+                os.replace(tmp, path)
+                return None
+        return None
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+
+
+def _export_job_gc() -> int:
+    """APOS_EXPORT_JOB_TTL_SEC を過ぎた成果物と状態ファイルを消す（このプロセスで待ち・実行中のものは残す）"""
+    try:
+        entries = os.listdir(_export_job_dir())
+    except FileNotFoundError:
+        return 0
+    with _export_jobs_lock:
+        active = {jid for jid, j in _export_jobs.items() if j["state"] in ("queued", "running")}
+    removed = 0
+    now = time.time()
+    for entry in entries:
+        if entry.split(".", 1)[0] in active:
+            continue
+        path = os.path.join(_export_job_dir(), entry)
+        try:
+            if now - os.path.getmtime(path) < EXPORT_JOB_TTL_SEC:
+                continue
+            os.remove(path)
+            removed += 1
+        except OSError:
+            continue
+    with _export_jobs_lock:
+        for jid in [jid for jid, j in _export_jobs.items()
+                    if j["state"] in ("done", "error", "cancelled") and now - (j.get("finished_at") or now) >= EXPORT_JOB_TTL_SEC]:
+            del _export_jobs[jid]
+    return removed
+
+
+def _export_image_names(shards: list[str], office_id: str | None, root: str) -> list[str]:
+    """スナップショットの各パーティションが参照している画像ファイル名（image_file と *_image_filename* 列）"""
+    names: list[str] = []
+    for shard in shards:
+        for name in _list_partitions(shard, root):
+            for uid, r in _iter_partition_rows(shard, name, root):
+                if office_id and _office_of_user(uid) != office_id:
+                    continue
+                for col, v in r.items():
+                    if col != "image_file" and "image_filename" not in col:
+                        continue
+                    for n in str(v or "").split(";"):
+                        n = os.path.basename(n.strip())
+                        if "." in n:
+                            names.append(n)
+    return list(dict.fromkeys(names))
+
+
+def _export_images_zip(wf, job: dict) -> None:
+    """参照されている画像を ZIP にまとめる（JPEG は圧縮済みなので無圧縮で格納）"""
+    office_id = job["office_id"] or None
+    shards = _export_shards(office_id)
+    with _store_snapshot(shards) as root:
+        names = _export_image_names(shards, office_id, root)
+    job["total_files"] = len(names)
+    with zipfile.ZipFile(wf, "w", compression=zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name in names:
+            path = os.path.join(UPLOADS_DIR, name)
+            if os.path.isfile(path):
+                zf.write(path, arcname=name)
+            job["files"] += 1
+            job["bytes"] = wf.tell()
+            yield
+
+
+def _export_job_run(job: dict, user_ids: list[str] | None) -> None:
+    """プールのスレッドで成果物を作る（tmp に書いてから置き換える。進捗は約1秒ごとに状態ファイルへ）"""
+    if _export_jobs_stopping.is_set():
+        job.update(state="cancelled", finished_at=time.time())
+        with contextlib.suppress(OSError):
+            _export_job_save(job)
+        return
+    job.update(state="running", started_at=time.time())
+    _export_job_save(job)
+    artifact = _export_job_artifact_path(job)
+    tmp = f"{artifact}.{os.getpid()}.tmp"
+    progress: dict = {}
+    saved_at = time.monotonic()
+    cancelled = False
+    try:
+        with open(tmp, "wb") as wf:
+            if job["format"] == "images":
+                steps = _export_images_zip(wf, job)
+            elif job["format"] == "decoded":
+                steps = _iter_decoded_csv(job["office_id"] or None, progress=progress)
+            else:
+                steps = _iter_export_csv(job["office_id"] or None,
+                                         user_ids=set(user_ids) if user_ids is not None else None, progress=progress)
+            try:
+                for chunk in steps:
+                    if _export_jobs_stopping.is_set():
+                        cancelled = True
+                        break
+                    if chunk:
+                        wf.write(chunk)
+                        job["bytes"] += len(chunk)
+                    job["rows"] = sum(progress.values())
+                    if time.monotonic() - saved_at >= 1.0:
+                        _export_job_save(job)
+                        saved_at = time.monotonic()
+            finally:
+                steps.close()
+        if cancelled:
+            os.remove(tmp)
+            job.update(state="cancelled", finished_at=time.time())
+            print("📦 export job cancelled:", job["job_id"])
+        else:
+            os.replace(tmp, artifact)
+            job.update(state="done", rows=sum(progress.values()), bytes=os.path.getsize(artifact), finished_at=time.time())
+            print(f"📦 export job done: {job['job_id']} {job['format']} rows={job['rows']} bytes={job['bytes']}")
+    except Exception as e:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp)
+        job.update(state="error", error=str(e), finished_at=time.time())
+        print("⚠️ export job failed:", job["job_id"], e)
+    try:
+        _export_job_save(job)
+    except Exception as e:
+        print("⚠️ export job state save failed:", job["job_id"], e)
+
+
+def _export_job_submit(fmt: str, office_id: str | None = None, q: str | None = None) -> dict:
+    """
+    ジョブを投入して状態を返す。同じ内容のジョブが待ち・実行中ならそれを、作成済みでデータが変わっていなければ
+    その成果物のジョブを返す（deduplicated=True）。
+    """
+    fmt = str(fmt or "csv").strip().lower()
+    if fmt not in EXPORT_JOB_FORMATS:
+        raise ValueError(f"unknown format: {fmt}（{', '.join(EXPORT_JOB_FORMATS)}）")
+    office = str(office_id or "").strip() or None
+    query = str(q or "").strip() or None
+    if query and fmt != "csv":
+        raise ValueError("q は format=csv でのみ使えます")
+    _store_flush()
+    _export_job_gc()
+    os.makedirs(_export_job_dir(), exist_ok=True)
+    user_ids = _cohort_query(query, office)["user_ids"] if query else None
+    version = _export_job_version(fmt, _export_shards(office))
+    job_id = hashlib.sha1(json.dumps([fmt, office or "", query or "", version]).encode("utf-8")).hexdigest()[:20]
+    job = {
+        "job_id": job_id,
+        "format": fmt,
+        "office_id": office or "",
+        "q": query or "",
+        "filename": _export_job_filename(fmt, office, query),
+        "state": "queued",
+        "rows": 0,
+        "bytes": 0,
+        "files": 0,
+        "total_files": None,
+        "error": None,
+        "pid": os.getpid(),
+        "pid_start": _pid_start_token(os.getpid()),
+        "created_at": time.time(),
+        "started_at": None,
+        "finished_at": None,
+    }
+    artifact = _export_job_artifact_path(job)
+    with _export_jobs_lock:
+        # 同じ内容のジョブがこのプロセスで待ち・実行中、または作成済みの成果物が残っていればそれを返す
+        current = _export_jobs.get(job_id)
+        if current is not None and (current["state"] in ("queued", "running")
+                                    or (current["state"] == "done" and os.path.exists(artifact))):
+            return dict(current, deduplicated=True)
+        pending = sum(1 for j in _export_jobs.values() if j["state"] in ("queued", "running"))
+        if pending >= EXPORT_JOB_MAX_QUEUED:
+            raise RuntimeError("エクスポートジョブが混み合っています。しばらくしてから再投入してください")
+        _export_jobs[job_id] = job
+    # 別ワーカーと同じジョブを二重に作らないよう、状態ファイルで確保する
+    other = _export_job_claim(job)
+    if other is not None:
+        with _export_jobs_lock:
+            if _export_jobs.get(job_id) is job:
+                del _export_jobs[job_id]
+        return dict(other, deduplicated=True)
+    _ensure_export_pool().submit(_export_job_run, job, user_ids)
+    return dict(job, deduplicated=False)
+
+
+@app.post("/api/export/jobs")
+async def submit_export_job(request: Request):
+    """
+    エクスポートジョブの投入。body: {"format": "csv" | "decoded" | "images", "office_id": 任意, "q": 任意（csv のみ・/api/query の式）}
+    戻り値の job.job_id で進捗を取得し、state が done になったら /download から受け取る。
+    """
+    try:
+        body = await request.json()
+    except Exception:
+        body = {}
+    if not isinstance(body, dict):
+        body = {}
+    try:
+        job = await run_in_threadpool(_export_job_submit, body.get("format", "csv"), body.get("office_id"), body.get("q"))
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+    return {"status": "ok", "job": job}
+
+
+@app.get("/api/export/jobs/{job_id}")
+async def get_export_job(job_id: str):
+    """エクスポートジョブの状態と進捗（rows / bytes / files / total_files）"""
+    job = _export_job_read(job_id) if re.fullmatch(r"[0-9a-f]{20}", job_id or "") else None
+    if job is None:
+        return {"status": "error", "message": "job not found"}
+    return {"status": "ok", "job": job}
+
+
+@app.get("/api/export/jobs/{job_id}/download")
+async def download_export_job(job_id: str):
+    """完了したエクスポートジョブの成果物"""
+    job = _export_job_read(job_id) if re.fullmatch(r"[0-9a-f]{20}", job_id or "") else None
+    if job is None:
+        return {"status": "error", "message": "job not found"}
+    if job.get("state") != "done":
+        return {"status": "error", "message": f"job is {job.get('state')}", "job": job}
+    path = _export_job_artifact_path(job)
+    if not os.path.exists(path):
+        return {"status": "error", "message": "artifact expired", "job": job}
+    return FileResponse(path, media_type=EXPORT_JOB_FORMATS[job["format"]][1], filename=job["filename"])
+
+
+# ------------------------------------------------------------
+# 🔹 データ品質チェック（one-hot 列の矛盾の検出）
+# ------------------------------------------------------------
+# 変換の不具合で「はい/いいえ の _0 と _1 が両方 1」「fatigue_score_* に複数の 1」「physical_activity_f18_* と
+# physical_activity_score_* の食い違い」のような行が作られたことがある。パーティションの列から規則ごとの列グループを
+# 作り、パーティションの内容（読み出しモデルの値タプル）を行列にして列単位（numpy の配列演算）で判定する。
+# デプロイ後に check_quality.py か GET /api/quality で流し、規則ごとに該当する user_id を返す。
+QUALITY_RULES = {
+    "yes_no_both": "はい/いいえ（_0 と _1）が両方 1",
+    "scale_multiple": "0-10 スケールで複数の値が 1",
+    "f18_mismatch": "physical_activity_f18_* と physical_activity_score_* が食い違う",
+    "non_binary": "one-hot 列に 0/1/空欄 以外の値",
+}
+
+
+def _quality_groups(name: str, header: list[str]) -> list[tuple[str, str, list[str]]]:
+    """
+    パーティション名とヘッダ → [(規則, グループ名, 列)]。f18_mismatch の列は [f18_0, score_0, f18_1, score_1, ...] の組。
+    non_binary の対象はプレフィルの逆変換表（CHOICE_MASTER・エイリアス表・form18 スケール）に載っている列だけとし、
+    x_y の形でも自由記述・数値の列（_FORMn_TEXT_COLS など）は対象にしない。
+    """
+    col_set = set(header)
+    choice_groups, _ = _prefill_spec(name, header)
+    one_hot_set = {
+        c for members in choice_groups.values() for c, _ in members
+        if c in col_set and not _search_is_text_col(c)
+    }
+    # physical_activity_f18_* はスコア列と重複するので逆変換表に載らないが one-hot 列として扱う
+    one_hot_set.update(f"physical_activity_f18_{i}" for i in range(11) if f"physical_activity_f18_{i}" in col_set)
+    one_hot_cols = [c for c in header if c in one_hot_set]
+    groups: list[tuple[str, str, list[str]]] = []
+    # はい/いいえ（treatment_respirator_0/1 など）は CHOICE_MASTER に無いものも多いので列の組で見る
+    # （両方が "1" の行だけを拾うので、自由記述の列が混ざっても誤検出にはならない）
+    for col in header:
+        if col.endswith("_0") and not _search_is_text_col(col):
+            base = col[:-2]
+            if f"{base}_1" in col_set and f"{base}_2" not in col_set and not _search_is_text_col(f"{base}_1"):
+                groups.append(("yes_no_both", base, [col, f"{base}_1"]))
+    for base in FORM18_SCALE_BASES:
+        out_base = FORM18_SCALE_ALIASES.get(base, base)
+        members = [f"{out_base}_{i}" for i in range(11) if f"{out_base}_{i}" in col_set]
+        if len(members) > 1:
+            groups.append(("scale_multiple", out_base, members))
+    f18 = [f"physical_activity_f18_{i}" for i in range(11) if f"physical_activity_f18_{i}" in col_set]
+    if len(f18) > 1:
+        groups.append(("scale_multiple", "physical_activity_f18", f18))
+    score_base = FORM18_SCALE_ALIASES.get("physical_activity", "physical_activity")
+    pairs = [
+        c for i in range(11)
+        for c in (f"physical_activity_f18_{i}", f"{score_base}_{i}")
+        if f"physical_activity_f18_{i}" in col_set and f"{score_base}_{i}" in col_set
+    ]
+    if pairs:
+        groups.append(("f18_mismatch", "physical_activity", pairs))
+    if one_hot_cols:
+        groups.append(("non_binary", "*", one_hot_cols))
+    return groups
+
+
+def _quality_hits(rule: str, values) -> "np.ndarray":
+    """規則の判定（values は 行 × 列 の文字列行列）→ 該当行の真偽"""
+    if rule == "non_binary":
+        return ~np.isin(values, ("", "0", "1")).all(axis=1)
+    flags = values == "1"
+    if rule == "f18_mismatch":
+        return (flags[:, 0::2] != flags[:, 1::2]).any(axis=1)
+    if rule == "yes_no_both":
+        return flags.all(axis=1)
+    return flags.sum(axis=1) > 1
+
+
+def _quality_scan_matrix(header: tuple, matrix, groups, report: dict, limit: int) -> None:
+    """行列（行 × ヘッダ列の文字列）を規則ごとに列単位で判定する"""
+    position = {c: i for i, c in enumerate(header)}
+    uids = matrix[:, position["user_id"]]
+    for rule, name, cols in groups:
+        values = np.char.strip(matrix[:, [position[c] for c in cols]].astype(str))
+        for i in np.flatnonzero(_quality_hits(rule, values)):
+            entry = report[rule].setdefault(name, {"count": 0, "user_ids": []})
+            entry["count"] += 1
+            if len(entry["user_ids"]) < limit:
+                entry["user_ids"].append(str(uids[i]).strip())
+
+
+def _quality_scan_rows(rows, groups, report: dict, limit: int) -> None:
+    """numpy が無い環境用: 同じ規則を行ごとに判定する"""
+    for r in rows:
+        for rule, name, cols in groups:
+            values = [str(r.get(c, "") or "").strip() for c in cols]
+            if rule == "non_binary":
+                hit = any(v not in ("", "0", "1") for v in values)
+            elif rule == "f18_mismatch":
+                hit = any((a == "1") != (b == "1") for a, b in zip(values[0::2], values[1::2]))
+            elif rule == "yes_no_both":
+                hit = all(v == "1" for v in values)
+            else:
+                hit = sum(v == "1" for v in values) > 1
+            if hit:
+                entry = report[rule].setdefault(name, {"count": 0, "user_ids": []})
+                entry["count"] += 1
+                if len(entry["user_ids"]) < limit:
+                    entry["user_ids"].append(str(r.get("user_id", "")).strip())
+
+
+def _quality_scan(form_id: str | None = None, office_id: str | None = None, limit: int = 100) -> dict:
+    """
+    レコードストア全体（form_id / office_id で絞り込み可）の one-hot 矛盾を規則ごとに集計する。
+    戻り値: {"rows": 判定した行数, "violations": 該当件数の合計, "rules": {規則: {グループ: {"count", "user_ids"}}}}
+    """
+    started = time.time()
+    _store_flush()
+    fid = str(form_id or "").strip()
+    only = _partition_name(f"form{fid}" if fid.isdigit() else fid) if fid else None
+    office = str(office_id or "").strip() or None
+    shards = _export_shards(office)
+    report: dict = {rule: {} for rule in QUALITY_RULES}
+    checked = 0
+    for shard in shards:
+        for name in _list_partitions(shard):
+            if only is not None and name != only:
+                continue
+            path = os.path.join(_shard_dir(shard), f"{name}.csv")
+            header = _read_header(path) or []
+            groups = _quality_groups(name, header) if "user_id" in header else []
+            if not groups:
+                continue
+            if np is not None:
+                # 読み出しモデルの値タプルをそのまま行列にする（保持できない大きさならディスクから読む）
+                entry = _read_model_get(path)
+                if entry is not None:
+                    header, values = entry[1], list(entry[2].values())
+                else:
+                    with open(path, "r", encoding="utf-8-sig", newline="") as rf:
+                        reader = csv.reader(rf)
+                        header = tuple(next(reader, []))
+                        values = [r + [""] * (len(header) - len(r)) for r in reader]
+                    groups = _quality_groups(name, list(header))
+                if office is not None:
+                    uid_idx = header.index("user_id")
+                    values = [v for v in values if _office_of_user(v[uid_idx]) == office]
+                if not values:
+                    continue
+                _quality_scan_matrix(tuple(header), np.array(values, dtype=object), groups, report, limit)
+                checked += len(values)
+            else:
+                rows = [r for r in _read_model_rows(path)
+                        if office is None or _office_of_user(r.get("user_id", "")) == office]
+                _quality_scan_rows(rows, groups, report, limit)
+                checked += len(rows)
+    return {
+        "rows": checked,
+        "violations": sum(e["count"] for groups in report.values() for e in groups.values()),
+        "rules": report,
+        "descriptions": QUALITY_RULES,
+        "elapsed_sec": round(time.time() - started, 3),
+    }
+
+
+@app.get("/api/quality")
+async def get_quality_report(form_id: str | None = None, office_id: str | None = None, limit: int = 100):
+    """one-hot 列の矛盾の検出結果（規則 → 列グループ → 件数と user_id（最大 limit 件））"""
+    try:
+        return {"status": "ok", **(await run_in_threadpool(_quality_scan, form_id, office_id, limit))}
+    except Exception as e:
+        return {"status": "error", "detail": str(e)}
+
+
+# ------------------------------------------------------------
+# 🔹 共通保存の行組み立て（/api/form{n} とアーカイブ再処理で共用）
+# ------------------------------------------------------------
+def _build_section_row(payload: dict, form_id: str, now: datetime, image_files: list[str] | None = None) -> dict:
+    """/api/form{n} の1フォーム分の payload → 保存行（image_files の扱いは _build_production_row と同じ）"""
+    timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+
+    # 画像保存 + データをフラット化（DataURL → jpg ファイル）
+    if image_files is None:
+        image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
+    field_types = payload.pop("field_types", None)
+    flattened = _flatten_payload(payload, field_types)
+
+    # ユーザー識別
+    uid = (payload.get("user_id") or flattened.get("user_id") or "").strip()
+    office_id = (payload.get("office_id") or flattened.get("office_id") or "").strip()
+    personal_id = (payload.get("personal_id") or flattened.get("personal_id") or "").strip()
+    if not uid and office_id and personal_id:
+        uid = f"{office_id}_{personal_id}"
+        flattened["user_id"] = uid
+
+    # 行データ作成
+    row = _KeyedRow({"timestamp": timestamp, "form_id": form_id})
+    row.update(flattened)
+    if uid:
+        row["user_id"] = uid
+
+    # 画像列は常に出力（無ければ空文字）
+    row["image_file"] = ";".join(image_files) if image_files else ""
+    row["image_url"] = ";".join(f"{BASE_UPLOAD_URL}/{fname}" for fname in image_files) if image_files else ""
+
+
+    if form_id == "form2":
+        form2_only = _form2_apply_order(row)
+        # デバッグ: _form2_apply_order 適用後の主要列を確認
+        try:
+            debug_after_activity = {
+                k: form2_only.get(k, "")
+                for k in (
+                    "activity_6_8","activity_8_10","activity_10_12","activity_12_14",
+                    "activity_14_16","activity_16_18","activity_18_20","activity_20_22","activity_22_6",
+                )
+            }
+            debug_after_public = {
+                k: form2_only.get(k, "")
+                for k in form2_only.keys()
+                if isinstance(k, str)
+                and (
+                    k.startswith((
+                        "public_medical_", "expensive_cost_", "economic_status_", "option_detail_",
+                    ))
+                )
+            }
+            print("✅ after _form2_apply_order (activity):", debug_after_activity)
+            print("✅ after _form2_apply_order (public/exp/econ/option):", debug_after_public)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form2_only["timestamp"], "form_id": form_id, "user_id": uid}, **form2_only, **img_cols}
+    elif form_id == "form3":
+        form3_only = _form3_apply_order_and_image(row)
+        # デバッグ: form3 の主要 one-hot / 数値・テキスト列を確認
+        try:
+            debug_f3 = {}
+            for k in list(form3_only.keys()):
+                if (
+                    k.startswith((
+                        "residence_type_", "elevator_", "entrance_to_road_", "reform_need_",
+                        "reform_place_", "care_tool_need_", "care_tool_type_", "equipment_need_",
+                        "equipment_type_", "social_service_usage_",
+                    ))
+                    or k in ("apartment_floor","room_safety","room_photo_image_filename","social_service_reason_text")
+                ):
+                    debug_f3[k] = form3_only.get(k, "")
+            print("🏠 form3 payload (residence/elevator/entrance/reform/tools/equipment):", debug_f3)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form3_only["timestamp"], "form_id": form_id, "user_id": uid}, **form3_only, **img_cols}
+    elif form_id == "form4":
+        form4_only = _form4_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form4_only["timestamp"], "form_id": form_id, "user_id": uid}, **form4_only, **img_cols}
+    elif form_id == "form5":
+        form5_only = _form5_apply_order(row)
+        # デバッグ: form5 の主要列を確認
+        try:
+            keys_rel = [f"relationship_status_{i}" for i in range(4)]
+            keys_con = [f"consultation_status_{i}" for i in range(2)]
+            keys_sp1 = [f"social_participation_1_{t}" for t in ("a","b","c","d")]
+            debug_f5 = {k: form5_only.get(k, "") for k in (keys_rel + keys_con + keys_sp1)}
+            print("🏷 form5 payload (rel/consult/sp1):", debug_f5)
+        except Exception:
+            pass
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form5_only["timestamp"], "form_id": form_id, "user_id": uid}, **form5_only, **img_cols}
+    elif form_id == "form6":
+        form6_only = _form6_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form6_only["timestamp"], "form_id": form_id, "user_id": uid}, **form6_only, **img_cols}
+    elif form_id == "form7":
+        form7_only = _form7_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form7_only["timestamp"], "form_id": form_id, "user_id": uid}, **form7_only, **img_cols}
+    elif form_id == "form8":
+        form8_only = _form8_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form8_only["timestamp"], "form_id": form_id, "user_id": uid}, **form8_only, **img_cols}
+    elif form_id == "form9":
+        form9_only = _form9_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form9_only["timestamp"], "form_id": form_id, "user_id": uid}, **form9_only, **img_cols}
+    elif form_id == "form10":
+        form10_only = _form10_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        # form10 は URL 列は不要
+        img_cols.pop("image_url", None)
+        row = {**{"timestamp": form10_only["timestamp"], "form_id": form_id, "user_id": uid}, **form10_only, **img_cols}
+    elif form_id == "form11":
+        form11_only = _form11_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form11_only["timestamp"], "form_id": form_id, "user_id": uid}, **form11_only, **img_cols}
+    elif form_id == "form12":
+        form12_only = _form12_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form12_only["timestamp"], "form_id": form_id, "user_id": uid}, **form12_only, **img_cols}
+    elif form_id == "form13":
+        form13_only = _form13_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form13_only["timestamp"], "form_id": form_id, "user_id": uid}, **form13_only, **img_cols}
+    elif form_id == "form14":
+        form14_only = _form14_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form14_only["timestamp"], "form_id": form_id, "user_id": uid}, **form14_only, **img_cols}
+    elif form_id == "form15":
+        form15_only = _form15_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form15_only["timestamp"], "form_id": form_id, "user_id": uid}, **form15_only, **img_cols}
+    elif form_id == "form16":
+        form16_only = _form16_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form16_only["timestamp"], "form_id": form_id, "user_id": uid}, **form16_only, **img_cols}
+    elif form_id == "form17":
+        form17_only = _form17_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form17_only["timestamp"], "form_id": form_id, "user_id": uid}, **form17_only, **img_cols}
+    elif form_id == "form18":
+        form18_only = _form18_apply_order(row)
+        img_cols = {k: row[k] for k in ("image_file","image_url") if k in row}
+        row = {**{"timestamp": form18_only["timestamp"], "form_id": form_id, "user_id": uid}, **form18_only, **img_cols}
+    # 不要列をCSVから除外
+    for k in ("session", "form_id"):
+        row.pop(k, None)
+    _set_visit_session(row, payload, flattened)
+    return row
+
+
+# ------------------------------------------------------------
+# 🟩 共通保存エンドポイント（form0, form1, form2…を統一管理）
+# ------------------------------------------------------------
+@app.post("/api/form{form_num}")
+async def save_form_section(form_num: int, request: Request):
+    """
+    form0.html / form1.html / form2.html などのページデータを共通保存
+    """
+    idem_key = None
+    result = None
+    try:
+        _ensure_dirs()
+
+        payload = await request.json()
+        if not isinstance(payload, dict):
+            return {"status": "error", "message": "Invalid JSON"}
+
+        # 同じ送信の再送なら、画像保存や書き込みをせず元の応答を返す
+        idem_key = _idempotency_key(request, payload)
+        replay = await _idempotency_begin(idem_key)
+        if replay is not None:
+            idem_key = None
+            return replay
+
+        # form_idを自動設定
+        form_id = payload.get("form_id") or f"form{form_num}"
+        now = datetime.now(timezone(timedelta(hours=9)))
+        timestamp = now.strftime("%Y-%m-%d %H:%M:%S")
+
+        # 生 payload（画像を除く）を控えてから、画像保存 + 行の組み立て
+        raw = _archive_snapshot(payload)
+        image_files, image_key_map = _decode_and_save_images(payload, form_id, now)
+        row = _build_section_row(payload, form_id, now, image_files)
+        _archive_raw_payload(request.url.path, form_id, now, raw, image_files)
 
-        # CSVへアップサート
-        _upsert_row(RECORDS_CSV_PATH, row, KEY_FIELDS)
+        # フォーム別パーティションへアップサート（別事業所の保存とは並行に進む）
+        durability = await run_in_threadpool(_store_submit, form_id, row, _wants_commit(request))
 
-        return {"status": "ok", "form_id": form_id, "timestamp": timestamp}
+        result = {"status": "ok", "form_id": form_id, "timestamp": timestamp, "durability": durability}
+        return result
 
     except Exception as e:
         return {"status": "error", "message": str(e)}
+    finally:
+        # 取り消し（CancelledError）でも待っている再送を解放する
+        _idempotency_finish(idem_key, result)
 
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+"""
+キャプチャ再生スクリプト（負荷試験）
+APOS_CAPTURE=1 で記録したフォーム送信を、アプリ本体（プロセス内）または起動中のサーバーへ
+元の間隔を速めて送り直し、応答時間の分布を表示する
+
+使い方:
+    python replay_capture.py captures/capture-*.jsonl
+    python replay_capture.py captures/*.jsonl --speed 20 --concurrency 128
+    python replay_capture.py captures/*.jsonl --target http://127.0.0.1:8000 --speed 0
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# main.py と同じディレクトリから読み込む
+sys.path.insert(0, str(Path(__file__).parent))
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+def load_captures(files, limit=None):
+    """キャプチャを時刻順に読み込む"""
+    records = []
+    for name in files:
+        with open(name, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(rec, dict) and rec.get("path"):
+                    records.append(rec)
+    records.sort(key=lambda r: r.get("ts", 0))
+    return records[:limit] if limit else records
+
+
+def restore_images(value, sizes, key=""):
+    """--image-size original: 差し替えた画像を元の大きさのダミーに戻す（アップロード量を再現）"""
+    if isinstance(value, str) and key in sizes and value.startswith("data:image/"):
+        head, stub = value.split(",", 1)
+        pad = max(0, sizes[key] - len(head) - 1 - len(stub)) * 3 // 4
+        return head + "," + base64.b64encode(base64.b64decode(stub) + b"\0" * pad).decode("ascii")
+    if isinstance(value, dict):
+        return {k: restore_images(v, sizes, f"{key}.{k}" if key else str(k)) for k, v in value.items()}
+    if isinstance(value, list):
+        return [restore_images(v, sizes, f"{key}[{i}]") for i, v in enumerate(value)]
+    return value
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, max(0, math.ceil(q / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[idx]
+
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": round(sum(values) / len(values), 2),
+        "p50": round(percentile(values, 50), 2),
+        "p90": round(percentile(values, 90), 2),
+        "p95": round(percentile(values, 95), 2),
+        "p99": round(percentile(values, 99), 2),
+        "max": round(values[-1], 2),
+    }
+
+
+def histogram(values, width=40):
+    """応答時間（ms）の対数目盛ヒストグラム"""
+    bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float("inf")]
+    counts = [0] * len(bounds)
+    for v in values:
+        for i, b in enumerate(bounds):
+            if v < b:
+                counts[i] += 1
+                break
+    peak = max(counts) or 1
+    lines = []
+    lower = 0
+    for b, c in zip(bounds, counts):
+        if c:
+            label = f"{lower:>5g}-{b:<5g}ms" if b != float("inf") else f"{lower:>5g}+     ms"
+            lines.append(f"  {label} {'#' * max(1, round(c * width / peak)):<{width}} {c}")
+        lower = b
+    return lines
+
+
+async def replay(records, client, speed, concurrency, image_size):
+    """キャプチャ時刻の間隔を speed 倍に縮めて送る（speed=0 は待たずに並列数いっぱいで送る）"""
+    sem = asyncio.Semaphore(concurrency)
+    results = []
+    base_ts = records[0].get("ts", 0) if records else 0
+    started = time.perf_counter()
+
+    async def one(rec):
+        due = (rec.get("ts", 0) - base_ts) / speed if speed > 0 else 0.0
+        delay = due - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with sem:
+            body = rec.get("body")
+            if image_size == "original" and rec.get("images"):
+                body = restore_images(body, rec["images"])
+            url = rec["path"] + (f"?{rec['query']}" if rec.get("query") else "")
+            lag = (time.perf_counter() - started - due) * 1000.0
+            t0 = time.perf_counter()
+            try:
+                resp = await client.post(url, json=body, headers=rec.get("headers") or {})
+                status = resp.status_code
+                try:
+                    ok = 200 <= status < 300 and (resp.json() or {}).get("status") != "error"
+                except ValueError:
+                    ok = 200 <= status < 300
+            except Exception as e:
+                status, ok = f"{type(e).__name__}", False
+            results.append({
+                "path": rec["path"],
+                "status": status,
+                "ok": ok,
+                "latency_ms": (time.perf_counter() - t0) * 1000.0,
+                "lag_ms": lag,
+                "captured_ms": rec.get("latency_ms"),
+            })
+
+    await asyncio.gather(*(one(r) for r in records))
+    return results, time.perf_counter() - started
+
+
+def prepare_in_process(workdir):
+    """アプリ本体を読み込み、保存先を作業ディレクトリに付け替える（本番のストア・DBには書かない）"""
+    os.environ["APOS_CAPTURE"] = "0"
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as app_main
+    app_main.RECORDS_CSV_PATH = os.path.join(workdir, "records.csv")
+    app_main.DEMO_CSV_PATH = os.path.join(workdir, "exports_demo", "demo_records.csv")
+    app_main.UPLOADS_DIR = os.path.join(workdir, "uploads")
+    app_main.RECORDS_PARTITION_DIR = os.path.join(workdir, "records_parts")
+    app_main.RAW_ARCHIVE_DIR = os.path.join(workdir, "raw_archive")
+    app_main.SEARCH_DB_PATH = os.path.join(workdir, "search.sqlite3")
+    # DB（APOS_DB_URL・旧ユーティリティ）とアウトボックスの分析ログには配送しない
+    app_main.DB_URL = ""
+    app_main.init_db = None
+    app_main.insert_form_data = None
+    app_main.OUTBOX_ANALYTICS_LOG = ""
+    app_main._ensure_dirs()
+    return app_main
+
+
+async def run(args, records):
+    if args.target:
+        client = httpx.AsyncClient(base_url=args.target, timeout=args.timeout)
+        try:
+            return await replay(records, client, args.speed, args.concurrency, args.image_size)
+        finally:
+            await client.aclose()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="apos-replay-")
+    print(f"作業ディレクトリ: {workdir}")
+    app_main = prepare_in_process(workdir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        await app_main.app.router.startup()
+    transport = httpx.ASGITransport(app=app_main.app)
+    client = httpx.AsyncClient(transport=transport, base_url="http://replay", timeout=args.timeout)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await replay(records, client, args.speed, args.concurrency, args.image_size)
+    finally:
+        await client.aclose()
+        with contextlib.redirect_stdout(io.StringIO()):
+            await app_main.app.router.shutdown()
+
+
+def main():
+    """メイン関数"""
+    parser = argparse.ArgumentParser(description="キャプチャしたフォーム送信の再生（負荷試験）")
+    parser.add_argument("files", nargs="+", help="キャプチャファイル（capture-*.jsonl）")
+    parser.add_argument("--target", help="送り先のサーバー（例: http://127.0.0.1:8000）。省略時はプロセス内で実行")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度の倍率（0 は間隔を空けずに送る）")
+    parser.add_argument("--concurrency", type=int, default=64, help="同時に送る件数の上限")
+    parser.add_argument("--limit", type=int, help="先頭から送る件数")
+    parser.add_argument("--image-size", choices=["stub", "original"], default="stub",
+                        help="画像を極小のまま送るか、元の大きさのダミーに戻すか")
+    parser.add_argument("--workdir", help="プロセス内実行時の保存先（省略時は一時ディレクトリ）")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1件あたりのタイムアウト（秒）")
+    parser.add_argument("--json", help="集計結果を JSON で書き出すファイル")
+    args = parser.parse_args()
+
+    if httpx is None:
+        print("⚠ httpx が必要です（pip install httpx）")
+        sys.exit(2)
+
+    records = load_captures(args.files, args.limit)
+    if not records:
+        print("⚠ 再生する記録がありません")
+        sys.exit(1)
+    span = records[-1].get("ts", 0) - records[0].get("ts", 0)
+    print(f"記録: {len(records)} 件（元の所要 {span:.1f} 秒） → 速度 x{args.speed or '∞'} / 並列 {args.concurrency}")
+
+    results, elapsed = asyncio.run(run(args, records))
+
+    report = {
+        "requests": len(results),
+        "failed": sum(1 for r in results if not r["ok"]),
+        "elapsed_sec": round(elapsed, 3),
+        "requests_per_sec": round(len(results) / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": summarize([r["latency_ms"] for r in results]),
+        "captured_latency_ms": summarize([r["captured_ms"] for r in results if r["captured_ms"] is not None]),
+        "schedule_lag_ms": summarize([max(0.0, r["lag_ms"]) for r in results]),
+        "by_path": {},
+        "status": {},
+    }
+    for r in results:
+        report["status"][str(r["status"])] = report["status"].get(str(r["status"]), 0) + 1
+    for path in sorted({r["path"] for r in results}):
+        report["by_path"][path] = summarize([r["latency_ms"] for r in results if r["path"] == path])
+
+    print(f"\n送信: {report['requests']} 件 / 失敗: {report['failed']} / {report['elapsed_sec']} 秒"
+          f" ({report['requests_per_sec']} 件/秒)")
+    print(f"ステータス: {json.dumps(report['status'], ensure_ascii=False)}")
+    for label, key in (("応答時間", "latency_ms"), ("本番の応答時間", "captured_latency_ms"), ("送信の遅れ", "schedule_lag_ms")):
+        s = report[key]
+        if s.get("count"):
+            print(f"{label}(ms): p50 {s['p50']} / p90 {s['p90']} / p95 {s['p95']} / p99 {s['p99']} / max {s['max']}")
+    print("\n応答時間の分布:")
+    for line in histogram([r["latency_ms"] for r in results]):
+        print(line)
+    print("\nパス別(ms):")
+    for path, s in report["by_path"].items():
+        print(f"  {path:<20} {s['count']:>6} 件  p50 {s['p50']:>8}  p99 {s['p99']:>8}  max {s['max']:>8}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()
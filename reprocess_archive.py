@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+生 payload アーカイブ再処理スクリプト
+raw_archive に残した受信内容を現在の変換で並列に組み立て直し、レコードストアを作り直す
+
+使い方:
+    python reprocess_archive.py
+    python reprocess_archive.py --since 2025-10-01 --until 2025-10-31 --workers 8
+    python reprocess_archive.py --dry-run
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import sys
+from pathlib import Path
+
+# main.py と同じディレクトリから読み込む
+sys.path.insert(0, str(Path(__file__).parent))
+
+
+def main():
+    """メイン関数"""
+    parser = argparse.ArgumentParser(description="生 payload アーカイブの再処理（レコードストアの作り直し）")
+    parser.add_argument("--since", help="この日以降の受信分のみ（YYYY-MM-DD）")
+    parser.add_argument("--until", help="この日までの受信分のみ（YYYY-MM-DD）")
+    parser.add_argument("--workers", type=int, help="変換に使うプロセス数（省略時は CPU コア数）")
+    parser.add_argument("--dry-run", action="store_true", help="変換のみ行い、ストアには書き込まない")
+    args = parser.parse_args()
+
+    # アプリ本体の読み込み時のログは表示しない
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main as app_main
+    app_main._ensure_dirs()
+
+    print(f"アーカイブ: {app_main.RAW_ARCHIVE_DIR}")
+    report = app_main._reprocess_archive(args.since, args.until, args.workers, args.dry_run)
+    print(f"  件数: {report['records']} / 対象行: {report['rows']} / 書き換え: {report['rebuilt']}"
+          f" / 新しい保存があり対象外: {report['skipped_newer']} / エラー: {report['failed']}")
+    print(f"  所要時間: {report['elapsed_sec']} 秒 ({report['records_per_sec']} 件/秒, ワーカー {report['workers']})")
+    print(f"  内訳: {json.dumps(report['phases_sec'], ensure_ascii=False)}")
+    for err in report["errors"][:20]:
+        print(f"  ⚠ {err['record']} 件目: {err['error']}")
+    if report["failed"] > 20:
+        print(f"  …ほか {report['failed'] - 20} 件")
+    if args.dry_run:
+        print("  (dry-run: ストアは変更していません)")
+
+    # 終了前にジャーナルを確定させる
+    app_main._shutdown_flush_records()
+    sys.exit(1 if report["failed"] else 0)
+
+
+if __name__ == "__main__":
+    main()